@@ -0,0 +1,245 @@
+"""Benchmark count_files
+This script generates a synthetic directory tree in a temporary directory and
+runs count_files in its different modes against it, with find and du as the baseline.
+Wall time, files/sec, cpu time, peak RSS and optionally syscall counts are written as JSON.
+Every mode runs under a small shim that forks and waits for it, so its peak
+RSS does not start from the high-water mark of this script. The peak RSS of
+an empty command run the same way is reported as rss_floor_kb, for scale."""
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess as sp
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+COUNT_FILES = os.path.join(SCRIPT_DIR, "count_files.py")
+# Run argv[1:] with its output discarded and print wall, user, sys, peak RSS in KB and the exit code.
+# The child is forked from this small process: a child spawned by the benchmark itself would
+# inherit the peak RSS of the benchmark when it execs.
+RSS_SHIM = """
+import os, sys, time
+started = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    try:
+        null = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        os.dup2(null, 2)
+        os.execvp(sys.argv[1], sys.argv[1:])
+    finally:
+        os._exit(127)
+_, status, usage = os.wait4(pid, 0)
+print(time.perf_counter() - started, usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+      os.waitstatus_to_exitcode(status))
+"""
+
+SETTINGS = {"Depth": 3, "Fanout": 4, "Files": 50, "Size": 4096, "Distribution": "lognormal",
+            "Dupes": 0.1, "Repeat": 3, "Jobs": 4, "Output": "bench_count_files.json",
+            "Label": "", "Seed": 1}
+DISTRIBUTIONS = ["fixed", "uniform", "lognormal"]
+
+OPTIONS = ["--depth", "--fanout", "--files", "--size", "--dist", "--dupes", "--repeat", "--jobs",
+           "-o", "--output", "--label", "--seed", "--strace", "--keep", "-h", "-H", "--help"]
+OPTIONS_VALUES = {"--depth": "Depth", "--fanout": "Fanout", "--files": "Files", "--size": "Size",
+                  "--dist": "Distribution", "--dupes": "Dupes", "--repeat": "Repeat", "--jobs": "Jobs",
+                  "-o": "Output", "--output": "Output", "--label": "Label", "--seed": "Seed"}
+OPTIONS_FLAGS = {"Strace": False, "Keep": False}
+OPTIONS_HELP_TEXT = {
+    "--depth": "{:>5} {:<12}\tDirectory levels below the root (default 3)".format("", OPTIONS[0] + " N"),
+    "--fanout": "{:>5} {:<12}\tSubdirectories per directory (default 4)".format("", OPTIONS[1] + " N"),
+    "--files": "{:>5} {:<12}\tFiles per directory (default 50)".format("", OPTIONS[2] + " N"),
+    "--size": "{:>5} {:<12}\tMean file size in bytes (default 4096)".format("", OPTIONS[3] + " N"),
+    "--dist": "{:>5} {:<12}\tFile size distribution: fixed, uniform or lognormal".format("", OPTIONS[4] + " D"),
+    "--dupes": "{:>5} {:<12}\tFraction of files that copy an earlier file (default 0.1)".format(
+        "", OPTIONS[5] + " F"),
+    "--repeat": "{:>5} {:<12}\tRuns per mode, the fastest is kept (default 3)".format("", OPTIONS[6] + " N"),
+    "--jobs": "{:>5} {:<12}\tJobs passed to the parallel modes (default 4)".format("", OPTIONS[7] + " N"),
+    "--output": "{:>5} {:<12}\tJSON file to write (default bench_count_files.json)".format(
+        OPTIONS[8], OPTIONS[9] + " F"),
+    "--label": "{:>5} {:<12}\tVersion label stored with the results".format("", OPTIONS[10] + " L"),
+    "--seed": "{:>5} {:<12}\tSeed of the generated tree (default 1)".format("", OPTIONS[11] + " N"),
+    "--strace": "{:>5} {:<12}\tAlso count syscalls of every mode with strace -c".format("", OPTIONS[12]),
+    "--keep": "{:>5} {:<12}\tKeep the generated tree".format("", OPTIONS[13]),
+    "-h": "{:>5} {:<12}\tDisplay this help and exit".format(OPTIONS[-3] + " " + OPTIONS[-2], OPTIONS[-1])
+}
+
+
+def file_size(rand):
+    """Draw a file size from the configured distribution"""
+    mean = SETTINGS["Size"]
+    if SETTINGS["Distribution"] == "fixed":
+        return mean
+    if SETTINGS["Distribution"] == "uniform":
+        return rand.randint(0, 2 * mean)
+    return int(rand.lognormvariate(0, 1) * mean / 1.6487)  # e^(1/2) is the mean of lognormal(0, 1)
+
+
+def generate_tree(root):
+    """
+    Generate the synthetic tree
+    Parameters:
+    root: directory to generate the tree in
+    Returns:
+    files: number of files, size: bytes written
+    """
+    rand = random.Random(SETTINGS["Seed"])
+    pool = os.urandom(1024 * 1024)
+    written = []
+    files = 0
+    size = 0
+    level = [root]
+    for depth in range(SETTINGS["Depth"] + 1):
+        next_level = []
+        for directory in level:
+            for idx in range(SETTINGS["Files"]):
+                path = os.path.join(directory, "file_{:05d}.bin".format(idx))
+                if written and rand.random() < SETTINGS["Dupes"]:
+                    shutil.copyfile(rand.choice(written), path)
+                else:
+                    length = file_size(rand)
+                    with open(path, "wb") as _f:
+                        while length > 0:
+                            offset = rand.randrange(len(pool))
+                            chunk = pool[offset:offset + length]
+                            _f.write(chunk)
+                            length -= len(chunk)
+                    if len(written) < 1000:
+                        written.append(path)
+                files += 1
+                size += os.path.getsize(path)
+            if depth < SETTINGS["Depth"]:
+                for idx in range(SETTINGS["Fanout"]):
+                    sub_dir = os.path.join(directory, "dir_{:03d}".format(idx))
+                    os.mkdir(sub_dir)
+                    next_level.append(sub_dir)
+        level = next_level
+    return files, size
+
+
+def count_syscalls(cmd, env):
+    """Run a command under strace -c and return the total number of syscalls"""
+    with tempfile.NamedTemporaryFile("r", suffix=".strace") as _f:
+        sp.run(["strace", "-c", "-f", "-o", _f.name] + cmd, env=env,
+               stdout=sp.DEVNULL, stderr=sp.DEVNULL, check=False)
+        for line in _f.read().splitlines():
+            if line.strip().endswith("total"):
+                return int(line.split()[2])
+    return None
+
+
+def run_once(cmd, env):
+    """
+    Run a command once
+    Returns:
+    wall seconds, user seconds, system seconds, peak RSS in KB and the exit code
+    """
+    output = sp.run([sys.executable, "-S", "-c", RSS_SHIM] + cmd, env=env, stdout=sp.PIPE, check=True).stdout
+    wall, user, system, rss, code = output.split()
+    return float(wall), float(user), float(system), int(rss), int(code)
+
+
+def run_mode(name, cmd, env, files, warmup=False):
+    """Run a mode several times and keep the fastest run"""
+    if warmup:
+        run_once(cmd, env)
+    runs = [run_once(cmd, env) for _ in range(SETTINGS["Repeat"])]
+    wall, user, system, rss, code = min(runs)
+    result = {"mode": name, "cmd": " ".join(cmd), "wall": round(wall, 6),
+              "files_per_sec": round(files / wall, 1) if wall > 0 else None,
+              "user": round(user, 6), "sys": round(system, 6), "peak_rss_kb": rss,
+              "exit_code": code, "syscalls": None}
+    if OPTIONS_FLAGS["Strace"]:
+        result["syscalls"] = count_syscalls(cmd, env)
+    print("{:<20}{:>10.3f}s{:>15,.0f} files/s{:>12,} KB".format(name, wall, result["files_per_sec"] or 0, rss))
+    return result
+
+
+def benchmark(root, files):
+    """Run the baseline and all count_files modes against the tree"""
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(os.path.dirname(root), "cache"))
+    python = sys.executable
+    jobs = str(SETTINGS["Jobs"])
+    modes = [
+        ("find | wc -l", ["/bin/bash", "-c", "find {} -type f | wc -l".format(root)], False),
+        ("du -s", ["du", "-s", "-B", "1K", root], False),
+        ("find + du", ["/bin/bash", "-c", "find {0} -type f | wc -l; du -s -B 1K {0}".format(root)], False),
+        ("cf", [python, COUNT_FILES, root], False),
+        ("cf --jobs", [python, COUNT_FILES, "-j", jobs, root], False),
+        ("cf --cache", [python, COUNT_FILES, "--cache", root], True),
+        ("cf --refresh", [python, COUNT_FILES, "--refresh", root], False),
+        ("cf --depth", [python, COUNT_FILES, "-d", "2", "--top", "10", root], False),
+        ("cf --format ndjson", [python, COUNT_FILES, "-f", "ndjson", root], False),
+        ("cf --dupes", [python, COUNT_FILES, "--dupes", "-j", jobs, root], False),
+    ]
+    if OPTIONS_FLAGS["Strace"] and shutil.which("strace") is None:
+        print("strace not found, syscalls are not counted")
+        OPTIONS_FLAGS["Strace"] = False
+    print("\n{:-<20}{:-<11}{:-<23}{:-<46}".format("MODE", "WALL", "THROUGHPUT", "PEAK RSS"))
+    results = [run_mode(name, cmd, env, files, warmup) for name, cmd, warmup in modes]
+    print("{:-<100}".format("-"))
+    return results
+
+
+def check_args(args):
+    """Read option values into SETTINGS"""
+    for idx, item in enumerate(args):
+        if idx > 0 and args[idx - 1] in OPTIONS_VALUES:
+            key = OPTIONS_VALUES[args[idx - 1]]
+            try:
+                SETTINGS[key] = type(SETTINGS[key])(item)
+            except ValueError:
+                print("Error {} expects a {}".format(args[idx - 1], type(SETTINGS[key]).__name__))
+                sys.exit(1)
+            continue
+        if item == OPTIONS[12]:
+            OPTIONS_FLAGS["Strace"] = True
+        elif item == OPTIONS[13]:
+            OPTIONS_FLAGS["Keep"] = True
+        elif item not in OPTIONS_VALUES:
+            print("Unknown argument: {}".format(item))
+            sys.exit(1)
+    if SETTINGS["Distribution"] not in DISTRIBUTIONS:
+        print("Error --dist expects one of: {}".format(", ".join(DISTRIBUTIONS)))
+        sys.exit(1)
+
+
+def main():
+    """Main function"""
+    if any(help_option in sys.argv for help_option in OPTIONS[-3:]):
+        print("Usage: bench_count_files.py [OPTION]...")
+        print("Benchmark count_files against a synthetic directory tree")
+        print("Options:")
+        for option in OPTIONS_HELP_TEXT.values():
+            print(option)
+        sys.exit(0)
+    check_args(sys.argv[1:])
+    rss_floor = run_once(["true"], os.environ)[3]
+    print("Peak RSS of an empty command: {:,} KB".format(rss_floor))
+    workdir = tempfile.mkdtemp(prefix="bench_cf_")
+    root = os.path.join(workdir, "tree")
+    os.mkdir(root)
+    try:
+        started = time.perf_counter()
+        files, size = generate_tree(root)
+        print("Generated {:,} files ({:,} bytes) in {:.2f}s: {}".format(
+            files, size, time.perf_counter() - started, root))
+        results = benchmark(root, files)
+    finally:
+        if not OPTIONS_FLAGS["Keep"]:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {"label": SETTINGS["Label"], "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "tree": {key: SETTINGS[key] for key in ["Depth", "Fanout", "Files", "Size",
+                                                      "Distribution", "Dupes", "Seed"]},
+              "files": files, "bytes": size, "rss_floor_kb": rss_floor, "results": results}
+    with open(SETTINGS["Output"], "w") as _f:
+        json.dump(report, _f, indent=2)
+    print("Results written to {}".format(SETTINGS["Output"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Benchmark ppm_files_to_pam
+This script generates synthetic RGB/NIR ppm pairs at several resolutions and bit
+depths in a temporary directory and converts them with ppm_files_to_pam in its
+different modes. Wall time, MB/s, frames/s, cpu time and peak RSS are written as
+JSON, the generated pairs only depend on the settings so runs of different
+versions are comparable.
+Every mode runs under a small shim that forks and waits for it, so its peak
+RSS does not start from the high-water mark of this script. The peak RSS of
+an empty command run the same way is reported as rss_floor_kb, for scale."""
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess as sp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PPM_FILES_TO_PAM = os.path.join(SCRIPT_DIR, "ppm_files_to_pam.py")
+# Run argv[1:] with its output discarded and print wall, user, sys, peak RSS in KB and the exit code.
+# The child is forked from this small process: a child spawned by the benchmark itself would
+# inherit the peak RSS of the benchmark when it execs.
+RSS_SHIM = """
+import os, sys, time
+started = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    try:
+        null = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        os.dup2(null, 2)
+        os.execvp(sys.argv[1], sys.argv[1:])
+    finally:
+        os._exit(127)
+_, status, usage = os.wait4(pid, 0)
+print(time.perf_counter() - started, usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+      os.waitstatus_to_exitcode(status))
+"""
+
+SETTINGS = {"Resolutions": "640x480,1920x1080,4000x3000", "Depths": "8,16", "Pairs": 8, "Repeat": 3,
+            "Jobs": 4, "Output": "bench_ppm_to_pam.json", "Label": "", "Seed": 1}
+
+OPTIONS = ["--resolutions", "--depths", "--pairs", "--repeat", "--jobs", "-o", "--output", "--label", "--seed",
+           "--keep", "-h", "-H", "--help"]
+OPTIONS_VALUES = {"--resolutions": "Resolutions", "--depths": "Depths", "--pairs": "Pairs", "--repeat": "Repeat",
+                  "--jobs": "Jobs", "-o": "Output", "--output": "Output", "--label": "Label", "--seed": "Seed"}
+OPTIONS_FLAGS = {"Keep": False}
+OPTIONS_HELP_TEXT = {
+    "--resolutions": "{:>5} {:<16}\tComma separated WIDTHxHEIGHT list (default 640x480,1920x1080,4000x3000)".format(
+        "", OPTIONS[0] + " L"),
+    "--depths": "{:>5} {:<16}\tComma separated bit depths, 8 and/or 16 (default 8,16)".format("", OPTIONS[1] + " L"),
+    "--pairs": "{:>5} {:<16}\tPairs per resolution and depth (default 8)".format("", OPTIONS[2] + " N"),
+    "--repeat": "{:>5} {:<16}\tRuns per mode, the fastest is kept (default 3)".format("", OPTIONS[3] + " N"),
+    "--jobs": "{:>5} {:<16}\tJobs passed to the parallel mode (default 4)".format("", OPTIONS[4] + " N"),
+    "--output": "{:>5} {:<16}\tJSON file to write (default bench_ppm_to_pam.json)".format(
+        OPTIONS[5], OPTIONS[6] + " F"),
+    "--label": "{:>5} {:<16}\tVersion label stored with the results".format("", OPTIONS[7] + " L"),
+    "--seed": "{:>5} {:<16}\tSeed of the generated images (default 1)".format("", OPTIONS[8] + " N"),
+    "--keep": "{:>5} {:<16}\tKeep the generated pairs".format("", OPTIONS[9]),
+    "-h": "{:>5} {:<16}\tDisplay this help and exit".format(OPTIONS[-3] + " " + OPTIONS[-2], OPTIONS[-1])
+}
+
+
+def generate_pairs(folder, width, height, bits, pairs, seed):
+    """
+    Generate the synthetic pairs of one resolution and bit depth
+    Returns:
+    bytes written
+    """
+    rand = np.random.default_rng(seed)
+    max_value = 255 if bits == 8 else 65535
+    dtype = np.dtype(np.uint8) if bits == 8 else np.dtype(">u2")
+    header = b"P6\n%d %d\n%d\n" %(width, height, max_value)
+    # A smooth gradient plus noise, so the pixels are not all the same
+    gradient = np.linspace(0, max_value // 2, width, dtype=np.float64)[np.newaxis, :, np.newaxis]
+    size = 0
+    for idx in range(pairs):
+        for role in ("sheared", "nir"):
+            noise = rand.integers(0, max_value // 2, size=(height, width, 3), dtype=np.uint32)
+            image = (noise + gradient).astype(dtype)
+            path = os.path.join(folder, "frame_{:04d}_{}.ppm".format(idx, role))
+            with open(path, "wb") as _f:
+                _f.write(header)
+                _f.write(memoryview(np.ascontiguousarray(image)).cast("B"))
+            size += os.path.getsize(path)
+    return size
+
+
+def run_once(cmd, folder):
+    """
+    Run a command once on fresh outputs
+    Returns:
+    wall seconds, user seconds, system seconds, peak RSS in KB and the exit code
+    """
+    shutil.rmtree(os.path.join(folder, "nir_images"), ignore_errors=True)
+    shutil.rmtree(os.path.join(folder, "shards"), ignore_errors=True)
+    output = sp.run([sys.executable, "-S", "-c", RSS_SHIM] + cmd, cwd=folder, stdout=sp.PIPE, check=True).stdout
+    wall, user, system, rss, code = output.split()
+    return float(wall), float(user), float(system), int(rss), int(code)
+
+
+def run_mode(name, cmd, folder, size):
+    """Run a mode several times and keep the fastest run"""
+    runs = [run_once(cmd, folder) for _ in range(SETTINGS["Repeat"])]
+    wall, user, system, rss, code = min(runs)
+    frames = SETTINGS["Pairs"]
+    result = {"mode": name, "cmd": " ".join(cmd[1:]), "wall": round(wall, 6),
+              "mb_per_sec": round(size / 1e6 / wall, 2) if wall > 0 else None,
+              "frames_per_sec": round(frames / wall, 3) if wall > 0 else None,
+              "user": round(user, 6), "sys": round(system, 6), "peak_rss_kb": rss, "exit_code": code}
+    print("{:<20}{:>10.3f}s{:>12,.1f} MB/s{:>12,.2f} frames/s{:>12,} KB".format(
+        name, wall, result["mb_per_sec"] or 0, result["frames_per_sec"] or 0, rss))
+    return result
+
+
+def benchmark(folder, size):
+    """Run all ppm_files_to_pam modes against the pairs of a folder"""
+    python = sys.executable
+    jobs = str(SETTINGS["Jobs"])
+    modes = [
+        ("ppam", [python, PPM_FILES_TO_PAM, "-d", folder]),
+        ("ppam sequential", [python, PPM_FILES_TO_PAM, "-d", "--queue-depth", "0", folder]),
+        ("ppam --stream", [python, PPM_FILES_TO_PAM, "-d", "-s", folder]),
+        ("ppam --jobs", [python, PPM_FILES_TO_PAM, "-d", "-j", jobs, folder]),
+        ("ppam --shard", [python, PPM_FILES_TO_PAM, "-d", "--shard", os.path.join(folder, "shards"), folder]),
+    ]
+    return [run_mode(name, cmd, folder, size) for name, cmd in modes]
+
+
+def check_args(args):
+    """Read option values into SETTINGS"""
+    for idx, item in enumerate(args):
+        if idx > 0 and args[idx - 1] in OPTIONS_VALUES:
+            key = OPTIONS_VALUES[args[idx - 1]]
+            try:
+                SETTINGS[key] = type(SETTINGS[key])(item)
+            except ValueError:
+                print("Error {} expects a {}".format(args[idx - 1], type(SETTINGS[key]).__name__))
+                sys.exit(1)
+            continue
+        if item == OPTIONS[9]:
+            OPTIONS_FLAGS["Keep"] = True
+        elif item not in OPTIONS_VALUES:
+            print("Unknown argument: {}".format(item))
+            sys.exit(1)
+    try:
+        resolutions = [tuple(int(value) for value in resolution.lower().split("x"))
+                       for resolution in SETTINGS["Resolutions"].split(",")]
+        depths = [int(depth) for depth in SETTINGS["Depths"].split(",")]
+    except ValueError:
+        resolutions, depths = [], []
+    if not resolutions or any(len(resolution) != 2 or min(resolution) < 1 for resolution in resolutions):
+        print("Error --resolutions expects WIDTHxHEIGHT[,WIDTHxHEIGHT]...")
+        sys.exit(1)
+    if not depths or any(depth not in (8, 16) for depth in depths):
+        print("Error --depths expects 8 and/or 16")
+        sys.exit(1)
+    return resolutions, depths
+
+
+def main():
+    """Main function"""
+    if any(help_option in sys.argv for help_option in OPTIONS[-3:]):
+        print("Usage: bench_ppm_to_pam.py [OPTION]...")
+        print("Benchmark ppm_files_to_pam against synthetic RGB/NIR pairs")
+        print("Options:")
+        for option in OPTIONS_HELP_TEXT.values():
+            print(option)
+        sys.exit(0)
+    resolutions, depths = check_args(sys.argv[1:])
+    rss_floor = run_once(["true"], tempfile.gettempdir())[3]
+    print("Peak RSS of an empty command: {:,} KB".format(rss_floor))
+    workdir = tempfile.mkdtemp(prefix="bench_ppam_")
+    sets = []
+    try:
+        for width, height in resolutions:
+            for bits in depths:
+                folder = os.path.join(workdir, "{}x{}_{}bit".format(width, height, bits))
+                os.mkdir(folder)
+                started = time.perf_counter()
+                # Generated in another process, whose memory is gone before the modes are measured
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    size = pool.submit(generate_pairs, folder, width, height, bits,
+                                       SETTINGS["Pairs"], SETTINGS["Seed"]).result()
+                print("\nGenerated {} pairs of {}x{} {}-bit ({:,} bytes) in {:.2f}s: {}".format(
+                    SETTINGS["Pairs"], width, height, bits, size, time.perf_counter() - started, folder))
+                print("{:-<20}{:-<11}{:-<17}{:-<21}{:-<15}".format("MODE", "WALL", "INPUT", "FRAMES", "PEAK RSS"))
+                sets.append({"width": width, "height": height, "bits": bits, "pairs": SETTINGS["Pairs"],
+                             "bytes": size, "results": benchmark(folder, size)})
+                if not OPTIONS_FLAGS["Keep"]:
+                    shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        if not OPTIONS_FLAGS["Keep"]:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {"label": SETTINGS["Label"], "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+              "cpus": os.cpu_count(), "settings": dict(SETTINGS), "rss_floor_kb": rss_floor, "sets": sets}
+    with open(SETTINGS["Output"], "w") as _f:
+        json.dump(report, _f, indent=2)
+    print("\nResults written to {}".format(SETTINGS["Output"]))
+
+
+if __name__ == "__main__":
+    main()
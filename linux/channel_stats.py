@@ -0,0 +1,272 @@
+"""
+Channel statistics
+Per channel mean, standard deviation, min, max and histogram of RGBN frames,
+computed while the frames are converted, an index of the statistics of every
+frame of an output folder and a summary of the whole dataset, so normalization
+and QA never read the pixels again.
+Values are scaled to 0..1 by the max value of their frame, so 8 and 16 bit
+frames can be combined.
+"""
+import os
+import json
+import numpy as np
+
+CHANNEL_NAMES = ["R", "G", "B", "NIR"]
+HISTOGRAM_BINS = 256
+CHUNK_ROWS = 256
+INDEX_NAME = "ppam_stats.jsonl"
+SUMMARY_NAME = "ppam_stats_summary.json"
+SAVE_EVERY = 100
+DECODER = json.JSONDecoder()
+
+
+class ChannelStats(object):
+    """
+    Exact statistics of one frame from a full resolution histogram of every
+    channel, counted CHUNK_ROWS rows at a time. Used like a PamWriter:
+    write_rows takes RGBN rows, so it can follow a streamed conversion too.
+    """
+    def __init__(self, max_value, channels=len(CHANNEL_NAMES)):
+        self.max_value = max_value
+        self.counts = np.zeros((channels, max_value + 1), dtype=np.int64)
+
+    def write_rows(self, rows):
+        """Count the samples of rows of shape (rows, width, channels)"""
+        for start in range(0, rows.shape[0], CHUNK_ROWS):
+            chunk = rows[start:start + CHUNK_ROWS]
+            for channel, counts in enumerate(self.counts):
+                found = np.bincount(chunk[:, :, channel].ravel(), minlength=self.max_value + 1)
+                counts += found[:self.max_value + 1]
+                counts[-1] += found[self.max_value + 1:].sum()  # Samples above the max value are clipped
+
+    def close(self):
+        """Nothing to finish, the statistics are read with summary"""
+
+    def abort(self):
+        """Nothing to drop"""
+
+    def summary(self):
+        """
+        Statistics of the frame
+        Returns:
+        dict of max_value, count (pixels) and per channel lists of mean, std,
+        min, max and a histogram of HISTOGRAM_BINS bins over 0..1
+        """
+        values = np.arange(self.max_value + 1, dtype=np.float64) / self.max_value
+        count = int(self.counts[0].sum())
+        mean = self.counts @ values / max(count, 1)
+        m2 = (self.counts * (values - mean[:, np.newaxis]) ** 2).sum(axis=1)
+        present = self.counts > 0
+        minimum = np.argmax(present, axis=1) / self.max_value
+        maximum = (self.max_value - np.argmax(present[:, ::-1], axis=1)) / self.max_value
+        bins = np.arange(self.max_value + 1) * HISTOGRAM_BINS // (self.max_value + 1)
+        histogram = [np.rint(np.bincount(bins, weights=counts, minlength=HISTOGRAM_BINS)).astype(np.int64).tolist()
+                     for counts in self.counts]
+        return {"max_value": self.max_value, "count": count, "mean": mean.tolist(),
+                "std": np.sqrt(m2 / max(count, 1)).tolist(), "min": minimum.tolist(), "max": maximum.tolist(),
+                "histogram": histogram}
+
+
+def frame_stats(rgbn, max_value):
+    """Statistics of a whole frame of shape (height, width, 4), see ChannelStats.summary"""
+    stats = ChannelStats(max_value, rgbn.shape[2])
+    stats.write_rows(rgbn)
+    return stats.summary()
+
+
+class DatasetStats(object):
+    """
+    Totals of any number of frames. Count, mean and sum of squared deviations
+    are combined with the pairwise Welford update, so totals built separately,
+    e.g. in other processes, can be merged in any order.
+    """
+    def __init__(self, channels=len(CHANNEL_NAMES)):
+        self.frames = 0
+        self.count = 0
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+        self.minimum = np.full(channels, np.inf)
+        self.maximum = np.full(channels, -np.inf)
+        self.histogram = np.zeros((channels, HISTOGRAM_BINS), dtype=np.int64)
+
+    def add(self, stats):
+        """Add the statistics of a frame as returned by ChannelStats.summary"""
+        frame = DatasetStats(len(stats["mean"]))
+        frame.frames = 1
+        frame.count = stats["count"]
+        frame.mean = np.array(stats["mean"])
+        frame.m2 = np.array(stats["std"]) ** 2 * stats["count"]
+        frame.minimum = np.array(stats["min"], dtype=np.float64)
+        frame.maximum = np.array(stats["max"], dtype=np.float64)
+        frame.histogram = np.array(stats["histogram"], dtype=np.int64)
+        self.merge(frame)
+
+    def merge(self, other):
+        """Add the totals of other"""
+        self.frames += other.frames
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        self.histogram += other.histogram
+
+    def summary(self):
+        """Totals as a dict with the mean, std, min, max and histogram of every channel"""
+        std = np.sqrt(self.m2 / self.count) if self.count else self.m2
+        channels = {}
+        for idx, name in enumerate(CHANNEL_NAMES[:len(self.mean)]):
+            channels[name] = {"mean": float(self.mean[idx]), "std": float(std[idx]),
+                              "min": float(self.minimum[idx]) if self.count else None,
+                              "max": float(self.maximum[idx]) if self.count else None,
+                              "histogram": self.histogram[idx].tolist()}
+        return {"frames": self.frames, "pixels": self.count, "bins": HISTOGRAM_BINS, "channels": channels}
+
+
+def record_name(line):
+    """
+    Name of an index line and whether it removes the frame, only the start of
+    the line is decoded. Raises ValueError for a torn line.
+    """
+    if not line.startswith(b'{"name":') or not line.endswith(b"}\n"):
+        raise ValueError("torn line")
+    text = line.decode()
+    name, end = DECODER.raw_decode(text, 8)
+    return name, text.startswith(',"removed":true', end)
+
+
+class StatsIndex(object):
+    """
+    Statistics of every frame of an output folder, a log of JSON lines like
+    the conversion manifest: a header followed by one line per recorded or
+    removed frame, later lines winning. Only the names are kept in memory, the
+    statistics are read back from the file for the summary.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, INDEX_NAME)
+        self.summary_path = os.path.join(directory, SUMMARY_NAME)
+        self.names = set()
+        self.lines = []
+        self.logged = 0
+        self.in_memory = True
+        rewrite = False
+        try:
+            for _, line in self.records():
+                name, removed = record_name(line)
+                self.logged += 1
+                if removed:
+                    self.names.discard(name)
+                else:
+                    self.names.add(name)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as _e:
+            if str(_e) != "torn line":  # The torn last line of an interrupted run is just dropped
+                print("Ignoring unreadable statistics index %s: %s" %(self.path, _e))
+            rewrite = True
+        if rewrite or self.logged > 2 * len(self.names) + SAVE_EVERY:
+            self.compact()
+
+    def records(self):
+        """
+        Offset and line of every line of the index after its header
+        Raises ValueError for an unknown header
+        """
+        with open(self.path, "rb") as _f:
+            header = _f.readline()
+            if json.loads(header or b"{}").get("version") != 1:
+                raise ValueError("unknown version")
+            offset = len(header)
+            for line in _f:
+                yield offset, line
+                offset += len(line)
+
+    def live_lines(self):
+        """The last line of every frame still in the index, stopping at a torn line"""
+        offsets = {}
+        try:
+            for offset, line in self.records():
+                try:
+                    name, removed = record_name(line)
+                except ValueError:
+                    break
+                if removed:
+                    offsets.pop(name, None)
+                else:
+                    offsets[name] = offset
+        except (OSError, ValueError):
+            return
+        with open(self.path, "rb") as _f:
+            for offset in sorted(offsets.values()):
+                _f.seek(offset)
+                yield _f.readline()
+
+    def record(self, name, stats):
+        """Record the statistics of a converted frame"""
+        if self.in_memory:
+            self.names.add(name)
+        self.log({"name": name, "stats": stats})
+
+    def remove(self, name):
+        """Drop a frame whose output is gone"""
+        if name in self.names or not self.in_memory:
+            self.names.discard(name)
+            self.log({"name": name, "removed": True})
+
+    def forget(self):
+        """
+        Save the index and stop keeping the names in memory, later lines are
+        only appended. Used by the watch mode, like Manifest.forget.
+        """
+        self.save()
+        self.names = set()
+        self.in_memory = False
+
+    def log(self, record):
+        """Queue a line, saving every SAVE_EVERY lines"""
+        self.lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+        if len(self.lines) >= SAVE_EVERY:
+            self.save()
+
+    def save(self):
+        """Append the queued lines to the index"""
+        if not self.lines:
+            return
+        new = not os.path.isfile(self.path)
+        with open(self.path, "a") as _f:
+            if new:
+                _f.write(json.dumps({"version": 1, "channels": CHANNEL_NAMES, "bins": HISTOGRAM_BINS}) + "\n")
+            _f.writelines(self.lines)
+        self.logged += len(self.lines)
+        self.lines = []
+
+    def compact(self):
+        """Rewrite the index with one line per frame, through a temporary file renamed into place"""
+        self.save()
+        tmp_path = "%s.tmp-%d" %(self.path, os.getpid())
+        with open(tmp_path, "wb") as _f:
+            _f.write(json.dumps({"version": 1, "channels": CHANNEL_NAMES, "bins": HISTOGRAM_BINS}).encode() + b"\n")
+            _f.writelines(self.live_lines())
+        os.replace(tmp_path, self.path)
+        self.logged = len(self.names)
+
+    def write_summary(self):
+        """
+        Merge the statistics of all frames into the dataset summary file
+        Returns:
+        the DatasetStats totals
+        """
+        self.save()
+        totals = DatasetStats()
+        for line in self.live_lines():
+            totals.add(json.loads(line)["stats"])
+        tmp_path = "%s.tmp-%d" %(self.summary_path, os.getpid())
+        with open(tmp_path, "w") as _f:
+            json.dump(totals.summary(), _f, indent=2)
+        os.replace(tmp_path, self.summary_path)
+        return totals
@@ -0,0 +1,198 @@
+"""
+Conversion manifest
+Record the inputs and output of every converted pair in the output folder so a
+rerun only converts pairs whose inputs changed or whose output is missing.
+The manifest is a log of JSON lines, a header followed by one line per recorded
+or removed output, later lines winning. It is rewritten when opened once most
+of its lines are outdated.
+"""
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = ".ppam_manifest.jsonl"
+CHUNK_SIZE = 1024 * 1024
+SAVE_EVERY = 100
+
+
+def file_checksum(path, offset=0, size=None):
+    """blake2b hex digest of a file, or of size bytes from offset"""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as _f:
+        _f.seek(offset)
+        left = size
+        while left is None or left > 0:
+            chunk = _f.read(CHUNK_SIZE if left is None else min(CHUNK_SIZE, left))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if left is not None:
+                left -= len(chunk)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """
+    Entries keyed on the output name holding the path (relative to the
+    manifest), size and mtime of both inputs, optionally their content hash,
+    and the size, mtime and checksum of the output.
+    A pair is up to date when its output exists and its inputs kept their size
+    and mtime. With content_hash an input that was only touched is recognised
+    by its hash and not converted again.
+    """
+    def __init__(self, directory, output_exists, content_hash=False):
+        """
+        Parameters:
+        directory: output folder the manifest is stored in
+        output_exists: function(name, entry) telling whether a recorded output is still there
+        content_hash: also compare the content hash of the inputs
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.output_exists = output_exists
+        self.content_hash = content_hash
+        self.entries = {}
+        self.lines = []
+        self.logged = 0
+        self.in_memory = True
+        torn = False
+        try:
+            with open(self.path, "r") as _f:
+                if json.loads(_f.readline()).get("version") != 1:
+                    raise ValueError("unknown version")
+                for line in _f:
+                    self.logged += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        torn = True  # Last line of an interrupted run, rewritten below
+                        break
+                    if record.get("removed"):
+                        self.entries.pop(record["name"], None)
+                    else:
+                        self.entries[record["name"]] = record["entry"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, AttributeError) as _e:
+            print("Ignoring unreadable manifest %s: %s" %(self.path, _e))
+            self.entries = {}
+            self.logged = 0
+        if torn or self.logged > 2 * len(self.entries) + SAVE_EVERY:
+            self.compact()
+
+    def input_state(self, path):
+        """Size and mtime of an input, its path relative to the manifest"""
+        file_stat = os.stat(path)
+        return {"path": os.path.relpath(os.path.abspath(path), self.directory),
+                "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+
+    def stale(self, rgb, nir, name, force=False):
+        """
+        Check whether a pair has to be converted
+        force: treat the pair as changed
+        Returns:
+        None when the recorded output is up to date, otherwise the state of the
+        inputs to record once the pair is converted (empty if they can not be read)
+        """
+        try:
+            inputs = {"rgb": self.input_state(rgb), "nir": self.input_state(nir)}
+        except OSError:
+            return {}
+        entry = None if force else self.entries.get(name)
+        if entry is not None and not self.output_exists(name, entry):
+            entry = None
+        if entry is not None and all(entry[role].get(key) == value
+                                     for role in inputs for key, value in inputs[role].items()):
+            missing = [role for role in inputs if "hash" not in entry[role]] if self.content_hash else []
+            if missing:
+                # Recorded without --hash, hash the inputs now so a later touch is recognised
+                try:
+                    for role in missing:
+                        entry[role]["hash"] = file_checksum(os.path.join(self.directory, inputs[role]["path"]))
+                except OSError:
+                    return {}
+                self.log(name, entry)
+            return None
+        if not self.content_hash:
+            return inputs
+        try:
+            for role, state in inputs.items():
+                old = entry[role] if entry is not None else {}
+                if "hash" in old and all(old[key] == state[key] for key in state):
+                    state["hash"] = old["hash"]
+                else:
+                    state["hash"] = file_checksum(os.path.join(self.directory, state["path"]))
+        except OSError:
+            return {}
+        if entry is not None and all(entry[role].get("hash") == inputs[role]["hash"] and
+                                     entry[role]["path"] == inputs[role]["path"] for role in inputs):
+            entry.update(inputs)  # Touched but unchanged
+            self.log(name, entry)
+            return None
+        return inputs
+
+    def record(self, name, inputs, output_bytes, checksum, output_mtime_ns=None):
+        """Record a converted pair"""
+        if not inputs:
+            return
+        entry = dict(inputs, bytes=output_bytes, checksum=checksum, output_mtime_ns=output_mtime_ns)
+        if self.in_memory:
+            self.entries[name] = entry
+        self.log(name, entry)
+
+    def prune(self):
+        """
+        Drop the entries whose inputs are gone
+        Returns:
+        names of the dropped outputs
+        """
+        removed = []
+        for name, entry in list(self.entries.items()):
+            if all(os.path.exists(os.path.join(self.directory, entry[role]["path"])) for role in ("rgb", "nir")):
+                continue
+            del self.entries[name]
+            removed.append(name)
+            self.log(name, None)
+        return removed
+
+    def log(self, name, entry):
+        """Queue a recorded (or removed, when entry is None) output, saving every SAVE_EVERY lines"""
+        record = {"name": name, "removed": True} if entry is None else {"name": name, "entry": entry}
+        self.lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+        if len(self.lines) >= SAVE_EVERY:
+            self.save()
+
+    def save(self):
+        """Append the queued lines to the manifest"""
+        if not self.lines:
+            return
+        if self.logged == 0 and self.in_memory:
+            self.compact()
+            return
+        with open(self.path, "a") as _f:
+            _f.writelines(self.lines)
+        self.logged += len(self.lines)
+        self.lines = []
+
+    def compact(self):
+        """Rewrite the manifest with one line per entry, through a temporary file renamed into place"""
+        if not self.in_memory:
+            self.save()
+            return
+        tmp_path = "%s.tmp-%d" %(self.path, os.getpid())
+        with open(tmp_path, "w") as _f:
+            _f.write(json.dumps({"version": 1}) + "\n")
+            for name, entry in self.entries.items():
+                _f.write(json.dumps({"name": name, "entry": entry}, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, self.path)
+        self.logged = len(self.entries)
+        self.lines = []
+
+    def forget(self):
+        """
+        Save the manifest and stop keeping its entries in memory, later records
+        are only appended. Used by the watch mode, whose pairs are always new.
+        """
+        self.compact()
+        self.entries = {}
+        self.in_memory = False
@@ -1,69 +1,392 @@
 """Count files
 This script counts files in directories and outputs their disk usage and # files.
 Various flags can be set to change the output of the script."""
-import subprocess as sp
 import sys
 import os
+import stat
 import datetime
+import threading
+import sqlite3
+import time
+import json
+import csv
+import queue
+import heapq
+from collections import deque
+from scan_cache import ScanCache, DEFAULT_CACHE_FILE
+from dupe_finder import DupeFinder
 
 TOTAL_FILES = 0
-TOTAL_GB = 0
-TOTAL_MB = 0
+TOTAL_BYTES = 0
+
+JOBS = 1
+DEPTH = 0
+TOP = 10
+FORMAT = "table"
+FORMATS = ["table", "ndjson", "csv"]
+RECORD_FIELDS = ["type", "path", "files", "bytes", "seconds", "error"]
+CSV_WRITER = None
 
 DIRECTORIES = []
 FILES = []
+BREAKDOWNS = []
+DUPE_FINDER = None
 
-OPTIONS = ["-t", "-T", "--triple", "-i", "--ignore", "-h", "-H", "--help"]
-OPTIONS_FLAGS = {"Triplets": False, "Ignore": False}
+OPTIONS = ["-t", "-T", "--triple", "-i", "--ignore", "-j", "--jobs", "--cache", "--refresh",
+           "-f", "--format", "-d", "--depth", "--top", "--dupes", "-h", "-H", "--help"]
+OPTIONS_FLAGS = {"Triplets": False, "Ignore": False, "Cache": False, "Refresh": False, "Dupes": False}
 OPTIONS_HELP_TEXT = {
     "-t": "{:>5}{:>3} {:<10}\tPrint triplets (files/3)".format(OPTIONS[0], OPTIONS[1], OPTIONS[2]),
     "-i": "{:>5}{:>3} {:<10}\tIgnore non-directories if present in args".format(OPTIONS[3], "", OPTIONS[4]),
+    "-j": "{:>5}{:>3} {:<10}\tWalk directories on N threads (default 1, not with --depth or --dupes)".format(
+        OPTIONS[5], "", OPTIONS[6] + " N"),
+    "--cache": "{:>5}{:>3} {:<10}\tAnswer unchanged directories from the scan cache, files modified in\n"
+               "\t\t\tplace keep their cached size until --refresh".format("", "", OPTIONS[7]),
+    "--refresh": "{:>5}{:>3} {:<10}\tRescan every directory and rewrite the scan cache".format("", "", OPTIONS[8]),
+    "-f": "{:>5}{:>3} {:<10}\tOutput table (default), ndjson or csv records as each path finishes".format(
+        OPTIONS[9], "", OPTIONS[10] + " F"),
+    "-d": "{:>5}{:>3} {:<10}\tBreak directories down to depth N in the same walk".format(
+        OPTIONS[11], "", OPTIONS[12] + " N"),
+    "--top": "{:>5}{:>3} {:<10}\tNumber of largest directories reported by --depth (default 10)".format(
+        "", "", OPTIONS[13] + " K"),
+    "--dupes": "{:>5}{:>3} {:<10}\tReport bytes reclaimable from duplicate files per directory".format(
+        "", "", OPTIONS[14]),
     "-h": "{:>5}{:>3} {:<10}\tDisplay this help and exit".format(OPTIONS[-3], OPTIONS[-2], OPTIONS[-1])
 }
 
 
-def count_files(directory):
+def scan_directory(directory, cache=None, on_file=None):
+    """
+    Scan the direct entries of a single directory
+    Raises OSError if the directory itself can not be read
+    Parameters:
+    directory: Path to directory to scan
+    cache: ScanCache to answer unchanged directories from, if any
+    on_file: called with the path and lstat result of every regular file, if any
+    Returns:
+    files: number of regular files directly in the directory
+    size: allocated size in bytes of the entries with a single link
+    links: (inode, size) of entries with several hardlinks, sized once by the caller
+    subdirs: paths of the subdirectories to descend into
+    """
+    files = 0
+    size = 0
+    links = []
+    subdirs = []
+    if cache is not None:
+        dir_stat = os.stat(directory)
+        cached = cache.get(dir_stat)
+        if cached is not None:
+            files, size, links, names = cached
+            return files, size, links, [os.path.join(directory, name) for name in names]
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                entry_stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(entry_stat.st_mode):
+                subdirs.append(entry.path)
+                size += entry_stat.st_blocks * 512
+                continue
+            if stat.S_ISREG(entry_stat.st_mode):
+                files += 1
+                if on_file is not None:
+                    on_file(entry.path, entry_stat)
+            if entry_stat.st_nlink > 1:
+                links.append((entry_stat.st_ino, entry_stat.st_blocks * 512))
+            else:
+                size += entry_stat.st_blocks * 512
+    if cache is not None:
+        cache.put(dir_stat, files, size, links, [os.path.basename(sub_dir) for sub_dir in subdirs])
+    return files, size, links, subdirs
+
+
+def add_links(seen_links, links):
+    """Return the size of hardlinked entries whose inode has not been seen yet"""
+    size = 0
+    for inode, link_size in links:
+        if inode not in seen_links:
+            seen_links.add(inode)
+            size += link_size
+    return size
+
+
+def scan_path(path, cache=None, on_file=None):
     """
-    Count files in a given directory
+    Walk a path once and collect its file count and allocated size
+    Ignores directories/files with insufficient permissions
+    Parameters:
+    path: Path to directory or file to scan
+    cache: ScanCache to answer unchanged directories from, if any
+    on_file: called with the path and lstat result of every regular file, if any
+    Returns:
+    files: number of regular files below path (like find -type f)
+    size: allocated size in bytes from st_blocks (like du -s), hardlinks counted once
+    """
+    files = 0
+    size = 0
+    seen_links = set()
+    try:
+        root = os.stat(path)
+    except OSError:
+        return 0, 0
+    size += root.st_blocks * 512
+    if not stat.S_ISDIR(root.st_mode):
+        if not stat.S_ISREG(root.st_mode):
+            return 0, size
+        if on_file is not None:
+            on_file(path, root)
+        return 1, size
+    stack = [path]
+    while stack:
+        try:
+            dir_files, dir_size, links, subdirs = scan_directory(stack.pop(), cache, on_file)
+        except OSError:
+            continue
+        files += dir_files
+        size += dir_size + add_links(seen_links, links)
+        stack.extend(subdirs)
+    return files, size
+
+
+def scan_breakdown(path, depth, top, cache=None, on_file=None):
+    """
+    Walk a path once and aggregate every directory down to a given depth
+    Directories are dropped as soon as their subtree is done, only the largest
+    are kept on a bounded heap so memory does not grow with the tree
+    Parameters:
+    path: Path to directory to scan
+    depth: deepest level below path to aggregate, path itself is level 0
+    top: number of largest directories to keep
+    cache: ScanCache to answer unchanged directories from, if any
+    on_file: called with the path and lstat result of every regular file, if any
+    Returns:
+    files, size: totals of path like scan_path
+    largest: (size, files, path, seconds) of the largest directories, largest first
+    """
+    seen_links = set()
+    largest = []
+    try:
+        root = os.stat(path)
+    except OSError:
+        return 0, 0, largest
+    if not stat.S_ISDIR(root.st_mode):
+        return (1 if stat.S_ISREG(root.st_mode) else 0), root.st_blocks * 512, largest
+    chain = [[path, 0, root.st_blocks * 512, time.monotonic()]]  # path, files, size, started
+    stack = [(path, 0)]
+    while stack:
+        directory, level = stack.pop()
+        if directory is None:  # Subtree of the innermost aggregated directory is done
+            name, files, size, started = chain.pop()
+            chain[-1][1] += files
+            chain[-1][2] += size
+            item = (size, files, name, time.monotonic() - started)
+            if len(largest) < top:
+                heapq.heappush(largest, item)
+            elif item > largest[0]:
+                heapq.heapreplace(largest, item)
+            continue
+        if 0 < level <= depth:
+            # The parent sized this directory's own blocks, credit them to it instead
+            try:
+                own_size = os.lstat(directory).st_blocks * 512
+            except OSError:
+                own_size = 0
+            chain[-1][2] -= own_size
+            chain.append([directory, 0, own_size, time.monotonic()])
+            stack.append((None, level))
+        try:
+            files, size, links, subdirs = scan_directory(directory, cache, on_file)
+        except OSError:
+            continue
+        chain[-1][1] += files
+        chain[-1][2] += size + add_links(seen_links, links)
+        stack.extend((sub_dir, level + 1) for sub_dir in subdirs)
+    return chain[0][1], chain[0][2], sorted(largest, reverse=True)
+
+
+class TreeWalk(object):
+    """
+    Running totals of one root path walked by a ParallelScanner
+    """
+    def __init__(self, path, finished=None):
+        self.path = path
+        self.files = 0
+        self.size = 0
+        self.pending = 0
+        self.seen_links = set()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.finished = finished
+        self.started = time.monotonic()
+        self.seconds = 0.0
+
+    def finish(self):
+        """Mark the walk as done and report it on the finished queue"""
+        self.seconds = time.monotonic() - self.started
+        self.done.set()
+        if self.finished is not None:
+            self.finished.put(self)
+
+    def add(self, files, size, links):
+        """Add the result of one scanned directory"""
+        with self.lock:
+            self.files += files
+            self.size += size + add_links(self.seen_links, links)
+
+    def result(self):
+        """Wait for the walk to finish and return files and size"""
+        self.done.wait()
+        return self.files, self.size
+
+
+class ParallelScanner(object):
+    """
+    Walk several roots at once on a pool of threads.
+    Every directory is a task, workers take from the newest end of their own
+    deque and steal from the oldest end of the others, so large subtrees are
+    split across the pool.
+    """
+    def __init__(self, jobs, cache=None):
+        self.jobs = jobs
+        self.cache = cache
+        self.queues = [deque() for _ in range(jobs)]
+        self.cond = threading.Condition()
+        self.idle = 0
+        self.closed = False
+        self.next_queue = 0
+        self.finished = queue.Queue()
+        self.threads = [threading.Thread(target=self.worker, args=(idx,), daemon=True)
+                        for idx in range(jobs)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, path):
+        """Start walking a path and return its TreeWalk"""
+        walk = TreeWalk(path, self.finished)
+        try:
+            root = os.stat(path)
+        except OSError:
+            walk.finish()
+            return walk
+        walk.size = root.st_blocks * 512
+        if not stat.S_ISDIR(root.st_mode):
+            walk.files = 1 if stat.S_ISREG(root.st_mode) else 0
+            walk.finish()
+            return walk
+        walk.pending = 1
+        self.queues[self.next_queue].append((walk, path))
+        self.next_queue = (self.next_queue + 1) % self.jobs
+        with self.cond:
+            self.cond.notify_all()
+        return walk
+
+    def close(self):
+        """Stop the worker threads"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def next_task(self, idx):
+        """Pop a task from the own queue, steal one, or wait for work"""
+        own = self.queues[idx]
+        while True:
+            try:
+                return own.pop()
+            except IndexError:
+                pass
+            for offset in range(1, self.jobs):
+                try:
+                    return self.queues[(idx + offset) % self.jobs].popleft()
+                except IndexError:
+                    continue
+            with self.cond:
+                if self.closed:
+                    return None
+                self.idle += 1
+                self.cond.wait(0.05)
+                self.idle -= 1
+
+    def worker(self, idx):
+        """Scan directories until the scanner is closed"""
+        own = self.queues[idx]
+        while True:
+            task = self.next_task(idx)
+            if task is None:
+                return
+            walk, directory = task
+            try:
+                files, size, links, subdirs = scan_directory(directory, self.cache)
+            except OSError:
+                files, size, links, subdirs = 0, 0, [], []
+            if subdirs:
+                with walk.lock:
+                    walk.pending += len(subdirs)
+                own.extend((walk, sub_dir) for sub_dir in subdirs)
+                if self.idle:
+                    with self.cond:
+                        self.cond.notify_all()
+            walk.add(files, size, links)
+            with walk.lock:
+                walk.pending -= 1
+                if walk.pending == 0:
+                    walk.finish()
+
+
+def count_files(directory, walk=None, cache=None):
+    """
+    Count files in a given directory and get its size in a single walk
     Ignores directories/files with insufficient permissions
     Parameters:
     directory: The wanted directory to count files in.
+    walk: TreeWalk already started by a ParallelScanner, if any
+    cache: ScanCache to answer unchanged directories from, if any
+    Returns:
+    files, size in bytes and the seconds the scan took
     """
-    global TOTAL_FILES
-    cmd = "find {} -type f 2>/dev/null | wc -l".format(directory)
-    ret_val = sp.run(["/bin/bash", "-c", cmd], capture_output=True, check=False)
-    if ret_val.returncode == 0:
-        output = ret_val.stdout.decode("utf-8").split("\n")[0]
-        TOTAL_FILES += int(output)
-        return int(output)
-    return None
+    global TOTAL_FILES, TOTAL_BYTES
+    on_file = DUPE_FINDER.add if DUPE_FINDER is not None else None
+    if walk is not None:
+        files, size = walk.result()
+        seconds = walk.seconds
+    elif DEPTH > 0:
+        started = time.monotonic()
+        files, size, largest = scan_breakdown(directory, DEPTH, TOP, cache, on_file)
+        seconds = time.monotonic() - started
+        BREAKDOWNS.append((directory, largest))
+    else:
+        started = time.monotonic()
+        files, size = scan_path(directory, cache, on_file)
+        seconds = time.monotonic() - started
+    TOTAL_FILES += files
+    TOTAL_BYTES += size
+    return files, size, seconds
 
 
 def get_size(path):
     """
-    Get the size of the given path
+    Get the size of the given path in bytes
     Ignores directories/files with insufficient permissions
     Parameters:
     path: Path to directory or file to get size of
     """
-    cmd = "du -s -B 1K {} 2>/dev/null".format(path)  # Retrieves size in 1024(bytes) units
-    ret_val = sp.run(["/bin/bash", "-c", cmd], capture_output=True, check=False)
-    output = ret_val.stdout.decode("utf-8").split("\t")[0]
-    return compute_str_to_bytes(output)
+    global TOTAL_BYTES
+    _, size = scan_path(path, on_file=DUPE_FINDER.add if DUPE_FINDER is not None else None)
+    TOTAL_BYTES += size
+    return size
 
 
-def compute_str_to_bytes(string):
+def format_size(size):
     """
-    Given a string consisting of integers compute the MB and GB equivalent
+    Format a size in bytes as MB, and GB when large enough
     Parameters:
-    string: string to read and compute into MB & GB
-    """
-    global TOTAL_GB, TOTAL_MB
-    value = int(string)
-    value_mb = (value * 2 ** -10)  # KB TO MB
-    value_gb = (value * 2 ** -20)  # KB TO GB
-    TOTAL_MB += value_mb
-    TOTAL_GB += value_gb
+    size: size in bytes
+    """
+    value_mb = size / 2 ** 20
+    value_gb = size / 2 ** 30
     mb_size = "{:,.2f}mb".format(value_mb)
     if value_gb < 0.01:
         return mb_size
@@ -71,29 +394,111 @@ def compute_str_to_bytes(string):
     return "{:<12} / {:^12}".format(mb_size, gb_size)
 
 
+def emit_record(kind, path, files, size, seconds, error=""):
+    """
+    Write a single ndjson or csv record and flush it right away
+    Parameters:
+    kind: directory, file or total
+    path: path the record is about
+    files: number of files
+    size: exact size in bytes
+    seconds: wall time spent scanning
+    error: reason the path could not be scanned, if any
+    """
+    global CSV_WRITER
+    record = {"type": kind, "path": path, "files": files, "bytes": size,
+              "seconds": round(seconds, 6), "error": error}
+    if FORMAT == "ndjson":
+        sys.stdout.write(json.dumps(record) + "\n")
+    else:
+        if CSV_WRITER is None:
+            CSV_WRITER = csv.DictWriter(sys.stdout, fieldnames=RECORD_FIELDS, lineterminator="\n")
+            CSV_WRITER.writeheader()
+        CSV_WRITER.writerow(record)
+    sys.stdout.flush()
+
+
+def open_cache():
+    """Open the scan cache if enabled, continue without it if it can not be opened"""
+    if not (OPTIONS_FLAGS["Cache"] or OPTIONS_FLAGS["Refresh"]):
+        return None
+    if DUPE_FINDER is not None:  # Cached directories do not list their files
+        return None
+    try:
+        return ScanCache(refresh=OPTIONS_FLAGS["Refresh"])
+    except (OSError, sqlite3.Error) as _e:
+        print("Scan cache unavailable, continuing without it: {}".format(_e), file=sys.stderr)
+        return None
+
+
 def check_read_permission(directory):
     """Check if there is permission to read the given directory"""
     return os.access(directory, os.R_OK)
 
 
+def print_directory(sub_dir, files, size):
+    """Print a single directory row of the summary table"""
+    if OPTIONS_FLAGS["Triplets"]:
+        print("{:<40}{:<15,}{:<15,.2f}{:<}".format(sub_dir, files, (files / 3), format_size(size)))
+    else:
+        print("{:<40}{:<15,}{:<}".format(sub_dir, files, format_size(size)))
+
+
 def summarize_directory():
     """Summarize directories in terms of files and disk usage"""
-    if OPTIONS_FLAGS["Triplets"]:
-        print("\n{:-<40}{:-<15}{:-<15}{:-<30}".format("DIRECTORY", "FILES", "TRIPLES", "SIZE(MB/GB)"))
+    if FORMAT == "table":
+        if OPTIONS_FLAGS["Triplets"]:
+            print("\n{:-<40}{:-<15}{:-<15}{:-<30}".format("DIRECTORY", "FILES", "TRIPLES", "SIZE(MB/GB)"))
+        else:
+            print("\n{:-<40}{:-<15}{:-<45}".format("DIRECTORY", "FILES", "SIZE"))
+    cache = open_cache()
+    scanner = None
+    walks = {}
+    if JOBS > 1 and DEPTH == 0 and DUPE_FINDER is None:
+        scanner = ParallelScanner(JOBS, cache)
+        for sub_dir in DIRECTORIES:
+            if check_read_permission(sub_dir):
+                walks[sub_dir] = scanner.submit(sub_dir)
+    if scanner is not None and FORMAT != "table":
+        # Records carry their path, so emit them in the order the walks finish
+        for sub_dir in DIRECTORIES:
+            if sub_dir not in walks:
+                emit_record("directory", sub_dir, 0, 0, 0.0, "Permission denied")
+        for _ in range(len(walks)):
+            walk = scanner.finished.get()
+            files, size, seconds = count_files(walk.path, walk)
+            emit_record("directory", walk.path, files, size, seconds)
     else:
-        print("\n{:-<40}{:-<15}{:-<45}".format("DIRECTORY", "FILES", "SIZE"))
-    for sub_dir in DIRECTORIES:
-        permission = check_read_permission(sub_dir)
-        if permission:
-            files = count_files(sub_dir)
-            dir_size = get_size(sub_dir)
-            if OPTIONS_FLAGS["Triplets"]:
-                print("{:<40}{:<15,}{:<15,.2f}{:<}".format(sub_dir, files, (files / 3), dir_size))
+        for sub_dir in DIRECTORIES:
+            permission = check_read_permission(sub_dir)
+            if permission:
+                files, size, seconds = count_files(sub_dir, walks.get(sub_dir), cache)
+                if FORMAT == "table":
+                    print_directory(sub_dir, files, size)
+                else:
+                    emit_record("directory", sub_dir, files, size, seconds)
+                    for top_size, top_files, top_dir, top_seconds in (BREAKDOWNS[-1][1] if DEPTH > 0 else []):
+                        emit_record("subdir", top_dir, top_files, top_size, top_seconds)
+            elif FORMAT == "table":
+                print("{} Permission denied".format(sub_dir))
             else:
-                print("{:<40}{:<15,}{:<}".format(sub_dir, files, dir_size))
-        else:
-            print("{} Permission denied".format(sub_dir))
-    print("{:-<100}".format("-"))
+                emit_record("directory", sub_dir, 0, 0, 0.0, "Permission denied")
+    if scanner is not None:
+        scanner.close()
+    if cache is not None:
+        cache.close()
+    if FORMAT == "table":
+        print("{:-<100}".format("-"))
+
+
+def summarize_breakdown():
+    """Print the largest directories found by --depth for every directory"""
+    for sub_dir, largest in BREAKDOWNS:
+        title = "TOP {} IN {} (DEPTH {})".format(len(largest), sub_dir, DEPTH)
+        print("\n{:-<40}{:-<15}{:-<45}".format(title + " ", "FILES", "SIZE"))
+        for size, files, top_dir, _ in largest:
+            print("{:<40}{:<15,}{:<}".format(top_dir, files, format_size(size)))
+        print("{:-<100}".format("-"))
 
 
 def summarize_files():
@@ -103,30 +508,53 @@ def summarize_files():
         return
     if len(FILES) <= 0:
         return
-    print("\n{:-<40}{:-<60}".format("FILE", "SIZE"))
+    if FORMAT == "table":
+        print("\n{:-<40}{:-<60}".format("FILE", "SIZE"))
     TOTAL_FILES += len(FILES)
     for file in FILES:
+        started = time.monotonic()
         size = get_size(file)
-        print("{:<40}{:<15}".format(file, size))
+        if FORMAT == "table":
+            print("{:<40}{:<15}".format(file, format_size(size)))
+        else:
+            emit_record("file", file, 1, size, time.monotonic() - started)
+    if FORMAT == "table":
+        print("{:-<100}".format("-"))
+
+
+def summarize_dupes():
+    """Hash the collected files and summarize the reclaimable bytes per directory"""
+    started = time.monotonic()
+    groups = DUPE_FINDER.find()
+    seconds = time.monotonic() - started
+    per_dir = DupeFinder.reclaimable(groups)
+    if FORMAT != "table":
+        for directory in sorted(per_dir):
+            copies, size = per_dir[directory]
+            emit_record("dupes", directory, copies, size, seconds)
+        return
+    print("\n{:-<40}{:-<15}{:-<45}".format("DUPLICATES IN DIRECTORY", "COPIES", "RECLAIMABLE"))
+    for directory, (copies, size) in sorted(per_dir.items(), key=lambda item: item[1][1], reverse=True):
+        print("{:<40}{:<15,}{:<}".format(directory, copies, format_size(size)))
+    print("{:-<100}".format("-"))
+    reclaimable = sum(size for _, size in per_dir.values())
+    hashed = DUPE_FINDER.hashed_bytes / DUPE_FINDER.total_bytes * 100 if DUPE_FINDER.total_bytes else 0
+    print("{:<10}\t{} in {:,} groups".format("Reclaim:", format_size(reclaimable), len(groups)))
+    print("{:<10}\t{:.2f}% of {} in {:.2f}s".format("Hashed:", hashed, format_size(DUPE_FINDER.total_bytes),
+                                                    seconds))
     print("{:-<100}".format("-"))
 
 
 def print_result(triplets):
     """Print total summary when multiple paths are given as parameters to the script"""
     print("\n{:-^100}".format("TOTAL SUMMARY"))
+    print("{:<10}\t{:<,}".format("Files:", TOTAL_FILES))
     if triplets:
-        print("{:<10}\t{:<,}".format("Files:", TOTAL_FILES))
         print("{:<10}\t{:<,.2f}".format("Triples:", TOTAL_FILES / 3))
-        if TOTAL_GB >= 1:
-            print("{:<10}\t{:<,.2f}GB".format("Size:", TOTAL_GB))
-        else:
-            print("{:<10}\t{:<,.2f}MB".format("Size:", TOTAL_MB))
+    if TOTAL_BYTES >= 2 ** 30:
+        print("{:<10}\t{:<,.2f}GB".format("Size:", TOTAL_BYTES / 2 ** 30))
     else:
-        print("{:<10}\t{:<,}".format("Files:", TOTAL_FILES))
-        if TOTAL_GB >= 1:
-            print("{:<10}\t{:<,.2f}GB".format("Size:", TOTAL_GB))
-        else:
-            print("{:<10}\t{:<,.2f}MB".format("Size:", TOTAL_MB))
+        print("{:<10}\t{:<,.2f}MB".format("Size:", TOTAL_BYTES / 2 ** 20))
     print("{:-<100}\n".format("-"))
 
 
@@ -140,7 +568,29 @@ def validate_path(path):
 
 def check_args(args):
     """Separate args from paths"""
-    for item in args:
+    global JOBS, FORMAT, DEPTH, TOP
+    for idx, item in enumerate(args):
+        if idx > 0 and args[idx - 1] in OPTIONS[5:7]:
+            if not item.isdigit() or int(item) < 1:
+                print("Error {} expects a positive number of jobs".format(args[idx - 1]))
+                sys.exit(1)
+            JOBS = int(item)
+            continue
+        if idx > 0 and args[idx - 1] in OPTIONS[9:11]:
+            if item not in FORMATS:
+                print("Error {} expects one of: {}".format(args[idx - 1], ", ".join(FORMATS)))
+                sys.exit(1)
+            FORMAT = item
+            continue
+        if idx > 0 and args[idx - 1] in OPTIONS[11:14]:
+            if not item.isdigit() or int(item) < 1:
+                print("Error {} expects a positive number".format(args[idx - 1]))
+                sys.exit(1)
+            if args[idx - 1] == OPTIONS[13]:
+                TOP = int(item)
+            else:
+                DEPTH = int(item)
+            continue
         if item in OPTIONS:
             if not OPTIONS_FLAGS["Triplets"]:
                 if item in OPTIONS[:3]:
@@ -148,8 +598,17 @@ def check_args(args):
             if not OPTIONS_FLAGS["Ignore"]:
                 if item in OPTIONS[3:5]:
                     OPTIONS_FLAGS["Ignore"] = True
+            if item == OPTIONS[7]:
+                OPTIONS_FLAGS["Cache"] = True
+            if item == OPTIONS[8]:
+                OPTIONS_FLAGS["Refresh"] = True
+            if item == OPTIONS[14]:
+                OPTIONS_FLAGS["Dupes"] = True
         else:
             DIRECTORIES.append(item)
+    if JOBS > 1 and (DEPTH or OPTIONS_FLAGS["Dupes"]):
+        print("{} is ignored with {}, the directories are walked on one thread".format(
+            OPTIONS[5], OPTIONS[12] if DEPTH else OPTIONS[14]), file=sys.stderr)
     for sub_dir in DIRECTORIES:
         validate_path(sub_dir)
     for file in FILES:
@@ -167,19 +626,31 @@ def main():
             print("Usage: cf [OPTION]... [PATH]... ")
             print("Counts files")
             print("*NOTE* ignores directories/files with insufficient permissions!")
+            print("*NOTE* the scan cache of --cache and --refresh is kept in {}".format(DEFAULT_CACHE_FILE))
             print("Options:")
             for option in OPTIONS_HELP_TEXT.values():
                 print(option)
             sys.exit(0)
-        print("------------------")
-        print("COUNT FILES SCRIPT")
-        print("------------------")
-        print("DATE: {}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        print("-------------------------")
         check_args(sys.argv[1:])
+        if OPTIONS_FLAGS["Dupes"]:
+            global DUPE_FINDER
+            DUPE_FINDER = DupeFinder(JOBS)
+        if FORMAT == "table":
+            print("------------------")
+            print("COUNT FILES SCRIPT")
+            print("------------------")
+            print("DATE: {}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            print("-------------------------")
+        started = time.monotonic()
         summarize_directory()
+        if FORMAT == "table":
+            summarize_breakdown()
         summarize_files()
-        if len(DIRECTORIES) > 1:
+        if DUPE_FINDER is not None:
+            summarize_dupes()
+        if FORMAT != "table":
+            emit_record("total", "", TOTAL_FILES, TOTAL_BYTES, time.monotonic() - started)
+        elif len(DIRECTORIES) > 1:
             print_result(OPTIONS_FLAGS["Triplets"])
 
 
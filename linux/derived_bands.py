@@ -0,0 +1,163 @@
+"""
+Derived bands
+Compute normalized difference bands such as NDVI, (a - b) / (a + b) over two
+of the R, G, B and NIR channels, from a merged RGBN frame while it is still
+in memory, and write each band as a sidecar file next to the frame:
+float16 bands as .npy files (np.load(path, mmap_mode="r") maps them),
+uint8 bands as .pgm files, with -1..1 scaled to 0..255, so they do not mix
+with the RGBN .pam frames.
+"""
+import os
+import numpy as np
+from ppm_to_pam import PgmWriter
+
+CHANNELS = {"R": 0, "G": 1, "B": 2, "N": 3, "NIR": 3}
+BUILTIN_BANDS = {"ndvi": ("NIR", "R"), "gndvi": ("NIR", "G"), "ndwi": ("G", "NIR")}
+BAND_FORMATS = ["float16", "uint8"]
+CHUNK_ROWS = 256
+
+
+class BandError(Exception):
+    """Raised for a band specification that can not be parsed"""
+
+
+def parse_band(spec):
+    """
+    Parse a band given as a builtin name (ndvi, gndvi, ndwi) or as NAME=A-B,
+    which computes (A - B) / (A + B) over the channels A and B (R, G, B, NIR)
+    Returns:
+    (name, index of A, index of B)
+    """
+    if spec.lower() in BUILTIN_BANDS:
+        first, second = BUILTIN_BANDS[spec.lower()]
+        return spec.lower(), CHANNELS[first], CHANNELS[second]
+    name, _, expression = spec.partition("=")
+    first, _, second = expression.upper().replace(" ", "").partition("-")
+    if not name or not name.replace("_", "").isalnum() or first not in CHANNELS or second not in CHANNELS:
+        raise BandError("Bad band %r, expected one of %s or NAME=A-B with A and B in R, G, B, NIR"
+                        %(spec, ", ".join(BUILTIN_BANDS)))
+    return name, CHANNELS[first], CHANNELS[second]
+
+
+def normalized_difference(rows, first, second):
+    """(A - B) / (A + B) of two channels of rows of shape (rows, width, 4) as float32, 0 where A + B is 0"""
+    first = rows[:, :, first].astype(np.float32)
+    second = rows[:, :, second].astype(np.float32)
+    total = first + second
+    np.subtract(first, second, out=first)
+    return np.divide(first, total, out=np.zeros_like(first), where=total != 0)
+
+
+def sidecar_paths(base, bands, band_format):
+    """Paths of the sidecars of a frame, base is the frame path without .pam"""
+    extension = ".npy" if band_format == "float16" else ".pgm"
+    return [base + "." + name + extension for name, _, _ in bands]
+
+
+class NpyWriter(object):
+    """
+    Write a 2d float16 .npy file row strip by row strip, to a temporary name
+    renamed into place on close
+    """
+    def __init__(self, path, width, height):
+        self.path = path
+        self.height = height
+        self.rows_written = 0
+        self.tmp_path = "%s.tmp-%d" %(path, os.getpid())
+        self._f = open(self.tmp_path, "wb")
+        np.lib.format.write_array_header_1_0(self._f, {"descr": np.lib.format.dtype_to_descr(np.dtype("<f2")),
+                                                      "fortran_order": False, "shape": (height, width)})
+
+    def write_rows(self, rows):
+        """Append rows of shape (rows, width)"""
+        rows = np.ascontiguousarray(rows, dtype="<f2")
+        self._f.write(memoryview(rows).cast("B"))
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        """Finish the file and rename it into place"""
+        if self._f is None:
+            return
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError("Only %d of %d rows written to %s" %(self.rows_written, self.height, self.path))
+        self._f.close()
+        self._f = None
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """Drop the partial file"""
+        if self._f is None:
+            return
+        self._f.close()
+        self._f = None
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class BandWriter(object):
+    """
+    Compute the bands of one frame from its merged rows and write their
+    sidecars, used like a PamWriter: write_rows takes RGBN rows.
+    """
+    def __init__(self, base, bands, band_format, width, height):
+        self.bands = bands
+        self.band_format = band_format
+        self.bytes_written = 0
+        self.writers = []
+        try:
+            for path in sidecar_paths(base, bands, band_format):
+                if band_format == "float16":
+                    self.writers.append(NpyWriter(path, width, height))
+                else:
+                    self.writers.append(PgmWriter(path, width, height, 255))
+        except OSError:
+            self.abort()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_rows(self, rows):
+        """Compute the bands of rows of shape (rows, width, 4), CHUNK_ROWS at a time"""
+        for start in range(0, rows.shape[0], CHUNK_ROWS):
+            chunk = rows[start:start + CHUNK_ROWS]
+            for (_, first, second), writer in zip(self.bands, self.writers):
+                values = normalized_difference(chunk, first, second)
+                if self.band_format == "uint8":
+                    values += 1.0
+                    values *= 127.5
+                    values = np.rint(values, out=values).astype(np.uint8)
+                    writer.write_rows(values)
+                else:
+                    writer.write_rows(values)
+                self.bytes_written += values.size * (1 if self.band_format == "uint8" else 2)
+
+    def close(self):
+        """Finish all sidecars"""
+        for writer in self.writers:
+            writer.close()
+
+    def abort(self):
+        """Drop all partial sidecars"""
+        for writer in self.writers:
+            writer.abort()
+
+
+def write_bands(base, rgbn, bands, band_format):
+    """
+    Write the sidecars of a whole merged frame of shape (height, width, 4)
+    Returns the number of bytes of band data written
+    """
+    height, width = rgbn.shape[:2]
+    with BandWriter(base, bands, band_format, width, height) as writer:
+        writer.write_rows(rgbn)
+    return writer.bytes_written
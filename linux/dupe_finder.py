@@ -0,0 +1,115 @@
+"""
+Dupe finder
+Find duplicate files in stages so that only a small part of the data is hashed:
+files are grouped by size, then by a hash of their first and last blocks,
+and only files that still collide get a full content hash.
+"""
+import os
+import stat
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+EDGE_SIZE = 4096
+CHUNK_SIZE = 1024 * 1024
+
+
+class DupeFinder(object):
+    """
+    Collect files from a walk and find the groups with identical content.
+    Every inode is only collected once, so hardlinks, a path given twice and
+    files reached through overlapping roots are not duplicates of themselves.
+    """
+    def __init__(self, jobs=1, edge_size=EDGE_SIZE):
+        self.jobs = jobs
+        self.edge_size = edge_size
+        self.by_size = defaultdict(list)
+        self.seen = set()
+        self.total_bytes = 0
+        self.hashed_bytes = 0
+
+    def add(self, path, file_stat):
+        """
+        Collect a file found by the walk
+        Parameters:
+        path: path of the file
+        file_stat: lstat result of the file
+        """
+        if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+            return
+        inode = (file_stat.st_dev, file_stat.st_ino)
+        if inode in self.seen:
+            return
+        self.seen.add(inode)
+        self.total_bytes += file_stat.st_size
+        self.by_size[file_stat.st_size].append((path, file_stat.st_blocks * 512))
+
+    def edge_hash(self, item):
+        """Hash the first and last edge_size bytes of a file, None if unreadable"""
+        path, _ = item
+        try:
+            with open(path, "rb") as _f:
+                digest = hashlib.blake2b(_f.read(self.edge_size))
+                size = os.fstat(_f.fileno()).st_size
+                if size > self.edge_size:
+                    _f.seek(max(self.edge_size, size - self.edge_size))
+                    digest.update(_f.read(self.edge_size))
+        except OSError:
+            return None
+        return digest.digest()
+
+    def full_hash(self, item):
+        """Hash the whole content of a file, None if unreadable"""
+        path, _ = item
+        digest = hashlib.blake2b()
+        try:
+            with open(path, "rb") as _f:
+                for chunk in iter(lambda: _f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        return digest.digest()
+
+    def regroup(self, groups, hash_function, size_of):
+        """Split every group by a hash computed on the pool, keep groups with several members"""
+        items = [(key, item) for key, group in groups for item in group]
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            digests = pool.map(lambda pair: hash_function(pair[1]), items)
+            split = defaultdict(list)
+            for (key, item), digest in zip(items, digests):
+                if digest is None:
+                    continue
+                self.hashed_bytes += size_of(key)
+                split[(key, digest)].append(item)
+        return [(key[0], group) for key, group in split.items() if len(group) > 1]
+
+    def find(self):
+        """
+        Run the size, edge hash and full hash stages
+        Returns:
+        list of (size, [(path, allocated size)...]) groups with identical content
+        """
+        groups = [(size, group) for size, group in self.by_size.items() if len(group) > 1]
+        edge = self.edge_size
+        groups = self.regroup(groups, self.edge_hash, lambda size: min(size, 2 * edge))
+        small = [(size, group) for size, group in groups if size <= 2 * edge]  # Edges cover all of it
+        large = [(size, group) for size, group in groups if size > 2 * edge]
+        large = self.regroup(large, self.full_hash, lambda size: size)
+        return sorted((size, sorted(group)) for size, group in small + large)
+
+    @staticmethod
+    def reclaimable(groups):
+        """
+        Compute the bytes freed per directory by keeping one copy of every group
+        Parameters:
+        groups: result of find
+        Returns:
+        dict of directory -> [redundant copies, reclaimable bytes]
+        """
+        per_dir = defaultdict(lambda: [0, 0])
+        for _, group in groups:
+            for path, blocks in group[1:]:
+                counts = per_dir[os.path.dirname(path)]
+                counts[0] += 1
+                counts[1] += blocks
+        return per_dir
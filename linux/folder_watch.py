@@ -0,0 +1,155 @@
+"""
+Folder watch
+Report files that are completely written into a set of folders, through
+inotify (called with ctypes) where available, or by polling the folders.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+READ_SIZE = 64 * 1024
+POLL_INTERVAL = 2.0
+CLOCK_SLACK_NS = 1000000000  # File times come from a coarser clock than time.time_ns
+
+
+class InotifyWatcher(object):
+    """
+    Watch folders for files closed after writing or moved in.
+    A file is only reported once its writer closed it, so it is complete.
+    """
+    kind = "inotify"
+
+    def __init__(self, folders):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.folders = {}
+        for folder in folders:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                error = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(error, os.strerror(error), folder)
+            self.folders[wd] = folder
+
+    def events(self, timeout):
+        """
+        Wait up to timeout seconds for completed files
+        Returns:
+        list of paths, None in the list when events were lost and the folders need a rescan
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        paths = []
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                paths.append(None)
+            elif wd in self.folders and name:
+                paths.append(os.path.join(self.folders[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        """Stop watching"""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(object):
+    """
+    Poll folders and report files whose size and mtime stayed the same for one
+    interval. Only files changed since the oldest file still settling are
+    looked at, using their ctime, which a rename into the folder updates too,
+    so the files remembered are the few that recently changed.
+    """
+    kind = "polling"
+
+    def __init__(self, folders, interval=POLL_INTERVAL):
+        self.folders = list(folders)
+        self.interval = interval
+        self.since = time.time_ns() - CLOCK_SLACK_NS
+        self.candidates = {}
+        self.reported = {}
+        self.last_poll = 0.0
+
+    def events(self, timeout):
+        """
+        Wait up to timeout seconds, polling once an interval has passed
+        Returns:
+        list of paths of files that stopped changing
+        """
+        wait = self.last_poll + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait))
+        self.last_poll = time.monotonic()
+        started = time.time_ns()
+        seen = {}
+        for folder in self.folders:
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        try:
+                            entry_stat = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        changed = max(entry_stat.st_mtime_ns, entry_stat.st_ctime_ns)
+                        if changed < self.since or not entry.is_file(follow_symlinks=False):
+                            continue
+                        seen[entry.path] = (entry_stat.st_size, entry_stat.st_mtime_ns, changed)
+            except OSError as _e:
+                if _e.errno != errno.ENOENT:
+                    raise
+        paths = []
+        candidates = {}
+        for path, state in seen.items():
+            if self.reported.get(path) == state:
+                continue
+            if self.candidates.get(path) == state:
+                paths.append(path)
+                self.reported[path] = state
+            else:
+                candidates[path] = state
+        self.candidates = candidates
+        self.since = min([state[2] for state in candidates.values()] + [started - CLOCK_SLACK_NS])
+        self.reported = {path: state for path, state in self.reported.items() if state[2] >= self.since}
+        return paths
+
+    def close(self):
+        """Stop watching"""
+        self.candidates = {}
+        self.reported = {}
+
+
+def open_watcher(folders, interval=None):
+    """
+    Watch folders with inotify, or by polling every interval seconds when
+    inotify is not available or interval is given
+    """
+    if interval is None:
+        try:
+            return InotifyWatcher(folders)
+        except (OSError, AttributeError) as _e:
+            print("inotify is not available (%s), polling the folders" %_e)
+    return PollingWatcher(folders, interval or POLL_INTERVAL)
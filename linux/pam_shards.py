@@ -0,0 +1,316 @@
+"""
+Pack converted RGBN frames into large shard files.
+Every shard "shard-NNNNN.data" holds the raw rasters of many frames, aligned to
+4096 bytes, and "shard-NNNNN.idx" a compact record per frame: offset, shape,
+max value and name. A frame is read with one seek and one read, or mapped.
+Run as a script to list or extract the frames of a shard directory.
+"""
+import os
+import sys
+import glob
+import struct
+import fnmatch
+import numpy as np
+from ppm_to_pam import write_pam
+from conversion_manifest import file_checksum
+
+SHARD_SIZE = 1 << 30
+ALIGNMENT = 4096
+INDEX_RECORD = struct.Struct("<QIIHIH")  # offset, width, height, depth, max value, name length
+
+OPTIONS = ["-l", "--list", "-x", "--extract", "-o", "--output", "-h", "-H", "--help"]
+OPTIONS_FLAGS = {"List": False, "Extract": False}
+OPTIONS_HELP_TEXT = {
+    "-l": "{:>5}{:>3} {:10} \tList the frames in the shards".format(OPTIONS[0], "", OPTIONS[1]),
+    "-x": "{:>5}{:>3} {:10} \tExtract frames matching the NAME patterns (all if none) as .pam files".format(
+        OPTIONS[2], "", OPTIONS[3]),
+    "-o": "{:>5}{:>3} {:10} \tOutput folder of extracted frames (default .)".format(OPTIONS[4], "", OPTIONS[5]),
+    "-h": "{:>5}{:>3} {:10} \tDisplay this help and exit".format(OPTIONS[-3], OPTIONS[-2], OPTIONS[-1])
+}
+
+
+def frame_dtype(max_value):
+    """Sample type of a frame, 16-bit big-endian above 255 like .pam files"""
+    return np.dtype(">u2") if max_value > 255 else np.dtype(np.uint8)
+
+
+def read_index(index_path):
+    """
+    Records of a shard index as (name, offset, shape, max value), a torn record
+    at the end (interrupted writer) is left out
+    Returns:
+    the records and the size of the complete records in bytes
+    """
+    with open(index_path, "rb") as _f:
+        index = _f.read()
+    records = []
+    pos = 0
+    while pos + INDEX_RECORD.size <= len(index):
+        offset, width, height, depth, max_value, name_len = INDEX_RECORD.unpack_from(index, pos)
+        if pos + INDEX_RECORD.size + name_len > len(index):
+            break
+        pos += INDEX_RECORD.size
+        records.append((index[pos:pos + name_len].decode("utf-8"), offset, (height, width, depth), max_value))
+        pos += name_len
+    return records, pos
+
+
+class ShardFrameWriter(object):
+    """
+    Append the rows of one frame to the current shard, used like a PamWriter.
+    The index record is only written once all rows are in.
+    """
+    def __init__(self, shards, name, width, height, depth, max_value):
+        self.shards = shards
+        self.name = name
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.max_value = max_value
+        self.dtype = frame_dtype(max_value)
+        self.offset = shards.data_f.tell()
+        self.rows_written = 0
+        self.bytes_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_rows(self, rows):
+        """Append rows of shape (rows, width, depth)"""
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != (self.width, self.depth):
+            raise ValueError("Rows of shape %s do not match width %d and depth %d"
+                             %(rows.shape, self.width, self.depth))
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError("More than %d rows written" %self.height)
+        self.shards.data_f.write(memoryview(rows).cast("B"))
+        self.rows_written += rows.shape[0]
+        self.bytes_written += rows.nbytes
+
+    def close(self):
+        """Pad the shard to the next alignment and record the frame in the index"""
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError("Only %d of %d rows written to %s" %(self.rows_written, self.height, self.name))
+        self.shards.finish_frame(self)
+
+    def abort(self):
+        """Drop the partial frame from the shard"""
+        self.shards.data_f.seek(self.offset)
+        self.shards.data_f.truncate()
+        self.shards.frame = None
+
+
+class ShardWriter(object):
+    """
+    Append frames to shard files of about shard_size bytes in a folder,
+    continuing the last shard of an earlier run.
+    """
+    def __init__(self, directory, shard_size=SHARD_SIZE):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.frame = None
+        self.last_frame = None
+        self.data_path = None
+        self.data_f = None
+        self.index_f = None
+        os.makedirs(directory, exist_ok=True)
+        shards = sorted(glob.glob(os.path.join(directory, "shard-*.data")))
+        self.shard = len(shards) - 1 if shards else 0
+        self.open_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open_shard(self):
+        """
+        Open the current shard and its index for appending, first cutting off
+        what a writer that crashed left after the last recorded frame, so the
+        next frame starts aligned
+        """
+        base = os.path.join(self.directory, "shard-%05d" %self.shard)
+        self.data_path = base + ".data"
+        records, index_size = read_index(base + ".idx") if os.path.exists(base + ".idx") else ([], 0)
+        end = 0
+        if records:
+            _, offset, (height, width, depth), max_value = records[-1]
+            end = offset + height * width * depth * frame_dtype(max_value).itemsize
+            end += -end % ALIGNMENT
+        for path, size in ((self.data_path, end), (base + ".idx", index_size)):
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+        self.data_f = open(self.data_path, "ab")
+        self.index_f = open(base + ".idx", "ab")
+
+    def frame_writer(self, name, width, height, depth, max_value):
+        """Start a new frame, moving on to a new shard if it would not fit"""
+        if self.frame is not None:
+            raise ValueError("Frame %s is still being written" %self.frame.name)
+        size = width * height * depth * frame_dtype(max_value).itemsize
+        if self.data_f.tell() > 0 and self.data_f.tell() + size > self.shard_size:
+            self.close()
+            self.shard += 1
+            self.open_shard()
+        self.frame = ShardFrameWriter(self, name, width, height, depth, max_value)
+        return self.frame
+
+    def add(self, name, image, max_value):
+        """
+        Append a whole frame of shape (height, width, depth)
+        Returns the number of bytes written
+        """
+        height, width, depth = image.shape
+        with self.frame_writer(name, width, height, depth, max_value) as writer:
+            writer.write_rows(image)
+        return writer.bytes_written
+
+    def finish_frame(self, frame):
+        """Align the shard and write the index record of a complete frame"""
+        end = self.data_f.tell()
+        if end % ALIGNMENT:
+            self.data_f.write(b"\0" * (ALIGNMENT - end % ALIGNMENT))
+        self.data_f.flush()
+        name = frame.name.encode("utf-8")
+        self.index_f.write(INDEX_RECORD.pack(frame.offset, frame.width, frame.height, frame.depth,
+                                             frame.max_value, len(name)) + name)
+        self.index_f.flush()
+        self.last_frame = frame
+        self.frame = None
+
+    def checksum(self):
+        """Checksum of the raster of the last finished frame"""
+        frame = self.last_frame
+        return file_checksum(self.data_path, frame.offset, frame.bytes_written)
+
+    def close(self):
+        """Close the current shard"""
+        for _f in (self.data_f, self.index_f):
+            if _f is not None:
+                _f.close()
+        self.data_f = None
+        self.index_f = None
+
+
+class ShardReader(object):
+    """
+    Read frames from a shard folder by position or name.
+    A torn record at the end of an index (interrupted writer) is ignored.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = []
+        self.by_name = {}
+        self.files = {}
+        for index_path in sorted(glob.glob(os.path.join(directory, "shard-*.idx"))):
+            data_path = index_path[:-4] + ".data"
+            for name, offset, shape, max_value in read_index(index_path)[0]:
+                self.by_name[name] = len(self.entries)
+                self.entries.append((name, data_path, offset, shape, max_value))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def entry(self, key):
+        """Index entry of a frame given by position or name"""
+        return self.entries[self.by_name[key] if isinstance(key, str) else key]
+
+    def read(self, key):
+        """Read a frame into a new array with one seek and one read"""
+        _, data_path, offset, shape, max_value = self.entry(key)
+        image = np.empty(shape, dtype=frame_dtype(max_value))
+        _f = self.files.get(data_path)
+        if _f is None:
+            _f = self.files[data_path] = open(data_path, "rb")
+        _f.seek(offset)
+        if _f.readinto(memoryview(image).cast("B")) != image.nbytes:
+            raise ValueError("Truncated frame in %s" %data_path)
+        return image, max_value
+
+    def map(self, key):
+        """Map a frame read-only without reading it"""
+        _, data_path, offset, shape, max_value = self.entry(key)
+        return np.memmap(data_path, dtype=frame_dtype(max_value), mode="r", offset=offset, shape=shape), max_value
+
+    def close(self):
+        """Close the open shard files"""
+        for _f in self.files.values():
+            _f.close()
+        self.files = {}
+
+
+def list_frames(reader, patterns):
+    """Print the frames matching the patterns"""
+    print("{:-<50}{:-<20}{:-<10}{:-<20}".format("FRAME", "SHAPE", "MAXVAL", "SHARD"))
+    for name, data_path, offset, shape, max_value in reader.entries:
+        if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        print("{:<50}{:<20}{:<10}{}@{}".format(name, "x".join(map(str, shape)), max_value,
+                                               os.path.basename(data_path), offset))
+
+
+def extract_frames(reader, patterns, outputdir):
+    """Write the frames matching the patterns as .pam files"""
+    os.makedirs(outputdir, exist_ok=True)
+    count = 0
+    for idx, entry in enumerate(reader.entries):
+        name = entry[0]
+        if reader.by_name[name] != idx:  # Replaced by a later frame of the same name
+            continue
+        if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        image, max_value = reader.read(idx)
+        output = os.path.join(outputdir, os.path.basename(name) + ".pam")
+        write_pam(output, image, max_value)
+        print("Extracted:", output)
+        count += 1
+    print("Extracted %d frames" %count)
+
+
+def main():
+    """Main method"""
+    args = sys.argv[1:]
+    if not args or any(help_option in args for help_option in OPTIONS[-3:]):
+        print("Usage: pam_shards.py [OPTION]... SHARD_DIR [NAME]...")
+        print("List or extract frames packed by ppam --shard")
+        print("Options:")
+        for _v in OPTIONS_HELP_TEXT.values():
+            print(_v)
+        exit(0 if args else 1)
+    outputdir = "."
+    paths = []
+    for idx, item in enumerate(args):
+        if idx > 0 and args[idx - 1] in OPTIONS[4:6]:
+            outputdir = item
+        elif item in OPTIONS[0:2]:
+            OPTIONS_FLAGS["List"] = True
+        elif item in OPTIONS[2:4]:
+            OPTIONS_FLAGS["Extract"] = True
+        elif item not in OPTIONS:
+            paths.append(item)
+    if not paths or not os.path.isdir(paths[0]):
+        print("ERROR! missing shard folder")
+        exit(1)
+    with ShardReader(paths[0]) as reader:
+        if OPTIONS_FLAGS["Extract"]:
+            extract_frames(reader, paths[1:], outputdir)
+        else:
+            list_frames(reader, paths[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,691 @@
 """Combine two or more .ppm files (RGB & NIR) into a .pam file"""
 from glob import glob
+from collections import defaultdict, OrderedDict, Counter, deque
 import sys
 import os
+import re
+import time
+import json
+import queue
+import signal
+import resource
+import threading
 import subprocess as sp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
-from ppm_to_pam import PpmToPam
-
-FILE_CONVERT_COUNT = 0
+from ppm_to_pam import PpmFormatError, TeeWriter, write_pam, merge_rgb_nir_strips, load_ppm
+from pam_shards import ShardWriter, ShardReader
+from conversion_manifest import Manifest, file_checksum
+from folder_watch import open_watcher
+from derived_bands import BandWriter, BandError, BAND_FORMATS, parse_band, write_bands, sidecar_paths
+from channel_stats import ChannelStats, StatsIndex, INDEX_NAME, frame_stats
 
 FOLDERS = []
 
-OPTIONS = ["-f", "-file", "--file", "-d", "-folder", "-h", "-H", "--help"]
-OPTIONS_FLAGS = {"File_mode": False, "Folder_mode": False}
+JOBS = 1
+IN_FLIGHT = 2  # Pairs submitted per job
+QUEUE_DEPTH = 2  # Pairs waiting between the stages of the pipeline
+PROFILE_REPORT = "ppam_profile.json"
+
+BANDS = []
+BAND_FORMAT = "float16"
+
+MANIFESTS = {}
+STATS_INDEXES = {}
+
+POLL_INTERVAL = None
+PENDING_TTL = 3600  # Seconds a file waits for its counterpart in watch mode
+MAX_PENDING = 10000
+SETTLE_TIME = 2.0  # Seconds the inputs of a pair stay unchanged before the watch mode takes it as written
+DEFERRED = []  # Pairs of the watch mode left to their watch events because they were still being written
+
+SHARD_DIR = None
+SHARDS = None
+SHARD_SOURCES = {}  # Frame name -> RGB file it is converted from, names are shared by all input folders
+
+RGB_TOKENS = ["unsheared", "sheared"]
+NIR_TOKENS = ["nir"]
+STEM_SEPARATORS = "-_. "
+
+OPTIONS = ["-f", "-file", "--file", "-d", "-folder", "-s", "--stream", "--shard", "--rgb-token", "--nir-token",
+           "-j", "--jobs", "--hash", "--force",
+           "-w", "--watch", "--poll", "--queue-depth", "--profile",
+           "--band", "--band-format", "--stats", "-h", "-H", "--help"]
+OPTIONS_FLAGS = {"File_mode": False, "Folder_mode": False, "Stream": False, "Hash": False, "Force": False,
+                 "Watch": False, "Profile": False, "Stats": False}
 OPTIONS_HELP_TEXT = {
     "-f": "{:>5}{:>3} {:10} \tFile mode: Combine a RGB and Nir image to a 4channel pam image\n\t\t\tRGB 1st Nir 2nd".format(OPTIONS[0], OPTIONS[1], OPTIONS[2]),
-    "-d": "{:>5} {:10} \tDir/Folder mode: Convert entire folder requires proper organizing of files.\n\t\t\tE.g.. RGB and Nir file names must match so if 'unsheard' was to be swapped with 'nir' you would have the nir file.".format(OPTIONS[3], OPTIONS[4]),
+    "-d": "{:>5} {:10} \tDir/Folder mode: Convert entire folder requires proper organizing of files.\n\t\t\tE.g.. RGB and Nir file names must match so if 'unsheard' was to be swapped with 'nir' you would have the nir file.\n\t\t\tTokens only match whole words, so 'sheared' does not match 'unsheared'.".format(OPTIONS[3], OPTIONS[4]),
+    "-s": "{:>5}{:>3} {:10} \tStream mode: merge binary ppms a few rows at a time with bounded memory".format(OPTIONS[5], "", OPTIONS[6]),
+    "--shard": "{:>5}{:>3} {:10} \tAppend the RGBN frames to ~1GB shard files in DIR instead of .pam files\n\t\t\tList or extract them with pam_shards.py".format("", "", OPTIONS[7] + " DIR"),
+    "--rgb-token": "{:>5}{:>3} {:10} \tName token of RGB files, repeat for several (default unsheared, sheared)".format("", "", OPTIONS[8] + " T"),
+    "--nir-token": "{:>5}{:>3} {:10} \tName token of NIR files, repeat for several (default nir)".format("", "", OPTIONS[9] + " T"),
+    "-j": "{:>5}{:>3} {:10} \tConvert N pairs at a time on a process pool (default 1)".format(OPTIONS[10], "", OPTIONS[11] + " N"),
+    "--hash": "{:>5}{:>3} {:10} \tFolder mode: also compare content hashes, so touched but unchanged inputs are skipped".format("", "", OPTIONS[12]),
+    "--force": "{:>5}{:>3} {:10} \tFolder mode: convert all pairs, even those the manifest shows as up to date".format("", "", OPTIONS[13]),
+    "-w": "{:>5}{:>3} {:10} \tFolder mode: keep running and convert pairs as soon as both files are written".format(OPTIONS[14], "", OPTIONS[15]),
+    "--poll": "{:>5}{:>3} {:10} \tWatch by polling the folders every S seconds instead of with inotify".format("", "", OPTIONS[16] + " S"),
+    "--queue-depth": "{:>5}{:>3} {:10} \tPairs read and merged ahead of the one being written (default 2, 0 to\n\t\t\tconvert one step after the other)".format("", "", OPTIONS[17] + " N"),
+    "--profile": "{:>5}{:>3} {:10} \tPrint the time spent reading, merging and writing and write the stages,\n\t\t\tbytes and peak RSS of every pair to ppam_profile.json".format("", "", OPTIONS[18]),
+    "--band": "{:>5}{:>3} {:10} \tAlso write a derived band next to every .pam file, repeat for several:\n\t\t\tndvi, gndvi, ndwi or NAME=A-B for (A-B)/(A+B) with A, B in R, G, B, NIR".format("", "", OPTIONS[19] + " B"),
+    "--band-format": "{:>5}{:>3} {:10} \tfloat16 (.npy sidecars, default) or uint8 (.pgm sidecars, -1..1 as 0..255)".format("", "", OPTIONS[20] + " F"),
+    "--stats": "{:>5}{:>3} {:10} \tFolder mode: record the mean, std, min, max and histogram of every channel\n\t\t\tof every frame in ppam_stats.jsonl and of the dataset in ppam_stats_summary.json".format("", "", OPTIONS[21]),
     "-h": "{:>5}{:>3} {:10} \tDisplay this help and exit".format(OPTIONS[-3], OPTIONS[-2], OPTIONS[-1])
 }
 
 
-def combine_rgb_nir(rgbfile, nirfile, outputdir):
-    """Combine an rgbfile and a nirfile into a 4channel .pam file."""
-    global FILE_CONVERT_COUNT
-    pam = PpmToPam(rgbfile, nirfile)
-    rgbn = np.ndarray(shape=(4, pam.height * pam.width), dtype=np.uint8)
-    rgbn = np.concatenate((pam.rgb_img, pam.nir_img[:, :, :1]), axis=2)
-    rgbn = np.moveaxis(rgbn, 2, 0)
-
-    new_file = outputdir + pam.rgbfile.split("/")[-1][:-4]
-    _f = open("%s_with_nir.pam" %new_file, "wb")
-    _f.write(b"P7\n")
-    _f.write(b"WIDTH %d\n" %pam.width)
-    _f.write(b"HEIGHT %d\n" %pam.height)
-    _f.write(b"DEPTH 4\n")
-    _f.write(b"MAXVAL %d\n" %pam.max_value)
-    _f.write(b"ENDHDR\n")
-    print("RGBN file:", _f.name)
-    for i in rgbn.flatten():
-        _f.write(b"%c" %i)
-    _f.close
-    FILE_CONVERT_COUNT += 1
+def convert_pair(rgbfile, nirfile, outputdir, stream=False, shards=None, return_frame=False, checksum=False,
+                 bands=None, band_format="float16", stats=False, profile=False):
+    """
+    Combine an rgbfile and a nirfile into a 4channel .pam file or shard frame.
+    Runs in the worker processes of --jobs too, so it reports instead of exiting.
+    Parameters:
+    outputdir: folder of the .pam file
+    stream: merge binary ppms strip by strip
+    shards: ShardWriter the frame is appended to instead of a .pam file
+    return_frame: return the frame to the caller instead of writing it
+    checksum: checksum the written output
+    bands, band_format: derived bands, as parsed by parse_band, written as sidecars of the .pam file
+    stats: compute the channel statistics of the frame
+    profile: measure the peak RSS of the pair
+    Returns:
+    dict with rgb, nir, output, bytes, checksum, stats, seconds, cpu, peak_rss_kb and error ("" on success),
+    and frame as (image, max value) when return_frame is set
+    """
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    if profile:
+        reset_peak_rss()
+    frame = rgbfile.split("/")[-1][:-4] + "_with_nir"
+    result = new_result(rgbfile, nirfile, frame if shards is not None or return_frame else outputdir + frame + ".pam")
+    output = result["output"]
+    try:
+        merged = None
+        if stream and not return_frame:
+            open_writer = None
+            if shards is not None:
+                open_writer = lambda width, height, depth, max_value: shards.frame_writer(
+                    frame, width, height, depth, max_value)
+            sidecars = []
+
+            def open_sidecar(width, height, max_value):
+                if bands:
+                    sidecars.append(BandWriter(output[:-4], bands, band_format, width, height))
+                if stats:
+                    sidecars.append(ChannelStats(max_value))
+                return TeeWriter(sidecars)
+            try:
+                with StageTimer(result, "stream"):
+                    merged = merge_rgb_nir_strips(rgbfile, nirfile, output, open_writer=open_writer,
+                                                  open_sidecar=open_sidecar if bands or stats else None)
+                    result["bytes_read"] = os.path.getsize(rgbfile) + os.path.getsize(nirfile)
+            except PpmFormatError as _e:
+                print("Can not stream %s (%s), converting in memory" %(rgbfile, _e))
+        if merged is not None:
+            width, height, max_value = merged
+            # Size of the .pam file with its header, like write_pam returns, or of the shard raster
+            result["bytes"] = width * height * 4 * (2 if max_value > 255 else 1) if shards is not None \
+                else os.path.getsize(output)
+            result["band_bytes"] = width * height * len(bands or []) * (1 if band_format == "uint8" else 2)
+            if stats:
+                result["stats"] = sidecars[-1].summary()
+        else:
+            with StageTimer(result, "read"):
+                rgb, nir, max_value = read_pair(rgbfile, nirfile)
+                result["bytes_read"] = os.path.getsize(rgbfile) + os.path.getsize(nirfile)
+            with StageTimer(result, "merge"):
+                rgbn, max_value = merge_pair(rgb, nir, max_value)
+            del rgb, nir
+            if stats:
+                with StageTimer(result, "stats"):
+                    result["stats"] = frame_stats(rgbn, max_value)
+            if return_frame:
+                result["frame"] = (rgbn, max_value)
+            else:
+                with StageTimer(result, "write"):
+                    if shards is not None:
+                        result["bytes"] = shards.add(frame, rgbn, max_value)
+                    else:
+                        result["bytes"] = write_pam(output, rgbn, max_value)
+                if bands:
+                    with StageTimer(result, "bands"):
+                        result["band_bytes"] = write_bands(output[:-4], rgbn, bands, band_format)
+        if checksum and not return_frame:
+            with StageTimer(result, "checksum"):
+                result["checksum"] = shards.checksum() if shards is not None else file_checksum(output)
+    except Exception as _e:
+        result["error"] = str(_e) or type(_e).__name__
+    result["seconds"] = time.perf_counter() - started
+    result["cpu"] = time.process_time() - cpu_started
+    if profile:
+        result["peak_rss_kb"] = peak_rss_kb()
+    return result
+
+
+def new_result(rgbfile, nirfile, output):
+    """Result of a pair before it is converted"""
+    return {"rgb": rgbfile, "nir": nirfile, "output": output, "bytes": 0, "band_bytes": 0, "bytes_read": 0,
+            "checksum": "", "stats": None,
+            "seconds": 0.0, "cpu": 0.0, "stages": {}, "peak_rss_kb": 0, "error": ""}
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of this process to its current RSS, so peak_rss_kb measures
+    from here on (Linux 4.0 and later). Also lowers the ru_maxrss seen by a parent.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as _f:
+            _f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_kb():
+    """Peak RSS of this process in KB since the last reset_peak_rss, or since it started"""
+    try:
+        with open("/proc/self/status") as _f:
+            for line in _f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageTimer(object):
+    """Add the wall and cpu time of a block to result["stages"][name]"""
+    def __init__(self, result, name):
+        self.result = result
+        self.name = name
+        self.started = 0.0
+        self.cpu_started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.cpu_started = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stage = self.result["stages"].setdefault(self.name, [0.0, 0.0])
+        stage[0] += time.perf_counter() - self.started
+        stage[1] += time.thread_time() - self.cpu_started
+
+
+def read_pair(rgbfile, nirfile):
+    """Reader stage: read both images of a pair into memory"""
+    rgb, max_value = load_ppm(rgbfile, mapped=False)
+    nir, nir_max_value = load_ppm(nirfile, mapped=False)
+    if rgb.shape[:2] != nir.shape[:2]:
+        raise PpmFormatError("Files do not have the same dimensions")
+    if max_value != nir_max_value:
+        raise PpmFormatError("Files do not have the same max values")
+    return rgb, nir, max_value
+
+
+def read_input(rgbfile, nirfile, result):
+    """Reader stage of the pipeline: read_pair counting the bytes read"""
+    data = read_pair(rgbfile, nirfile)
+    result["bytes_read"] = os.path.getsize(rgbfile) + os.path.getsize(nirfile)
+    return data
+
+
+def merge_pair(rgb, nir, max_value):
+    """Merger stage: interleave the rgb channels and the first nir channel"""
+    rgbn = np.empty(rgb.shape[:2] + (4,), dtype=rgb.dtype)
+    rgbn[:, :, :3] = rgb
+    rgbn[:, :, 3] = nir[:, :, 0]
+    return rgbn, max_value
+
+
+def queue_put(_queue, item, stop):
+    """Put an item on a bounded queue unless stop is set, returns False when stopped"""
+    while not stop.is_set():
+        try:
+            _queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def queue_get(_queue, stop):
+    """Get an item from a queue, None once stop is set"""
+    while not stop.is_set():
+        try:
+            return _queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def pipeline_stage(name, function, source, target, stop):
+    """
+    Run a stage on its own thread: apply function to the data of every task from
+    source and pass the task on to target. Failed tasks are passed on without data.
+    """
+    while True:
+        task = queue_get(source, stop)
+        if task is None:
+            queue_put(target, None, stop)
+            return
+        result, data = task
+        if data is not None:
+            try:
+                with StageTimer(result, name):
+                    data = function(*data)
+            except Exception as _e:
+                result["error"] = str(_e) or type(_e).__name__
+                data = None
+        if not queue_put(target, (result, data), stop):
+            return
+
+
+def convert_pairs_pipelined(pairs, outputdir, checksum=False):
+    """
+    Convert pairs with reader, merger and writer stages on their own threads,
+    connected by queues of QUEUE_DEPTH pairs. The next pairs are read and merged
+    while the current one is written, so disk and cpu are busy at the same time.
+    With --profile the peak RSS of a pair is that of the process since the
+    previous pair was written, so it includes the pairs read and merged ahead.
+    Yields:
+    the result of every pair as returned by convert_pair, in order
+    """
+    stop = threading.Event()
+    pair_queue = queue.Queue(QUEUE_DEPTH)
+    read_queue = queue.Queue(QUEUE_DEPTH)
+    merge_queue = queue.Queue(QUEUE_DEPTH)
+    stages = [threading.Thread(target=pipeline_stage, args=stage + (stop,), daemon=True)
+              for stage in (("read", read_input, pair_queue, read_queue),
+                            ("merge", merge_pair, read_queue, merge_queue))]
+    for stage in stages:
+        stage.start()
+
+    def feed():
+        for rgb, nir in pairs:
+            frame = rgb.split("/")[-1][:-4] + "_with_nir"
+            result = new_result(rgb, nir, frame if SHARDS is not None else outputdir + frame + ".pam")
+            if not queue_put(pair_queue, (result, (rgb, nir, result)), stop):
+                return
+        queue_put(pair_queue, None, stop)
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    profile = OPTIONS_FLAGS["Profile"]
+    if profile:
+        reset_peak_rss()
+    try:
+        while True:
+            task = queue_get(merge_queue, stop)
+            if task is None:
+                break
+            result, data = task
+            if data is not None:
+                try:
+                    rgbn, max_value = data
+                    with StageTimer(result, "write"):
+                        if SHARDS is not None:
+                            result["bytes"] = SHARDS.add(result["output"], rgbn, max_value)
+                        else:
+                            result["bytes"] = write_pam(result["output"], rgbn, max_value)
+                    if BANDS:
+                        with StageTimer(result, "bands"):
+                            result["band_bytes"] = write_bands(result["output"][:-4], rgbn, BANDS, BAND_FORMAT)
+                    if OPTIONS_FLAGS["Stats"]:
+                        with StageTimer(result, "stats"):
+                            result["stats"] = frame_stats(rgbn, max_value)
+                    if checksum:
+                        with StageTimer(result, "checksum"):
+                            result["checksum"] = SHARDS.checksum() if SHARDS is not None \
+                                else file_checksum(result["output"])
+                except Exception as _e:
+                    result["error"] = str(_e) or type(_e).__name__
+            result["seconds"] = sum(stage[0] for stage in result["stages"].values())
+            result["cpu"] = sum(stage[1] for stage in result["stages"].values())
+            if profile:
+                result["peak_rss_kb"] = peak_rss_kb()
+                reset_peak_rss()
+            yield finish_pair(result)
+    finally:
+        stop.set()
+        for thread in stages + [feeder]:
+            thread.join()
+
+
+def finish_pair(result, checksum=False):
+    """Write a frame returned by a worker to the shards and print the outcome of a pair"""
+    if "frame" in result:
+        image, max_value = result.pop("frame")
+        try:
+            with StageTimer(result, "write"):
+                result["bytes"] = SHARDS.add(result["output"], image, max_value)
+            if checksum:
+                with StageTimer(result, "checksum"):
+                    result["checksum"] = SHARDS.checksum()
+        except (OSError, ValueError) as _e:
+            result["error"] = str(_e)
+    if result["error"]:
+        print("FAILED:", result["rgb"], "|", result["nir"], ":", result["error"])
+    else:
+        print("RGBN %s: %s (%.2fs)" %("frame" if SHARDS is not None else "file", result["output"], result["seconds"]))
+    return result
+
+
+def ignore_sigint():
+    """Leave Ctrl-C to the main process, workers finish their pair and are shut down"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class WorkerPool(object):
+    """
+    ProcessPoolExecutor of JOBS workers that is started again when a worker
+    dies, e.g. killed by the OOM killer, which breaks the whole executor
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=ignore_sigint)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def submit(self, *args):
+        """Submit a call, raises BrokenProcessPool when a worker died"""
+        return self.executor.submit(*args)
+
+    def restart(self):
+        """Replace a broken executor by a new one"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=ignore_sigint)
+
+    def shutdown(self):
+        """Stop the workers"""
+        self.executor.shutdown(cancel_futures=True)
+
+
+def convert_pairs(pairs, outputdir, checksum=False, pool=None):
+    """
+    Convert pairs one at a time, or on a pool of JOBS processes with at most
+    JOBS * IN_FLIGHT pairs submitted so memory stays bounded.
+    A worker dying breaks the pool and every pair in flight. The pool is
+    started again and those pairs are retried one at a time, so only the
+    pair that kills its worker again is reported as failed.
+    pool: WorkerPool to reuse, a new one is started when None
+    Yields:
+    the result of every pair as returned by convert_pair, in completion order
+    """
+    stream = OPTIONS_FLAGS["Stream"]
+    if JOBS <= 1 and QUEUE_DEPTH > 0 and not stream:
+        yield from convert_pairs_pipelined(pairs, outputdir, checksum)
+        return
+    if JOBS <= 1:
+        for rgb, nir in pairs:
+            yield finish_pair(convert_pair(rgb, nir, outputdir, stream, SHARDS, checksum=checksum,
+                                           bands=BANDS, band_format=BAND_FORMAT, stats=OPTIONS_FLAGS["Stats"],
+                                           profile=OPTIONS_FLAGS["Profile"]))
+        return
+    # Workers can not share the shard files, they hand the frames back to be appended here
+    return_frame = SHARDS is not None
+    if pool is None:
+        with WorkerPool(JOBS) as pool:
+            yield from convert_pairs(pairs, outputdir, checksum, pool)
+        return
+    pending = {}
+    suspects = deque()  # Pairs in flight when a worker died
+    isolated = None  # The suspect running alone on the pool
+    broken = False
+
+    def submit(pair):
+        pending[pool.submit(convert_pair, pair[0], pair[1], outputdir, stream, None, return_frame, checksum,
+                            BANDS, BAND_FORMAT, OPTIONS_FLAGS["Stats"], OPTIONS_FLAGS["Profile"])] = pair
+    pairs = iter(pairs)
+    while True:
+        if broken and not pending:
+            pool.restart()
+            broken = False
+        candidate = None
+        try:
+            if suspects:
+                if not pending:
+                    candidate = suspects.popleft()
+                    submit(candidate)
+                    isolated = candidate
+            else:
+                for candidate in pairs:
+                    submit(candidate)
+                    if len(pending) >= JOBS * IN_FLIGHT:
+                        break
+        except BrokenProcessPool:  # A worker died since the last wait, the pair was not submitted
+            broken = True
+            suspects.appendleft(candidate)
+        if not pending:
+            if broken or suspects:
+                continue
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            rgb, nir = pending.pop(future)
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                broken = True
+                if (rgb, nir) != isolated:
+                    suspects.append((rgb, nir))
+                    continue
+                result = new_result(rgb, nir, "")
+                result["error"] = "the worker process converting it died"
+            if (rgb, nir) == isolated:
+                isolated = None
+            yield finish_pair(result, checksum)
+
+
+def summarize_results(results, seconds, skipped=0):
+    """Print the aggregate of all pairs, returns the number of failed pairs"""
+    converted = [result for result in results if not result["error"]]
+    failed = [result for result in results if result["error"]]
+    if not results:
+        if skipped:
+            print("All %d pairs are up to date" %skipped)
+        elif not OPTIONS_FLAGS["Watch"]:  # Watched folders may well start empty
+            print("Error couldn't find any matching files")
+        return 0
+    if skipped:
+        print("Skipped %d pairs that are up to date" %skipped)
+    total_bytes = sum(result["bytes"] for result in converted)
+    print("Combined %d files into %d files" %(len(converted)*2, len(converted)))
+    print("Wrote %.1f MB in %.2fs (%.1f MB/s), %.2fs of conversion and %.2fs cpu on %d jobs"
+          %(total_bytes / 1e6, seconds, total_bytes / 1e6 / seconds if seconds > 0 else 0,
+            sum(result["seconds"] for result in results), sum(result["cpu"] for result in results), JOBS))
+    if failed:
+        print("%d pairs failed:" %len(failed))
+        for result in failed:
+            print("  %s | %s: %s" %(result["rgb"], result["nir"], result["error"]))
+    return len(failed)
+
+
+def write_profile(results, seconds, path):
+    """
+    Print the time spent in every stage and write a JSON report with the
+    aggregate and the stages, bytes and peak RSS of every pair
+    """
+    stages = defaultdict(lambda: [0.0, 0.0])
+    for result in results:
+        for name, (wall, cpu) in result["stages"].items():
+            stages[name][0] += wall
+            stages[name][1] += cpu
+    stage_wall = sum(wall for wall, _ in stages.values())
+    converted = [result for result in results if not result["error"]]
+    bytes_read = sum(result["bytes_read"] for result in converted)
+    bytes_written = sum(result["bytes"] + result["band_bytes"] for result in converted)
+    # The peaks of the pairs, as the process peaks were reset before every pair
+    peak_rss = max([result["peak_rss_kb"] for result in results] +
+                   [peak_rss_kb(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss])
+    report = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "argv": sys.argv[1:], "jobs": JOBS,
+              "queue_depth": QUEUE_DEPTH, "stream": OPTIONS_FLAGS["Stream"], "wall": round(seconds, 6),
+              "pairs": len(results), "failed": len(results) - len(converted),
+              "bytes_read": bytes_read, "bytes_written": bytes_written,
+              "read_mb_per_sec": round(bytes_read / 1e6 / seconds, 2) if seconds > 0 else None,
+              "write_mb_per_sec": round(bytes_written / 1e6 / seconds, 2) if seconds > 0 else None,
+              "frames_per_sec": round(len(converted) / seconds, 3) if seconds > 0 else None,
+              "peak_rss_kb": peak_rss,
+              "stages": {name: {"wall": round(wall, 6), "cpu": round(cpu, 6),
+                                "share": round(wall / stage_wall, 4) if stage_wall > 0 else None}
+                         for name, (wall, cpu) in stages.items()},
+              "results": [{key: value for key, value in result.items() if key not in ("checksum", "stats")}
+                          for result in results]}
+    print("\n{:-<12}{:-<12}{:-<12}{:-<8}".format("STAGE", "WALL", "CPU", "SHARE"))
+    for name, (wall, cpu) in sorted(stages.items(), key=lambda item: -item[1][0]):
+        print("{:<12}{:>10.3f}s{:>10.3f}s{:>7.1%}".format(name, wall, cpu, wall / stage_wall if stage_wall else 0))
+    print("{:-<44}".format(""))
+    print("Read %.1f MB, wrote %.1f MB, %.2f frames/s, peak RSS %d KB"
+          %(bytes_read / 1e6, bytes_written / 1e6, report["frames_per_sec"] or 0, peak_rss))
+    with open(path, "w") as _f:
+        json.dump(report, _f, indent=2)
+    print("Profile written to", path)
+
+
+def role_pattern(rgb_tokens, nir_tokens):
+    """
+    Regex matching a role token as a whole word of a file name,
+    longest tokens first so a token is never matched inside a longer one
+    """
+    tokens = sorted(set(rgb_tokens) | set(nir_tokens), key=len, reverse=True)
+    return re.compile(r"(?<![A-Za-z0-9])(%s)(?![A-Za-z0-9])" %"|".join(map(re.escape, tokens)))
+
+
+def pair_key(name, pattern, nir_tokens):
+    """
+    Stem and role of a file name, None when it has no role token
+    The role is the rgb token, or 'nir' for all nir tokens.
+    """
+    matches = list(pattern.finditer(name))
+    if not matches:
+        return None
+    match = matches[-1]
+    token = match.group(1)
+    stem = (name[:match.start()].rstrip(STEM_SEPARATORS).lower() + "|"
+            + name[match.end():].lstrip(STEM_SEPARATORS).lower())
+    return stem, token if token not in nir_tokens else "nir"
+
+
+def index_pairs(files, rgb_tokens=None, nir_tokens=None):
+    """
+    Pair rgb files with their nir file in one pass over the names
+    Every file is indexed by the stem left when its last role token and the
+    separators around it are cut out, so 'a_sheared.ppm' and 'A-nir.ppm' share
+    the stem 'a|ppm'.
+    Parameters:
+    files: paths of the .ppm files of a folder
+    rgb_tokens, nir_tokens: name tokens of the rgb and nir files
+    Returns:
+    pairs: sorted list of (rgb file, nir file)
+    orphans: sorted list of files without a counterpart
+    duplicates: sorted list of lists of files claiming the same stem and role
+    """
+    rgb_tokens = RGB_TOKENS if rgb_tokens is None else rgb_tokens
+    nir_tokens = NIR_TOKENS if nir_tokens is None else nir_tokens
+    pattern = role_pattern(rgb_tokens, nir_tokens)
+    index = defaultdict(lambda: defaultdict(list))
+    orphans = []
+    for file in files:
+        key = pair_key(os.path.basename(file), pattern, nir_tokens)
+        if key is None:
+            orphans.append(file)
+            continue
+        index[key[0]][key[1]].append(file)
+    pairs = []
+    duplicates = []
+    for roles in index.values():
+        for role, role_files in roles.items():
+            if len(role_files) > 1:
+                duplicates.append(sorted(role_files))
+        nir = roles.get("nir", [])
+        rgbs = [role_files for role, role_files in roles.items() if role != "nir"]
+        if len(nir) != 1:  # Several nir files are reported as duplicates
+            orphans.extend(role_files[0] for role_files in rgbs if len(role_files) == 1)
+            continue
+        pairs.extend((role_files[0], nir[0]) for role_files in rgbs if len(role_files) == 1)
+        if not rgbs:
+            orphans.extend(nir)
+    return sorted(pairs), sorted(orphans), sorted(duplicates)
+
+
+class PendingPairs(object):
+    """
+    Completed files of the watch mode still waiting for their counterpart,
+    keyed on folder and stem. A nir file stays after its pairs are converted
+    so a late second rgb role is paired too. Entries not updated for ttl
+    seconds, and the oldest beyond max_pending, are dropped so the table stays
+    small however long the watch runs.
+    """
+    def __init__(self, ttl=PENDING_TTL, max_pending=MAX_PENDING):
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.pattern = role_pattern(RGB_TOKENS, NIR_TOKENS)
+        self.table = OrderedDict()  # (folder, stem) -> [last update, {role: path}, converted roles]
+
+    def __len__(self):
+        return len(self.table)
+
+    def add(self, path):
+        """
+        Add a completed file
+        Returns:
+        list of (rgb file, nir file) pairs it completes
+        """
+        key = pair_key(os.path.basename(path), self.pattern, NIR_TOKENS)
+        if key is None:
+            return []
+        stem, role = key
+        entry = self.table.pop((os.path.dirname(path), stem), None) or [0, {}, set()]
+        self.table[(os.path.dirname(path), stem)] = entry
+        entry[0] = time.monotonic()
+        entry[1][role] = path
+        if role == "nir":
+            entry[2].clear()  # A rewritten nir file is paired again
+        else:
+            entry[2].discard(role)
+        pairs = []
+        nir = entry[1].get("nir")
+        if nir is not None:
+            for rgb_role, rgb in entry[1].items():
+                if rgb_role != "nir" and rgb_role not in entry[2]:
+                    pairs.append((rgb, nir))
+                    entry[2].add(rgb_role)
+        self.expire()
+        return pairs
+
+    def owner(self, path):
+        """
+        File of the same name in another folder that is still in the table,
+        its frame would clash with the one of path in the shards
+        Returns:
+        the path of that file, None if there is none
+        """
+        name = os.path.basename(path)
+        key = pair_key(name, self.pattern, NIR_TOKENS)
+        if key is None:
+            return None
+        for (folder, stem), entry in self.table.items():
+            other = entry[1].get(key[1])
+            if stem == key[0] and folder != os.path.dirname(path) and other is not None \
+                    and os.path.basename(other) == name:
+                return other
+        return None
+
+    def expire(self):
+        """Drop entries older than ttl and the oldest beyond max_pending"""
+        limit = time.monotonic() - self.ttl
+        while self.table:
+            key, entry = next(iter(self.table.items()))
+            if entry[0] >= limit and len(self.table) <= self.max_pending:
+                break
+            del self.table[key]
+            if not entry[2]:
+                print("No matching file for:", ", ".join(os.path.basename(path) for path in entry[1].values()))
 
 
 def pair_file():
@@ -50,39 +696,319 @@ def pair_file():
     if len(FOLDERS) < 1:
         print("Error not enough files")
         exit(1)
+    started = time.perf_counter()
+    results = []
+    skipped = 0
     if OPTIONS_FLAGS["File_mode"]:
         rgb = FOLDERS[0]
         nir = FOLDERS[1]
         outputdir = os.path.abspath("", *rgb.split("/")[:-1]) + "/nir_images/"
-        if create_dir(outputdir):
-            combine_rgb_nir(rgb, nir, outputdir)
+        if SHARDS is not None or create_dir(outputdir):
+            results.extend(convert_pairs([(rgb, nir)], outputdir))
     if OPTIONS_FLAGS["Folder_mode"]:
         for folder in FOLDERS:
-            outputdir = os.path.abspath(folder) + "/nir_images/"
-            files = sorted(glob(os.path.abspath(folder)+"/*.ppm"))
-            for file in files:
-                if "nir" in file:
-                    for subfile in files:
-                        if "unsheared" in subfile:
-                            rgb = subfile.replace("unsheared", "nir")
-                            if rgb == file:
-                                print(subfile.split("/")[-1], "|", file.split("/")[-1])
-                                if create_dir(outputdir):
-                                    combine_rgb_nir(subfile, file, outputdir)
-                                else:
-                                    exit(1)
-                        elif "sheared" in subfile:
-                            rgb = subfile.replace("sheared", "nir")
-                            if rgb == file:
-                                print(subfile.split("/")[-1], "|", file.split("/")[-1])
-                                if create_dir(outputdir):
-                                    combine_rgb_nir(subfile, file, outputdir)
-                                else:
-                                    exit(1)
-    if FILE_CONVERT_COUNT == 0:
-        print("Error couldn't find any matching files")
+            folder_results, folder_skipped = convert_folder(folder)
+            results.extend(folder_results)
+            skipped += folder_skipped
+        write_stats_summaries()
+    seconds = time.perf_counter() - started
+    failed = summarize_results(results, seconds, skipped)
+    if OPTIONS_FLAGS["Profile"]:
+        write_profile(results, seconds, PROFILE_REPORT)
+    if failed and not OPTIONS_FLAGS["Watch"]:
+        exit(1)
+
+
+def convert_folder(folder, pool=None):
+    """
+    Pair all files of a folder and convert the pairs that are not up to date
+    Returns:
+    results of the converted pairs and the number of pairs skipped
+    """
+    outputdir = os.path.abspath(folder) + "/nir_images/"
+    pairs, orphans, duplicates = index_pairs(glob(os.path.abspath(folder)+"/*.ppm"))
+    for group in duplicates:
+        print("Duplicate files for one frame, skipped:", ", ".join(file.split("/")[-1] for file in group))
+    for file in orphans:
+        print("No matching file for:", file.split("/")[-1])
+    if OPTIONS_FLAGS["Watch"]:
+        pairs = settled_pairs(pairs)
+    if not pairs:
+        return [], 0
+    if SHARDS is None and not create_dir(outputdir):
+        exit(1)
+    results, skipped = convert_folder_pairs(pairs, outputdir, pool)
+    print("%s: %d pairs, %d up to date, %d orphans, %d duplicates"
+          %(folder, len(pairs), skipped, len(orphans), len(duplicates)))
+    return results, skipped
+
+
+def settled_pairs(pairs):
+    """
+    Split off the pairs of the watch mode with an input changed in the last
+    SETTLE_TIME seconds, it may still be written. They are kept in DEFERRED
+    and converted once their watch events report them complete.
+    Returns:
+    the pairs whose inputs are settled
+    """
+    settled = []
+    for pair in pairs:
+        if is_settled(pair[0]) and is_settled(pair[1]):
+            settled.append(pair)
+        else:
+            DEFERRED.append(pair)
+    return settled
+
+
+def is_settled(path):
+    """Whether a file was not changed in the last SETTLE_TIME seconds"""
+    try:
+        return time.time() - os.stat(path).st_mtime >= SETTLE_TIME
+    except OSError:
+        return False
+
+
+def convert_folder_pairs(pairs, outputdir, pool=None):
+    """
+    Convert the pairs the manifest of outputdir does not show as up to date and record them
+    Returns:
+    results of the converted pairs and the number of pairs skipped
+    """
+    manifest = open_manifest(outputdir)
+    stats_index = open_stats(outputdir) if OPTIONS_FLAGS["Stats"] else None
+    todo, inputs, taken = up_to_date(manifest, pairs, outputdir)
+    results = list(taken)
+    for result in convert_pairs(todo, outputdir, checksum=True, pool=pool):
+        results.append(result)
+        if not result["error"]:
+            name = os.path.basename(result["output"])
+            try:
+                output_mtime_ns = os.stat(result["output"]).st_mtime_ns if SHARDS is None else None
+            except OSError:
+                output_mtime_ns = None
+            manifest.record(name, inputs.pop(name), result["bytes"], result["checksum"], output_mtime_ns)
+            if stats_index is not None and result["stats"]:
+                stats_index.record(name, result["stats"])
+    manifest.save()
+    if stats_index is not None:
+        stats_index.save()
+    return results, len(pairs) - len(todo) - len(taken)
+
+
+def watch_folders():
+    """
+    Convert pairs as soon as both of their files are completely written into
+    the folders, until interrupted. Memory stays flat: only the pending pairs
+    table and the manifest lines not yet saved are kept.
+    Pairs the first pass left as still being written are converted once
+    their files are reported complete or stay unchanged for SETTLE_TIME.
+    Workers ignore Ctrl-C, the pairs they are converting are finished.
+    """
+    folders = [os.path.abspath(folder) for folder in FOLDERS]
+    for folder in folders:
+        if SHARDS is None and not create_dir(folder + "/nir_images/"):
+            exit(1)
+        forget_folder(folder + "/nir_images/")
+    watcher = open_watcher(folders, POLL_INTERVAL)
+    pending = PendingPairs()
+    for folder in folders:  # Files written before the watch started still wait for their counterpart
+        for file in index_pairs(glob(folder + "/*.ppm"))[1]:
+            pending.add(file)
+    ready = defaultdict(list)
+    unsettled = set()
+
+    def add_settled():
+        # Files of pairs skipped while being written are added once settled, unless an event reported them
+        while DEFERRED:
+            unsettled.update(DEFERRED.pop())
+        for path in list(unsettled):
+            if not os.path.exists(path):
+                unsettled.discard(path)
+            elif is_settled(path):
+                unsettled.discard(path)
+                for pair in pending.add(path):
+                    ready[os.path.dirname(path)].append(pair)
+    add_settled()
+    pool = WorkerPool(JOBS) if JOBS > 1 else None
+    counts = Counter()
+    print("Watching %d folders with %s, press Ctrl-C to stop" %(len(folders), watcher.kind))
+    try:
+        while True:
+            for path in watcher.events(timeout=1.0):
+                if path is None:
+                    print("Events were lost, rescanning the folders")
+                    for folder in folders:
+                        close_manifest(folder + "/nir_images/")
+                        results, _ = convert_folder(folder, pool)
+                        forget_folder(folder + "/nir_images/")
+                        counts.update("failed" if result["error"] else "converted" for result in results)
+                elif path.endswith(".ppm"):
+                    unsettled.discard(path)
+                    for pair in pending.add(path):
+                        ready[os.path.dirname(path)].append(pair)
+            add_settled()
+            for folder, pairs in ready.items():
+                if SHARDS is not None:
+                    pairs = unclashed_pairs(pairs, pending, counts)
+                results, _ = convert_folder_pairs(pairs, folder + "/nir_images/", pool)
+                counts.update("failed" if result["error"] else "converted" for result in results)
+            ready.clear()
+            pending.expire()
+    except KeyboardInterrupt:
+        print("\nStopped watching: %d pairs converted, %d failed, %d files waiting for their pair"
+              %(counts["converted"], counts["failed"], sum(len(entry[1]) for entry in pending.table.values() if not entry[2])))
+    finally:
+        watcher.close()
+        if pool is not None:
+            pool.shutdown()
+        for manifest in MANIFESTS.values():
+            manifest.save()
+        write_stats_summaries()
+
+
+def forget_folder(outputdir):
+    """
+    Stop keeping what the manifest, statistics index and frame names of an
+    output folder hold in memory, so a watch runs for days without growing
+    """
+    open_manifest(outputdir).forget()
+    if OPTIONS_FLAGS["Stats"]:
+        open_stats(outputdir).forget()
+    SHARD_SOURCES.clear()
+
+
+def unclashed_pairs(pairs, pending, counts):
+    """
+    Pairs of the watch mode whose frame name is not taken by a file of another
+    folder still in the pending pairs table, the others fail
+    """
+    unclashed = []
+    for rgb, nir in pairs:
+        owner = pending.owner(rgb)
+        if owner is None:
+            unclashed.append((rgb, nir))
+            continue
+        result = new_result(rgb, nir, os.path.basename(rgb)[:-4] + "_with_nir")
+        result["error"] = "frame name %s is already used by %s" %(result["output"], owner)
+        finish_pair(result)
+        counts["failed"] += 1
+    return unclashed
+
+
+def open_manifest(outputdir):
+    """
+    Manifest of an output folder, or the one of the shard folder, which is
+    shared by all input folders. Outputs whose inputs are gone are removed.
+    """
+    directory = SHARD_DIR if SHARDS is not None else outputdir
+    if directory in MANIFESTS:
+        return MANIFESTS[directory]
+    if SHARDS is not None:
+        with ShardReader(SHARD_DIR) as reader:
+            frames = set(reader.by_name)
+        output_exists = lambda name, entry: name in frames
     else:
-        print("Combined %d files into %d files" %(FILE_CONVERT_COUNT*2, FILE_CONVERT_COUNT))
+        def output_exists(name, entry):
+            # The recorded size and mtime of the output are enough, the output is not read again
+            path = os.path.join(outputdir, name)
+            try:
+                output_stat = os.stat(path)
+            except OSError:
+                return False
+            if output_stat.st_size != entry["bytes"]:
+                return False
+            if entry.get("output_mtime_ns") == output_stat.st_mtime_ns:
+                return True
+            # Touched since it was written: only its checksum tells whether it still holds the frame.
+            # Entries recorded before output mtimes were are taken on their size, like before.
+            if entry.get("output_mtime_ns") is not None and entry.get("checksum"):
+                try:
+                    if file_checksum(path) != entry["checksum"]:
+                        return False
+                except OSError:
+                    return False
+            entry["output_mtime_ns"] = output_stat.st_mtime_ns
+            manifest.log(name, entry)
+            return True
+    manifest = MANIFESTS[directory] = Manifest(directory, output_exists, OPTIONS_FLAGS["Hash"])
+    if SHARDS is not None:
+        for name, entry in manifest.entries.items():
+            SHARD_SOURCES[name] = os.path.normpath(os.path.join(directory, entry["rgb"]["path"]))
+    stats_index = None
+    if OPTIONS_FLAGS["Stats"] or os.path.isfile(os.path.join(directory, INDEX_NAME)):
+        stats_index = open_stats(outputdir)
+    for name in manifest.prune():
+        if stats_index is not None:
+            stats_index.remove(name)
+        if SHARDS is None:  # Frames stay in their shard, only their entry is dropped
+            base = os.path.join(outputdir, name[:-4])
+            # .*.pam are the uint8 sidecars of earlier versions
+            for path in [base + ".pam"] + glob(base + ".*.npy") + glob(base + ".*.pgm") + glob(base + ".*.pam"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        print("Inputs are gone, removed:", name)
+    manifest.save()
+    if stats_index is not None:
+        stats_index.save()
+    return manifest
+
+
+def open_stats(outputdir):
+    """Statistics index of an output folder, or the one of the shard folder"""
+    directory = SHARD_DIR if SHARDS is not None else outputdir
+    if directory not in STATS_INDEXES:
+        STATS_INDEXES[directory] = StatsIndex(directory)
+    return STATS_INDEXES[directory]
+
+
+def write_stats_summaries():
+    """Write the dataset summary of every statistics index opened by this run"""
+    for stats_index in STATS_INDEXES.values():
+        totals = stats_index.write_summary()
+        print("Statistics of %d frames written to %s" %(totals.frames, stats_index.summary_path))
+
+
+def close_manifest(outputdir):
+    """Save and forget the manifest of an output folder, it is read again by open_manifest"""
+    manifest = MANIFESTS.pop(SHARD_DIR if SHARDS is not None else outputdir, None)
+    if manifest is not None:
+        manifest.save()
+
+
+def up_to_date(manifest, pairs, outputdir):
+    """
+    Split off the pairs the manifest shows as up to date. With shards, a pair
+    whose frame name is already taken by an RGB file of another folder fails
+    instead of replacing that frame, the watch mode checks with unclashed_pairs.
+    Returns:
+    the pairs to convert, dict of output name -> input state to record and
+    the failed results of the pairs with a taken name
+    """
+    todo = []
+    inputs = {}
+    taken = []
+    for rgb, nir in pairs:
+        name = rgb.split("/")[-1][:-4] + "_with_nir" + ("" if SHARDS is not None else ".pam")
+        if SHARDS is not None and manifest.in_memory:  # The watch mode checks its pending pairs instead
+            owner = SHARD_SOURCES.setdefault(name, os.path.abspath(rgb))
+            if owner != os.path.abspath(rgb) and os.path.exists(owner):
+                result = new_result(rgb, nir, name)
+                result["error"] = "frame name %s is already used by %s" %(name, owner)
+                taken.append(finish_pair(result))
+                continue
+            SHARD_SOURCES[name] = os.path.abspath(rgb)
+        force = OPTIONS_FLAGS["Force"] or (BANDS and SHARDS is None and not all(
+            os.path.isfile(path) for path in sidecar_paths(os.path.join(outputdir, name[:-4]), BANDS, BAND_FORMAT)))
+        stats_index = open_stats(outputdir) if OPTIONS_FLAGS["Stats"] else None
+        force = force or (stats_index is not None and stats_index.in_memory and name not in stats_index.names)
+        state = manifest.stale(rgb, nir, name, force)
+        if state is None:
+            continue
+        todo.append((rgb, nir))
+        inputs[name] = state
+    return todo, inputs, taken
 
 
 def create_dir(_dir):
@@ -114,17 +1040,81 @@ def validate_dir(path):
 
 def check_args(args):
     """Seperate args from folders"""
+    global SHARD_DIR, JOBS, POLL_INTERVAL, QUEUE_DEPTH, BAND_FORMAT
     arg_count = 0
-    for item in args:
-        if item in OPTIONS:
+    rgb_tokens = []
+    nir_tokens = []
+    for idx, item in enumerate(args):
+        if idx > 0 and args[idx - 1] == OPTIONS[7]:
+            SHARD_DIR = item
+        elif idx > 0 and args[idx - 1] == OPTIONS[8]:
+            rgb_tokens.append(item)
+        elif idx > 0 and args[idx - 1] == OPTIONS[9]:
+            nir_tokens.append(item)
+        elif idx > 0 and args[idx - 1] in OPTIONS[10:12]:
+            try:
+                JOBS = int(item)
+            except ValueError:
+                JOBS = 0
+            if JOBS < 1:
+                print("Error {} expects a number above 0".format(args[idx - 1]))
+                exit(1)
+        elif idx > 0 and args[idx - 1] == OPTIONS[17]:
+            try:
+                QUEUE_DEPTH = int(item)
+            except ValueError:
+                QUEUE_DEPTH = -1
+            if QUEUE_DEPTH < 0:
+                print("Error {} expects a number of pairs".format(args[idx - 1]))
+                exit(1)
+        elif idx > 0 and args[idx - 1] == OPTIONS[19]:
+            try:
+                BANDS.append(parse_band(item))
+            except BandError as _e:
+                print("Error", _e)
+                exit(1)
+        elif idx > 0 and args[idx - 1] == OPTIONS[20]:
+            if item not in BAND_FORMATS:
+                print("Error {} expects one of: {}".format(args[idx - 1], ", ".join(BAND_FORMATS)))
+                exit(1)
+            BAND_FORMAT = item
+        elif idx > 0 and args[idx - 1] == OPTIONS[16]:
+            try:
+                POLL_INTERVAL = float(item)
+            except ValueError:
+                POLL_INTERVAL = 0
+            if POLL_INTERVAL <= 0:
+                print("Error {} expects a number of seconds above 0".format(args[idx - 1]))
+                exit(1)
+        elif item in OPTIONS:
             print("arg found", item)
             arg_count += 1
             if item in OPTIONS[:3]:
                 OPTIONS_FLAGS["File_mode"] = True
             if item in OPTIONS[3:5]:
                 OPTIONS_FLAGS["Folder_mode"] = True
+            if item in OPTIONS[5:7]:
+                OPTIONS_FLAGS["Stream"] = True
+            if item == OPTIONS[12]:
+                OPTIONS_FLAGS["Hash"] = True
+            if item == OPTIONS[13]:
+                OPTIONS_FLAGS["Force"] = True
+            if item in OPTIONS[14:17]:
+                OPTIONS_FLAGS["Watch"] = True
+            if item == OPTIONS[18]:
+                OPTIONS_FLAGS["Profile"] = True
+            if item == OPTIONS[21]:
+                OPTIONS_FLAGS["Stats"] = True
         else:
             FOLDERS.append(item)
+    if rgb_tokens:
+        RGB_TOKENS[:] = rgb_tokens
+    if nir_tokens:
+        NIR_TOKENS[:] = nir_tokens
+    if BANDS and SHARD_DIR is not None:
+        print("Error {} can not be combined with {}, sidecars are written next to .pam files".format(
+            OPTIONS[19], OPTIONS[7]))
+        exit(1)
     for subfolder in FOLDERS:
         validate_dir(subfolder)
     if not arg_count > 0:
@@ -135,6 +1125,7 @@ def check_args(args):
 
 def main():
     """Main method"""
+    global SHARDS
     if len(sys.argv) < 3:
         if any(help_option in sys.argv for help_option in OPTIONS[-3:]):
             print("Usage: ppam [OPTION]... [IMAGE/FOLDER]...")
@@ -154,7 +1145,18 @@ def main():
                 print(_v)
             exit(0)
         check_args(sys.argv[1:])
-        pair_file()
+        if OPTIONS_FLAGS["Watch"] and not OPTIONS_FLAGS["Folder_mode"]:
+            print("Error --watch needs folder mode (-d)")
+            exit(1)
+        if SHARD_DIR is None:
+            pair_file()
+            if OPTIONS_FLAGS["Watch"]:
+                watch_folders()
+            return
+        with ShardWriter(SHARD_DIR) as SHARDS:
+            pair_file()
+            if OPTIONS_FLAGS["Watch"]:
+                watch_folders()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,148 @@
 """
 Combine two .ppm files (RGB & NIR) into a single .pam file
 """
+import os
+import re
 import sys
+import mmap
+import warnings
+from collections import OrderedDict
 import numpy as np
 import imageio
 
+WRITE_CHUNK_SIZE = 16 * 1024 * 1024
+STRIP_SIZE = 1024 * 1024
+MAX_OPEN_PAM_FILES = 64
+HEADER_READ_SIZE = 4096
+PPM_WHITESPACE = b" \t\n\r\v\f"
+
+
+class PpmFormatError(Exception):
+    """Raised when a file is not a PPM the native reader understands"""
+
+
+def read_ppm_header(_f):
+    """
+    Parse the header of a PPM file, comments and any whitespace are allowed
+    between the fields.
+    Parameters:
+    _f: binary file positioned at the start of the file
+    Returns:
+    magic (b"P6" or b"P3"), width, height, max_value and the offset of the raster
+    """
+    data = _f.read(HEADER_READ_SIZE)
+    if data[:2] not in (b"P6", b"P3"):
+        raise PpmFormatError("This is not a ppm format")
+    fields = []
+    pos = 2
+    while len(fields) < 3:
+        if pos >= len(data):
+            more = _f.read(HEADER_READ_SIZE)
+            if not more:
+                raise PpmFormatError("Truncated ppm header")
+            data += more
+            continue
+        char = data[pos:pos + 1]
+        if char in PPM_WHITESPACE:
+            pos += 1
+        elif char == b"#":
+            end = data.find(b"\n", pos)
+            while end < 0:
+                more = _f.read(HEADER_READ_SIZE)
+                if not more:
+                    raise PpmFormatError("Truncated ppm header")
+                data += more
+                end = data.find(b"\n", pos)
+            pos = end + 1
+        else:
+            end = pos
+            while True:
+                if end >= len(data):
+                    more = _f.read(HEADER_READ_SIZE)
+                    data += more
+                    if not more:
+                        break
+                if data[end:end + 1] in PPM_WHITESPACE or data[end:end + 1] == b"#":
+                    break
+                end += 1
+            if not data[pos:end].isdigit():
+                raise PpmFormatError("Bad ppm header field: %r" %data[pos:end])
+            fields.append(int(data[pos:end]))
+            pos = end
+    if pos >= len(data):
+        data += _f.read(1)
+    if pos >= len(data) or data[pos:pos + 1] not in PPM_WHITESPACE:
+        raise PpmFormatError("Missing whitespace after ppm header")
+    width, height, max_value = fields
+    if width < 1 or height < 1 or not 0 < max_value < 65536:
+        raise PpmFormatError("Bad ppm dimensions or max value")
+    return data[:2], width, height, max_value, pos + 1
+
+
+def read_ppm(path, mapped=True):
+    """
+    Read a PPM file without decoding it through imageio.
+    Binary P6 rasters are returned as a read-only memory-mapped view of the file,
+    or read into a new array with a single readinto when mapped is False,
+    16-bit samples (max value > 255) as big-endian uint16.
+    ASCII P3 rasters are parsed in one vectorized pass by numpy's text parser.
+    Returns:
+    image of shape (height, width, 3) and the max value
+    """
+    with open(path, "rb") as _f:
+        magic, width, height, max_value, offset = read_ppm_header(_f)
+        dtype = np.dtype(">u2") if max_value > 255 else np.dtype(np.uint8)
+        if magic == b"P3":
+            _f.seek(offset)
+            data = _f.read()
+            if b"#" in data:
+                data = re.sub(rb"#[^\n]*", b"", data)
+            with warnings.catch_warnings():
+                # numpy warns, or raises in newer versions, when a token is not a number
+                warnings.simplefilter("error", DeprecationWarning)
+                try:
+                    samples = np.fromstring(data, dtype=np.int64, sep=" ")
+                except (DeprecationWarning, ValueError):
+                    raise PpmFormatError("Bad sample in ppm raster")
+            if samples.size < width * height * 3:
+                raise PpmFormatError("Truncated ppm raster, %d of %d samples" %(samples.size, width * height * 3))
+            samples = samples[:width * height * 3]
+            if samples.min() < 0 or samples.max() > max_value:
+                raise PpmFormatError("Ppm sample out of range 0..%d" %max_value)
+            samples = samples.astype(np.uint16 if max_value > 255 else np.uint8)
+            return samples.reshape(height, width, 3), max_value
+        if not mapped:
+            image = np.empty((height, width, 3), dtype=dtype)
+            _f.seek(offset)
+            read_strip(_f, image)
+            return image, max_value
+        # Map the file the header was read from, not whatever is at path by now
+        mapping = map_open_file(_f)
+    if len(mapping) - offset < width * height * 3 * dtype.itemsize:
+        mapping.close()
+        raise PpmFormatError("Truncated ppm raster")
+    image = np.frombuffer(mapping, dtype=dtype, count=width * height * 3,
+                          offset=offset).reshape(height, width, 3)
+    return image, max_value
+
+
+def load_ppm(path, mapped=True):
+    """
+    Read a PPM file with read_ppm, falling back to imageio for anything it does not handle.
+    Returns:
+    image of shape (height, width, 3) and the max value
+    """
+    try:
+        return read_ppm(path, mapped)
+    except PpmFormatError as _e:
+        print("Native ppm reader failed for %s (%s), falling back to imageio" %(path, _e))
+    image = np.asarray(imageio.imread(path))
+    if image.ndim == 2:
+        image = np.repeat(image[:, :, np.newaxis], 3, axis=2)
+    max_value = 65535 if image.dtype == np.uint16 else 255
+    return image, max_value
+
+
 class PpmToPam(object):
     """
     Combine two .ppm files (RGB & NIR) into a single .pam file
@@ -22,12 +160,14 @@ class PpmToPam(object):
 
         self.rgb_img = None
         self.nir_img = None
+        self.valid = False
 
         if rgbfile[-4:] != ".ppm":
             print("Files does not have a ppm file extension")
             return
 
-        if not self.read_files(rgbfile, nirfile):
+        self.valid = self.read_files(rgbfile, nirfile)
+        if not self.valid:
             print("Error when reading files!")
 
     def __str__(self):
@@ -36,65 +176,398 @@ class PpmToPam(object):
     def read_files(self, rgbfile, nirfile):
         """Read two files, rgb and nir"""
         try:
-            with open(rgbfile, "rb") as _f:
-                line = _f.readline().decode("latin-1")
-                if not line[:2] in ["P6", "P3"]:
-                    print("This is not a ppm format, returning")
-                    return False
-
-                line = _f.readline().decode("latin-1")
-                self.width = int(line.strip().split(" ")[0])
-                self.height = int(line.strip().split(" ")[1])
-
-                line = _f.readline().decode("latin-1")
-                self.max_value = int(line)
-            self.rgb_img = imageio.imread(rgbfile)
-
-            with open(nirfile, "rb") as _f:
-                line = _f.readline().decode("latin-1")
-                if not line[:2] in ["P6", "P3"]:
-                    print("This is not a ppm format, returning")
-                    return False
-
-                line = _f.readline().decode("latin-1")
-                if self.width != int(line.strip().split(" ")[0]):
-                    print("Files do not have the same dimensions (width)")
-                    return False
-
-                if self.height != int(line.strip().split(" ")[1]):
-                    print("Files do not have the same dimension (height)")
-                    return False
-
-                line = _f.readline().decode("latin-1")
-                if self.max_value != int(line):
-                    print("Files do not have the same max values")
-                    return False
-            self.nir_img = imageio.imread(nirfile)
+            self.rgb_img, self.max_value = load_ppm(rgbfile)
+            self.height, self.width = self.rgb_img.shape[:2]
+
+            self.nir_img, nir_max_value = load_ppm(nirfile)
+            if self.width != self.nir_img.shape[1]:
+                print("Files do not have the same dimensions (width)")
+                return False
+
+            if self.height != self.nir_img.shape[0]:
+                print("Files do not have the same dimension (height)")
+                return False
+
+            if self.max_value != nir_max_value:
+                print("Files do not have the same max values")
+                return False
 
         except Exception as _e:
             print("Execption while reading rgbfile: %s \n%s" %(rgbfile, str(_e)))
             return False
         return True
 
+
+class PamWriter(object):
+    """
+    Write a .pam (P7) file: the header followed by the raster as interleaved tuples.
+    Samples are written as bytes, or 16-bit big-endian when MAXVAL > 255.
+    The file is written to a temporary name next to the target and renamed
+    into place on close, so readers never see a partial file.
+    """
+    def __init__(self, path, width, height, depth, max_value, tuple_type=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.max_value = max_value
+        self.tuple_type = tuple_type
+        self.dtype = np.dtype(">u2") if max_value > 255 else np.dtype(np.uint8)
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.tmp_path = "%s.tmp-%d" %(path, os.getpid())
+        self._f = open(self.tmp_path, "wb")
+        self._f.write(self.header())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def header(self):
+        """Header of the file as bytes"""
+        header = b"P7\n"
+        header += b"WIDTH %d\n" %self.width
+        header += b"HEIGHT %d\n" %self.height
+        header += b"DEPTH %d\n" %self.depth
+        header += b"MAXVAL %d\n" %self.max_value
+        if self.tuple_type:
+            header += b"TUPLTYPE %s\n" %self.tuple_type.encode("ascii")
+        header += b"ENDHDR\n"
+        return header
+
+    def write_rows(self, rows):
+        """
+        Append rows to the raster
+        Parameters:
+        rows: array of shape (rows, width, depth), or (rows, width) when depth is 1
+        """
+        rows = np.asarray(rows)
+        if rows.ndim == 2 and self.depth == 1:
+            rows = rows[:, :, np.newaxis]
+        if rows.shape[1:] != (self.width, self.depth):
+            raise ValueError("Rows of shape %s do not match width %d and depth %d"
+                             %(rows.shape, self.width, self.depth))
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError("More than %d rows written" %self.height)
+        if rows.dtype == self.dtype and rows.flags.c_contiguous:
+            self._f.write(memoryview(rows).cast("B"))  # Zero-copy, one write
+        else:
+            row_bytes = self.width * self.depth * self.dtype.itemsize
+            step = max(1, WRITE_CHUNK_SIZE // row_bytes)
+            for start in range(0, rows.shape[0], step):
+                chunk = np.ascontiguousarray(rows[start:start + step], dtype=self.dtype)
+                self._f.write(memoryview(chunk).cast("B"))
+        self.rows_written += rows.shape[0]
+        self.bytes_written += rows.shape[0] * self.width * self.depth * self.dtype.itemsize
+
+    def close(self):
+        """Finish the file and rename it into place"""
+        if self._f is None:
+            return
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError("Only %d of %d rows written to %s" %(self.rows_written, self.height, self.path))
+        self._f.close()
+        self._f = None
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """Drop the partial file"""
+        if self._f is None:
+            return
+        self._f.close()
+        self._f = None
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class PgmWriter(PamWriter):
+    """Write a single channel image as a .pgm (P5) file, like PamWriter"""
+    def __init__(self, path, width, height, max_value):
+        super().__init__(path, width, height, 1, max_value)
+
+    def header(self):
+        """Header of the file as bytes"""
+        return b"P5\n%d %d\n%d\n" %(self.width, self.height, self.max_value)
+
+
+class TeeWriter(object):
+    """Pass the rows on to several writers, e.g. the sidecars of merge_rgb_nir_strips"""
+    def __init__(self, writers):
+        self.writers = list(writers)
+
+    def write_rows(self, rows):
+        """Write the rows to every writer"""
+        for writer in self.writers:
+            writer.write_rows(rows)
+
+    def close(self):
+        """Close every writer"""
+        for writer in self.writers:
+            writer.close()
+
+    def abort(self):
+        """Abort every writer"""
+        for writer in self.writers:
+            writer.abort()
+
+
+def write_pam(path, image, max_value, tuple_type=None):
+    """
+    Write an image array of shape (height, width, depth) as a .pam file
+    Returns the number of bytes written
+    """
+    height, width = image.shape[:2]
+    depth = image.shape[2] if image.ndim == 3 else 1
+    with PamWriter(path, width, height, depth, max_value, tuple_type) as writer:
+        writer.write_rows(image)
+    return writer.bytes_written + len(writer.header())
+
+
+def read_strip(_f, buf):
+    """Fill buf from a binary file, raise PpmFormatError if the file ends first"""
+    view = memoryview(buf).cast("B")
+    filled = 0
+    while filled < len(view):
+        count = _f.readinto(view[filled:])
+        if not count:
+            raise PpmFormatError("Truncated ppm raster")
+        filled += count
+
+
+def merge_rgb_nir_strips(rgbfile, nirfile, output, strip_size=STRIP_SIZE, open_writer=None, open_sidecar=None):
+    """
+    Merge a binary RGB and NIR ppm into a 4 channel .pam file strip by strip.
+    Both inputs are read a few rows at a time into preallocated buffers and the NIR
+    channel is interleaved into a reused output strip, so memory stays around
+    2 * strip_size whatever the image size.
+    open_writer(width, height, depth, max_value) can return another writer with
+    write_rows, e.g. a shard frame, instead of a PamWriter on output.
+    open_sidecar(width, height, max_value) can return a second writer that gets
+    every merged strip too, e.g. to compute derived bands.
+    Raises PpmFormatError for files that are not binary P6 ppms.
+    Returns:
+    width, height and max value of the image
+    """
+    with open(rgbfile, "rb") as rgb_f, open(nirfile, "rb") as nir_f:
+        magic, width, height, max_value, offset = read_ppm_header(rgb_f)
+        nir_magic, nir_width, nir_height, nir_max_value, nir_offset = read_ppm_header(nir_f)
+        if magic != b"P6" or nir_magic != b"P6":
+            raise PpmFormatError("Strip merging needs binary P6 files")
+        if (width, height, max_value) != (nir_width, nir_height, nir_max_value):
+            raise PpmFormatError("Files do not have the same dimensions or max values")
+        rgb_f.seek(offset)
+        nir_f.seek(nir_offset)
+        dtype = np.dtype(">u2") if max_value > 255 else np.dtype(np.uint8)
+        strip_rows = max(1, strip_size // (width * 4 * dtype.itemsize))
+        rgb_buf = np.empty((strip_rows, width, 3), dtype=dtype)
+        nir_buf = np.empty((strip_rows, width, 3), dtype=dtype)
+        out_buf = np.empty((strip_rows, width, 4), dtype=dtype)
+        if open_writer is None:
+            writer = PamWriter(output, width, height, 4, max_value)
+        else:
+            writer = open_writer(width, height, 4, max_value)
+        sidecar = None
+        try:
+            with writer:
+                if open_sidecar is not None:
+                    sidecar = open_sidecar(width, height, max_value)
+                for row in range(0, height, strip_rows):
+                    rows = min(strip_rows, height - row)
+                    read_strip(rgb_f, rgb_buf[:rows])
+                    read_strip(nir_f, nir_buf[:rows])
+                    out_buf[:rows, :, :3] = rgb_buf[:rows]
+                    out_buf[:rows, :, 3] = nir_buf[:rows, :, 0]
+                    writer.write_rows(out_buf[:rows])
+                    if sidecar is not None:
+                        sidecar.write_rows(out_buf[:rows])
+            if sidecar is not None:
+                sidecar.close()
+        except BaseException:
+            if sidecar is not None:
+                sidecar.abort()
+            raise
+    return width, height, max_value
+
+
+def read_pam_header(_f):
+    """
+    Parse the header of a .pam (P7) file
+    Parameters:
+    _f: binary file positioned at the start of the file
+    Returns:
+    dict with WIDTH, HEIGHT, DEPTH, MAXVAL, TUPLTYPE and the offset of the raster
+    """
+    if _f.readline().rstrip() != b"P7":
+        raise PpmFormatError("This is not a pam format")
+    header = {"TUPLTYPE": ""}
+    while True:
+        line = _f.readline()
+        if not line:
+            raise PpmFormatError("Truncated pam header")
+        line = line.strip()
+        if not line or line.startswith(b"#"):
+            continue
+        if line == b"ENDHDR":
+            break
+        key, _, value = line.partition(b" ")
+        key = key.decode("ascii", "replace")
+        if key == "TUPLTYPE":
+            header["TUPLTYPE"] = (header["TUPLTYPE"] + " " + value.strip().decode("ascii", "replace")).strip()
+        elif key in ("WIDTH", "HEIGHT", "DEPTH", "MAXVAL"):
+            header[key] = int(value)
+    for key in ("WIDTH", "HEIGHT", "DEPTH", "MAXVAL"):
+        if key not in header:
+            raise PpmFormatError("Pam header misses %s" %key)
+    header["OFFSET"] = _f.tell()
+    return header
+
+
+def map_file(path):
+    """Map a file read-only, without keeping a file descriptor open where supported"""
+    with open(path, "rb") as _f:
+        return map_open_file(_f)
+
+
+def map_open_file(_f):
+    """Map an open file read-only, the mapping stays valid once the file is closed"""
+    try:
+        return mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ, trackfd=False)
+    except TypeError:  # trackfd needs python 3.13
+        return mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PamFile(object):
+    """
+    Lazy read-only access to a .pam file.
+    The raster is exposed as a memory-mapped (height, width, depth) array,
+    so crops, channels and tiles are views that only page in what is used.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as _f:
+            header = read_pam_header(_f)
+        self.width = header["WIDTH"]
+        self.height = header["HEIGHT"]
+        self.depth = header["DEPTH"]
+        self.max_value = header["MAXVAL"]
+        self.tuple_type = header["TUPLTYPE"]
+        self.offset = header["OFFSET"]
+        self.dtype = np.dtype(">u2") if self.max_value > 255 else np.dtype(np.uint8)
+        self._mmap = map_file(path)
+        count = self.width * self.height * self.depth
+        if len(self._mmap) - self.offset < count * self.dtype.itemsize:
+            self._mmap.close()
+            raise PpmFormatError("Truncated pam raster: %s" %path)
+        self.data = np.frombuffer(self._mmap, dtype=self.dtype, count=count,
+                                  offset=self.offset).reshape(self.height, self.width, self.depth)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    @property
+    def shape(self):
+        """Shape of the raster"""
+        return self.data.shape
+
+    def channel(self, idx):
+        """View of a single channel"""
+        return self.data[:, :, idx]
+
+    def crop(self, top, left, height, width):
+        """View of a rectangle of the image"""
+        return self.data[top:top + height, left:left + width]
+
+    def tiles(self, size, stride=None):
+        """
+        View of all size x size tiles, stride pixels apart (default size)
+        Returns:
+        array of shape (rows, cols, size, size, depth), no data is copied
+        """
+        stride = stride or size
+        windows = np.lib.stride_tricks.sliding_window_view(self.data, (size, size), axis=(0, 1))
+        return np.moveaxis(windows[::stride, ::stride], 2, 4)
+
+    def close(self):
+        """
+        Unmap the file. If views of it are still in use the mapping is
+        released once they are gone instead.
+        """
+        if self._mmap is None:
+            return
+        self.data = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._mmap = None
+
+
+class PamCollection(object):
+    """
+    Random access to many .pam files, at most max_open of them are mapped
+    at a time and the least recently used one is closed first.
+    """
+    def __init__(self, paths, max_open=MAX_OPEN_PAM_FILES):
+        self.paths = list(paths)
+        self.max_open = max_open
+        self.open_files = OrderedDict()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getitem__(self, idx):
+        """PamFile of the idx-th path"""
+        pam = self.open_files.get(idx)
+        if pam is not None:
+            self.open_files.move_to_end(idx)
+            return pam
+        pam = PamFile(self.paths[idx])
+        self.open_files[idx] = pam
+        while len(self.open_files) > self.max_open:
+            _, oldest = self.open_files.popitem(last=False)
+            oldest.close()
+        return pam
+
+    def close(self):
+        """Close every open file"""
+        while self.open_files:
+            _, pam = self.open_files.popitem()
+            pam.close()
+
+
+def open_many(paths, max_open=MAX_OPEN_PAM_FILES):
+    """Open many .pam files for random access, see PamCollection"""
+    return PamCollection(paths, max_open)
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 3:
         print("Not enough files")
         exit()
     PAM = PpmToPam(sys.argv[1], sys.argv[2])
-    RGBN = np.ndarray(shape=(4, PAM.height * PAM.width), dtype=np.uint8)
     RGBN = np.concatenate((PAM.rgb_img, PAM.nir_img[:, :, :1]), axis=2)
-    RGBN = np.moveaxis(RGBN, 2, 0)
 
     NEW_FILE = PAM.rgbfile.split("/")[-1][:-4]
-    F = open("/tmp/nir/nir-09-12-21/%s_RGBN.pam" %NEW_FILE, "wb")
-    F.write(b"P7\n")
-    F.write(b"WIDTH %d\n" %PAM.width)
-    F.write(b"HEIGHT %d\n" %PAM.height)
-    F.write(b"DEPTH 4\n")
-    F.write(b"MAXVAL %d\n" %PAM.max_value)
-    F.write(b"ENDHDR\n")
-    print("Output file:", F.name)
-
-    for i in RGBN.flatten():
-        F.write(b"%c" %i)
-    F.close()
+    OUTPUT = "/tmp/nir/nir-09-12-21/%s_RGBN.pam" %NEW_FILE
+    print("Output file:", OUTPUT)
+    write_pam(OUTPUT, RGBN, PAM.max_value)
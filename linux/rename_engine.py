@@ -0,0 +1,253 @@
+"""
+Rename engine
+Plan a batch of renames in memory, check it for collisions, order chains and
+break cycles, then execute it with os.rename while keeping a journal so an
+interrupted batch can be rolled back or resumed.
+"""
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RenameError(Exception):
+    """Raised when a rename plan is invalid or a journal can not be used"""
+
+
+class RenamePlan(object):
+    """
+    Ordered list of (source, target) steps.
+    A step whose target is the source of another step is only executed after
+    that step, and cycles (e.g. a->b, b->a) are broken with a temporary name.
+    """
+    def __init__(self):
+        self.renames = {}
+        self.steps = []
+
+    def add(self, source, target):
+        """
+        Add a rename to the plan, renames to the same name are dropped
+        Parameters:
+        source: path of the file to rename
+        target: new path of the file
+        """
+        if source == target:
+            return
+        if source in self.renames:
+            raise RenameError("{} is renamed twice".format(source))
+        self.renames[source] = target
+
+    def check(self):
+        """
+        Check the plan for collisions
+        Returns:
+        list of error messages, empty if the plan can be executed
+        """
+        errors = []
+        targets = {}
+        for source, target in self.renames.items():
+            if target in targets:
+                errors.append("{} and {} are both renamed to {}".format(targets[target], source, target))
+                continue
+            targets[target] = source
+            if target not in self.renames and os.path.lexists(target):
+                errors.append("{} already exists".format(target))
+            if not os.path.lexists(source):
+                errors.append("{} does not exist".format(source))
+        return errors
+
+    def order(self):
+        """
+        Order the renames so no target is overwritten before it is moved away
+        Every source has one target and every target one source, so the renames
+        form independent chains and cycles.
+        Returns:
+        list of chains, each a list of (source, target) steps to run in order
+        """
+        sources_of = {target: source for source, target in self.renames.items()}
+        done = set()
+        chains = []
+        for start in self.renames:
+            if start in done:
+                continue
+            # Walk forward to the end of the chain, or back to start for a cycle
+            end = start
+            while self.renames.get(end) in self.renames and self.renames[end] != start:
+                end = self.renames[end]
+            cycle = self.renames.get(end) == start
+            chain = []
+            if cycle:
+                temp = temp_name(start)
+                chain.append((start, temp))
+                done.add(start)
+                node = sources_of[start]
+                while node != start:
+                    chain.append((node, self.renames[node]))
+                    done.add(node)
+                    node = sources_of[node]
+                chain.append((temp, self.renames[start]))
+            else:
+                node = end
+                while True:
+                    chain.append((node, self.renames[node]))
+                    done.add(node)
+                    if node not in sources_of or sources_of[node] in done:
+                        break
+                    node = sources_of[node]
+            chains.append(chain)
+        self.steps = [step for chain in chains for step in chain]
+        return chains
+
+
+def temp_name(path):
+    """Temporary name next to path used to break a rename cycle"""
+    folder, name = os.path.split(path)
+    return os.path.join(folder, ".{}.rf-tmp-{}".format(name, os.getpid()))
+
+
+class Journal(object):
+    """
+    Journal of a rename batch, one JSON object per line.
+    The first line holds every step and the length of every chain,
+    later lines the index of finished steps.
+    Finished steps are written out right away but not synced, a step that ran
+    without being recorded is recognised because its source is gone and its
+    target exists.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.steps = []
+        self.chains = []
+        self.finished = set()
+        self.lock = threading.Lock()
+        self._f = None
+
+    def set_chains(self, lengths):
+        """Split the step indices into chains of the given lengths"""
+        self.chains = []
+        start = 0
+        for length in lengths:
+            self.chains.append(list(range(start, start + length)))
+            start += length
+
+    def start(self, chains):
+        """
+        Write the planned steps
+        Parameters:
+        chains: list of chains as returned by RenamePlan.order
+        """
+        if os.path.exists(self.path):
+            raise RenameError("journal {} already exists, resume or roll it back first".format(self.path))
+        self.steps = [step for chain in chains for step in chain]
+        self.set_chains([len(chain) for chain in chains])
+        self._f = open(self.path, "w")
+        self._f.write(json.dumps({"steps": self.steps, "chains": [len(chain) for chain in chains]}) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def load(self):
+        """Read the steps and finished steps of an existing journal"""
+        try:
+            with open(self.path, "r") as _f:
+                lines = _f.read().splitlines()
+        except OSError as _e:
+            raise RenameError("can not read journal {}: {}".format(self.path, _e))
+        try:
+            header = json.loads(lines[0])
+            self.steps = [tuple(step) for step in header["steps"]]
+            self.set_chains(header["chains"])
+            for line in lines[1:]:
+                if line:
+                    self.finished.add(json.loads(line)["done"])
+        except (IndexError, KeyError, ValueError):
+            # A torn last line only loses finished markers, which resume recovers from the disk
+            if not self.steps:
+                raise RenameError("journal {} is corrupt".format(self.path))
+        self._f = open(self.path, "a")
+
+    def mark(self, idx):
+        """Record a finished step"""
+        with self.lock:
+            self.finished.add(idx)
+            self._f.write(json.dumps({"done": idx}) + "\n")
+            self._f.flush()
+
+    def close(self, remove=False):
+        """Close the journal and remove it once the batch is complete"""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if remove:
+            os.remove(self.path)
+
+
+def step_done(source, target):
+    """Check whether a step already ran, its source is gone and its target exists"""
+    return not os.path.lexists(source) and os.path.lexists(target)
+
+
+def execute_chain(journal, chain, verbose=False, resume=False):
+    """
+    Execute the steps of one chain in order, a failed step stops the rest of
+    the chain since the following steps depend on it
+    Returns:
+    (source, target, error) of the failed step, None when all steps succeeded
+    """
+    for idx in chain:
+        source, target = journal.steps[idx]
+        if idx in journal.finished:
+            continue
+        if resume and step_done(source, target):
+            journal.mark(idx)
+            continue
+        if os.path.lexists(target):
+            return source, target, "target exists"
+        try:
+            os.rename(source, target)
+        except OSError as _e:
+            return source, target, _e.strerror
+        journal.mark(idx)
+        if verbose:
+            print("{} -> {}\n".format(source, target), end="")
+    return None
+
+
+def execute(journal, jobs=1, verbose=False, resume=False):
+    """
+    Execute the steps of a journal, independent chains run on a pool of threads
+    Parameters:
+    journal: Journal the steps are recorded in
+    jobs: number of chains renamed at the same time
+    verbose: print every rename
+    resume: skip steps the journal or the disk show as done
+    Returns:
+    list of (source, target, error) of the failed steps
+    """
+    if jobs <= 1:
+        results = [execute_chain(journal, chain, verbose, resume) for chain in journal.chains]
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(lambda chain: execute_chain(journal, chain, verbose, resume),
+                                    journal.chains))
+    return [failed for failed in results if failed is not None]
+
+
+def rollback(journal, verbose=False):
+    """
+    Undo the finished steps of a journal in reverse order
+    Returns:
+    (source, target, error) of the step that could not be undone, None on success
+    """
+    for idx in reversed(range(len(journal.steps))):
+        source, target = journal.steps[idx]
+        if idx not in journal.finished and not step_done(source, target):
+            continue
+        if os.path.lexists(source):
+            return target, source, "target exists"
+        try:
+            os.rename(target, source)
+        except OSError as _e:
+            return target, source, _e.strerror
+        if verbose:
+            print("{} -> {}".format(target, source))
+    return None
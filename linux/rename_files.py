@@ -5,157 +5,348 @@ This can be done in several ways:
     prefix: adding a prefix to the file/files.
     suffix: adding a suffix to the file/files.
     full-rename: rename all files to a given string with a integer suffix.
+    template: build the new name from a template and an optional regex.
+Paths are consumed as a stream and renamed in batches, so any number of
+files can be piped through --files-from.
 """
-import subprocess as sp
 import sys
 import os
+import re
+from string import Formatter
+from rename_engine import RenamePlan, RenameError, Journal, execute, rollback
 
 PREFIX = ""
 SUFFIX = ""
 FULL_OVERWRITE = ""
+TEMPLATE = ""
+REGEX = ""
+FILES_FROM = ""
+JOURNAL = ".rf_journal.jsonl"
+JOBS = 1
+BATCH = 10000
 
-FILES = []
+PATHS = []
+SEQUENCES = {}
+TEMPLATE_FIELDS = ["dir", "name", "stem", "ext", "seq", "idx"]
 
-OPTIONS = ["-px", "--prefix", "-sx", "--suffix", "-rename", "-h", "-H", "--help"]
-OPTIONS_FLAGS = {"prefix": False, "suffix": False, "full_overwrite": False}
+OPTIONS = ["-px", "--prefix", "-sx", "--suffix", "-rename", "--journal", "--resume", "--rollback", "-v", "--verbose",
+           "-j", "--jobs", "-t", "--template", "-e", "--regex", "-r", "--recursive", "--files-from", "-0",
+           "--batch", "-h", "-H", "--help"]
+OPTIONS_FLAGS = {"prefix": False, "suffix": False, "full_overwrite": False, "resume": False, "rollback": False,
+                 "verbose": False, "recursive": False, "null": False}
 OPTIONS_HELP_TEXT = {
     "--prefix": "{} {:>3} \tAdd a prefix to the file/files.".format(OPTIONS[0], OPTIONS[1]),
     "--suffix": "{} {:>3} \tAdd a suffix to the file/files.".format(OPTIONS[2], OPTIONS[3]),
     "--rename": "{} \tRename the file/files. If multiple files will be suffixed with an integer.".format(OPTIONS[4]),
+    "--template": "{} {:>3} \tBuild new names from a template, e.g. '{{stem}}_{{seq:06d}}{{ext}}'.\n"
+                  "\t\t\tFields: {} (dir is the name of the folder), regex groups as {{1}}.. or by name.".format(
+                      OPTIONS[12], OPTIONS[13], ", ".join(TEMPLATE_FIELDS)),
+    "--regex": "{} {:>3} \tOnly rename names matching the regex, its groups are template fields.".format(
+        OPTIONS[14], OPTIONS[15]),
+    "--recursive": "{} {:>3} \tDescend into subfolders of the given folders.".format(OPTIONS[16], OPTIONS[17]),
+    "--files-from": "{} \tRead paths from a file, '-' for stdin, one per line.".format(OPTIONS[18]),
+    "-0": "{} \t\tPaths read with --files-from are separated by NUL characters.".format(OPTIONS[19]),
+    "--batch": "{} \tNumber of files planned and renamed at a time (default {}).\n"
+               "\t\t\tRenames are checked per batch: a chain or cycle of names that crosses batches\n"
+               "\t\t\tis reported as an existing target, use a larger batch for it.".format(OPTIONS[20], BATCH),
+    "--journal": "{} \tJournal file of the batch (default {}).".format(OPTIONS[5], JOURNAL),
+    "--resume": "{} \tContinue an interrupted batch from its journal.".format(OPTIONS[6]),
+    "--rollback": "{} \tUndo an interrupted batch from its journal.".format(OPTIONS[7]),
+    "--verbose": "{} {:>3} \tPrint every rename.".format(OPTIONS[8], OPTIONS[9]),
+    "--jobs": "{} {:>3} N \tRename up to N independent files at the same time.".format(OPTIONS[10], OPTIONS[11]),
     "--help": "{}{:>3} {} \tDisplay this help and exit.".format(OPTIONS[-3], OPTIONS[-2], OPTIONS[-1])
 }
 
 
-def rename_file(file, new_name):
+def escape(text):
+    """Escape braces so text is taken literally in a template."""
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def build_template():
     """
-    Rename a file.
+    Compile the template for the selected mode.
+    The prefix, suffix and -rename modes are expressed as templates.
+
+    Returns:
+        template: format string of the new file name, None if no mode is selected.
+        regex: compiled regex names must match, None if not given.
+    """
+    regex = None
+    if REGEX:
+        try:
+            regex = re.compile(REGEX)
+        except re.error as _e:
+            print("Error invalid regex {}: {}".format(REGEX, _e))
+            exit(1)
+    if TEMPLATE:
+        template = TEMPLATE
+    elif OPTIONS_FLAGS["prefix"] or OPTIONS_FLAGS["suffix"]:
+        template = escape(PREFIX) + "{stem}" + escape(SUFFIX) + "{ext}"
+    elif OPTIONS_FLAGS["full_overwrite"]:
+        name, ext = os.path.splitext(FULL_OVERWRITE)
+        template = escape(name) + "_{idx}" + escape(ext)
+    else:
+        if regex is not None:
+            print("Error {} needs a {}".format(OPTIONS[15], OPTIONS[13]))
+            exit(1)
+        return None, None
+    groups = ["x"] * ((regex.groups if regex is not None else 0) + 1)
+    named = dict.fromkeys(regex.groupindex if regex is not None else [], "x")
+    try:
+        list(Formatter().parse(template))
+        template.format(*groups, dir="x", name="x", stem="x", ext=".x", seq=0, idx=0, **named)
+    except (ValueError, KeyError, IndexError) as _e:
+        print("Error invalid template {}: {}".format(template, _e))
+        exit(1)
+    return template, regex
+
+
+def new_file_name(idx, file, template, regex):
+    """
+    Compute the new name of a file from the template.
 
     Parameters:
-        file: path of file that needs renaming.
-        new_name: new name of the file.
+        idx: position of the file in the stream of files.
+        file: path of the file.
+        template: format string from build_template.
+        regex: compiled regex from build_template, or None.
+    Returns:
+        new path of the file, None if the name does not match the regex.
+    """
+    folder, name = os.path.split(file)
+    groups = [name]
+    named = {}
+    if regex is not None:
+        match = regex.search(name)
+        if match is None:
+            return None
+        groups = [match.group(0)] + [group or "" for group in match.groups()]
+        named = {key: value or "" for key, value in match.groupdict().items()}
+    seq = SEQUENCES.get(folder, 0)
+    SEQUENCES[folder] = seq + 1
+    stem, ext = os.path.splitext(name)
+    fields = {"dir": os.path.basename(os.path.abspath(folder)), "name": name, "stem": stem, "ext": ext, "seq": seq, "idx": idx}
+    fields.update(named)
+    new_name = template.format(*groups, **fields)
+    if not new_name or "/" in new_name:
+        raise RenameError("template gives an invalid name for {}: {}".format(file, new_name))
+    return os.path.join(folder, new_name)
+
+
+def run_journal(journal, resume=False):
     """
-    cmd = "mv {} {}".format(file, new_name)
-    print(cmd)
-    ret_val = sp.run(["/bin/bash", "-c", cmd], capture_output=True)
-    if ret_val.returncode == 0:
-        return True
-    return False
+    Execute the steps recorded in a journal,
+    the journal is removed once every step succeeded.
+
+    Returns:
+        number of renamed files and number of failed renames.
+    """
+    failures = execute(journal, jobs=JOBS, verbose=OPTIONS_FLAGS["verbose"], resume=resume)
+    for failed in failures:
+        print("Error renaming {} to {}: {}".format(*failed))
+    if failures:
+        journal.close()
+        print("Renamed {} files in this batch".format(len(journal.finished)))
+        print("Error renaming {0} files! Undo with: rf --rollback --journal {1}, "
+              "or retry the rest with: rf --resume --journal {1}".format(len(failures), journal.path))
+        return len(journal.finished), len(failures)
+    journal.close(remove=True)
+    return len(journal.finished), 0
 
 
-def extract_file_name(file):
+def rename_batch(batch, template, regex, start, journal_path):
     """
-    Extract filename from a string.
-    Folder, filename and extension(if present) is extracted and returned.
+    Plan, check and execute the renames of one batch of files,
+    the batch is not touched if it contains collisions.
+
     Parameters:
-        file: path to file in form of a string.
+        batch: list of paths.
+        template, regex: from build_template.
+        start: position of the first file in the stream of files.
+        journal_path: journal file of the batch.
     Returns:
-        folder: folder containing the file.
-        name: name of the file.
-        ext: if the file has an extension else None.
-        """
-    if file[0] == ".":
-        folder, name = file.split("/")
-        folder = "{}/".format(folder)
-        if "." in name:
-            name, ext = name.split(".")
-            return folder, name, ext
-        return folder, name, None
-    elif "." in file:
-        name, ext = file.split(".")
-        folder, name = "/".join(name.split("/")[:-1]), name.split("/")[-1]
-        return folder, name, ext
-    folder, name = "/".join(file.split("/")[:-1]), file.split("/")[-1]
-    if "/" not in folder:
-        folder = folder+"/"
-    return folder, name, None
+        number of renamed files and number of errors.
+    """
+    plan = RenamePlan()
+    try:
+        for idx, file in enumerate(batch, start):
+            new_name = new_file_name(idx, file, template, regex)
+            if new_name is not None:
+                plan.add(file, new_name)
+    except RenameError as _e:
+        print("Error {}".format(_e))
+        print("Error renaming files! Nothing was renamed in this batch.")
+        return 0, 1
+    errors = plan.check()
+    if errors:
+        for error in errors:
+            print("Error {}".format(error))
+        print("Error renaming files! Nothing was renamed in this batch.")
+        return 0, len(errors)
+    journal = Journal(journal_path)
+    try:
+        journal.start(plan.order())
+    except (RenameError, OSError) as _e:
+        print("Error {}".format(_e))
+        return 0, 1
+    return run_journal(journal)
 
 
 def rename_files():
     """
-    Renames files in the global list FILES
+    Renames the streamed files in batches of BATCH files.
+    Renames are checked within a batch, a name taken by an earlier batch
+    is reported as an existing target.
+    A failed batch does not stop the later ones, the journal it leaves for
+    --resume or --rollback is kept and the next batches use JOURNAL.1, JOURNAL.2..
+    Exits with 1 once all batches ran if any of them failed.
     """
-    if OPTIONS_FLAGS["prefix"]:
-        for file in FILES:
-            if OPTIONS_FLAGS["suffix"]:
-                folder, name, ext = extract_file_name(file)
-                if "." in file[1:]: # with extension
-                    new_file_name = folder+PREFIX+name+SUFFIX+"."+ext
-                else: # no extension
-                    new_file_name = folder+PREFIX+name+SUFFIX
-            else:
-                folder, name, ext = extract_file_name(file)
-                if "." in file[1:]: # with extension
-                    new_file_name = folder+PREFIX+name+"."+ext
-                else: # no extension
-                    new_file_name = folder+PREFIX+name
-            if not rename_file(file, new_file_name):
-                print("Error renaming files!")
-                exit(1)
-    elif OPTIONS_FLAGS["suffix"]:
-        for file in FILES:
-            folder, name, ext = extract_file_name(file)
-            if "." in file[1:]: # with extension
-                new_file_name = folder+name+SUFFIX+"."+ext
-            else: # no extension
-                new_file_name = folder+name+SUFFIX
-            if not rename_file(file, new_file_name):
-                print("Error renaming files!")
-                exit(1)
-    elif OPTIONS_FLAGS["full_overwrite"]:
-        if FULL_OVERWRITE.count(".") > 1:
-            print("Error too many '.' in new filename!")
+    template, regex = build_template()
+    if template is None:
+        return
+    if os.path.exists(JOURNAL):
+        print("Error journal {} already exists, resume or roll it back first".format(JOURNAL))
+        exit(1)
+    totals = [0, 0]  # renamed files, failed batches
+    kept = []
+
+    def run_batch(batch, start):
+        journal_path = "{}.{}".format(JOURNAL, len(kept)) if kept else JOURNAL
+        renamed, errors = rename_batch(batch, template, regex, start, journal_path)
+        totals[0] += renamed
+        totals[1] += 1 if errors else 0
+        if os.path.exists(journal_path):
+            kept.append(journal_path)
+    start = 0
+    batch = []
+    for file in iter_files():
+        batch.append(file)
+        if len(batch) >= BATCH:
+            run_batch(batch, start)
+            start += len(batch)
+            batch = []
+    if batch:
+        run_batch(batch, start)
+    renamed, failed = totals
+    print("Renamed {} files".format(renamed))
+    if failed:
+        print("Error {} of the batches failed{}".format(
+            failed, ", journals kept: " + ", ".join(kept) if kept else ""))
+        exit(1)
+
+
+def replay_journal():
+    """Resume or roll back the batch recorded in the journal"""
+    journal = Journal(JOURNAL)
+    try:
+        journal.load()
+    except RenameError as _e:
+        print("Error {}".format(_e))
+        exit(1)
+    if OPTIONS_FLAGS["resume"]:
+        renamed, failed = run_journal(journal, resume=True)
+        print("Renamed {} files".format(renamed))
+        if failed:
             exit(1)
-        for idx, file in enumerate(FILES):
-            folder, _, __ = extract_file_name(file)
-            if "." in FULL_OVERWRITE:
-                name, ext = FULL_OVERWRITE.split(".")
-                new_file_name = folder+name+"_"+str(idx)+"."+ext
-            else:
-                name = FULL_OVERWRITE
-                new_file_name = folder+name+"_"+str(idx)
-            if not rename_file(file, new_file_name):
-                print("Error renaming files!")
-                exit(1)
+        return
+    failed = rollback(journal, verbose=OPTIONS_FLAGS["verbose"])
+    journal.close(remove=failed is None)
+    if failed is not None:
+        print("Error rolling back {} to {}: {}".format(*failed))
+        exit(1)
+    print("Rolled back {}".format(JOURNAL))
 
 
 def extract_files(folder):
     """
-    Extract all files from a given folder.
+    Extract all files from a given folder, and its subfolders when recursive.
+    Every folder is listed completely before its files are yielded,
+    so files renamed meanwhile are not listed again.
 
     Parameters:
         folder: path to folder containing files.
-    Returns:
-        files: list of files from the given folder."""
-    if folder == "." or folder == ".*":
-        folder = folder+"/"
-        cmd = "find {} -maxdepth 1 -type f | grep -v ../".format(folder)
-    else:
-        cmd = "find {} -maxdepth 1 -type f".format(folder)
-    print(cmd)
-    ret_val = sp.run(["/bin/bash", "-c", cmd], capture_output=True)
-    files = []
-    if ret_val.returncode == 0:
-        files = ret_val.stdout.decode("utf-8").split("\n")[:-1]
-    return files
+    Yields:
+        paths of the files, sorted per folder."""
+    journal = os.path.abspath(JOURNAL)
+    kept_journal = re.compile(re.escape(journal) + r"\.\d+$")  # Left by failed batches
+    stack = [folder]
+    while stack:
+        current = stack.pop()
+        files = []
+        subfolders = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        files.append(entry.path)
+                    elif OPTIONS_FLAGS["recursive"] and entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.path)
+        except OSError as _e:
+            print("Error reading {}: {}".format(current, _e.strerror))
+            continue
+        for file in sorted(files):
+            if os.path.abspath(file) != journal and not kept_journal.match(os.path.abspath(file)):
+                yield file
+        stack.extend(sorted(subfolders, reverse=True))
+
+
+def read_paths(stream):
+    """
+    Read paths from a binary stream, one per line or NUL separated with -0.
+
+    Yields:
+        paths as strings.
+    """
+    if not OPTIONS_FLAGS["null"]:
+        for line in stream:
+            line = line.rstrip(b"\n")
+            if line:
+                yield os.fsdecode(line)
+        return
+    rest = b""
+    for chunk in iter(lambda: stream.read(65536), b""):
+        parts = (rest + chunk).split(b"\0")
+        rest = parts.pop()
+        for part in parts:
+            if part:
+                yield os.fsdecode(part)
+    if rest:
+        yield os.fsdecode(rest)
 
 
 def check_path(path):
     """
     Checks a if a path is a directory or a file,
-    if the path is a directory the files within is appended to FILES
-    else the file is appended to FILES.
+    if the path is a directory the files within are yielded
+    else the file is yielded.
     """
     if os.path.isdir(path):
-        for element in extract_files(path):
-            FILES.append(element)
+        yield from extract_files(path)
     else:
-        FILES.append(path)
+        yield path
 
 
+def iter_files():
+    """Yield the files given as arguments followed by the files read with --files-from"""
+    for path in PATHS:
+        yield from check_path(path)
+    if FILES_FROM == "-":
+        for path in read_paths(sys.stdin.buffer):
+            yield from check_path(path)
+    elif FILES_FROM:
+        try:
+            with open(FILES_FROM, "rb") as stream:
+                for path in read_paths(stream):
+                    yield from check_path(path)
+        except OSError as _e:
+            print("Error reading {}: {}".format(FILES_FROM, _e.strerror))
+            exit(1)
+
 
 def check_args(args):
     """Seperate args from folders"""
-    global PREFIX, SUFFIX, FULL_OVERWRITE
+    global PREFIX, SUFFIX, FULL_OVERWRITE, JOURNAL, JOBS, TEMPLATE, REGEX, FILES_FROM, BATCH
     for idx, item in enumerate(args):
         if OPTIONS_FLAGS["prefix"]:
             if args[idx-1] in OPTIONS[0:2]:
@@ -170,15 +361,46 @@ def check_args(args):
             if args[idx-1] == OPTIONS[4]:
                 FULL_OVERWRITE = item
                 continue
+        if idx > 0 and args[idx-1] == OPTIONS[5]:
+            JOURNAL = item
+            continue
+        if idx > 0 and args[idx-1] in OPTIONS[12:14]:
+            TEMPLATE = item
+            continue
+        if idx > 0 and args[idx-1] in OPTIONS[14:16]:
+            REGEX = item
+            continue
+        if idx > 0 and args[idx-1] == OPTIONS[18]:
+            FILES_FROM = item
+            continue
+        if idx > 0 and (args[idx-1] in OPTIONS[10:12] or args[idx-1] == OPTIONS[20]):
+            if not item.isdigit() or int(item) < 1:
+                print("Error {} expects a positive number".format(args[idx-1]))
+                exit(1)
+            if args[idx-1] == OPTIONS[20]:
+                BATCH = int(item)
+            else:
+                JOBS = int(item)
+            continue
         if item in OPTIONS:
+            if item == OPTIONS[6]:
+                OPTIONS_FLAGS["resume"] = True
+            if item == OPTIONS[7]:
+                OPTIONS_FLAGS["rollback"] = True
+            if item in OPTIONS[8:10]:
+                OPTIONS_FLAGS["verbose"] = True
             if item in OPTIONS[0:2]:
                 OPTIONS_FLAGS["prefix"] = True
             if item in OPTIONS[2:4]:
                 OPTIONS_FLAGS["suffix"] = True
-            if item in OPTIONS[4]:
+            if item == OPTIONS[4]:
                 OPTIONS_FLAGS["full_overwrite"] = True
+            if item in OPTIONS[16:18]:
+                OPTIONS_FLAGS["recursive"] = True
+            if item == OPTIONS[19]:
+                OPTIONS_FLAGS["null"] = True
         else:
-            check_path(item)
+            PATHS.append(item)
 
 
 def main():
@@ -195,7 +417,10 @@ def main():
                 print(option)
             exit(0)
         check_args(sys.argv[1:])
-        rename_files()
+        if OPTIONS_FLAGS["resume"] or OPTIONS_FLAGS["rollback"]:
+            replay_journal()
+        else:
+            rename_files()
 
 if __name__ == "__main__":
     main()
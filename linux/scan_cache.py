@@ -0,0 +1,105 @@
+"""
+Scan cache
+Persistent per-directory results for count_files, keyed on the
+(device, inode, mtime) of each directory.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                                  "count_files", "scan_cache.sqlite")
+DEFAULT_MAX_ENTRIES = 1000000
+FLUSH_EVERY = 10000
+
+
+class ScanCache(object):
+    """
+    Store the direct file count, size, hardlinks and subdirectory names of
+    every scanned directory. A directory's mtime changes whenever entries are
+    added, removed or renamed in it, so an unchanged (device, inode, mtime)
+    can be answered without listing the directory again.
+    Files growing in place do not change the mtime, use refresh for those.
+    """
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_entries=DEFAULT_MAX_ENTRIES, refresh=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = []
+        self.touched = []
+        self.now = int(time.time())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dirs ("
+                          "dev INTEGER, ino INTEGER, mtime_ns INTEGER, files INTEGER, size INTEGER, "
+                          "links TEXT, subdirs TEXT, last_used INTEGER, PRIMARY KEY (dev, ino))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS dirs_last_used ON dirs (last_used)")
+
+    def get(self, dir_stat):
+        """
+        Look up a directory
+        Parameters:
+        dir_stat: os.stat result of the directory
+        Returns:
+        (files, size, links, subdir names) or None if missing or modified
+        """
+        if self.refresh:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT mtime_ns, files, size, links, subdirs FROM dirs "
+                                    "WHERE dev = ? AND ino = ?",
+                                    (dir_stat.st_dev, dir_stat.st_ino)).fetchone()
+            if row is None or row[0] != dir_stat.st_mtime_ns:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched.append((self.now, dir_stat.st_dev, dir_stat.st_ino))
+            if len(self.touched) >= FLUSH_EVERY:
+                self.flush_locked()
+        links = [tuple(link) for link in json.loads(row[3])]
+        return row[1], row[2], links, json.loads(row[4])
+
+    def put(self, dir_stat, files, size, links, subdirs):
+        """
+        Store the result of scanning a directory
+        Parameters:
+        dir_stat: os.stat result of the directory, taken before it was listed
+        files, size, links: as returned by scan_directory
+        subdirs: names of the subdirectories
+        """
+        with self.lock:
+            self.pending.append((dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns, files, size,
+                                 json.dumps(links), json.dumps(subdirs), self.now))
+            if len(self.pending) >= FLUSH_EVERY:
+                self.flush_locked()
+
+    def flush_locked(self):
+        """Write buffered entries, the lock must be held"""
+        if self.pending:
+            self.conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  self.pending)
+            self.pending = []
+        if self.touched:
+            self.conn.executemany("UPDATE dirs SET last_used = ? WHERE dev = ? AND ino = ?",
+                                  self.touched)
+            self.touched = []
+        self.conn.commit()
+
+    def close(self):
+        """Flush buffered entries and evict the least recently used beyond max_entries"""
+        with self.lock:
+            self.flush_locked()
+            count = self.conn.execute("SELECT COUNT(*) FROM dirs").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute("DELETE FROM dirs WHERE rowid IN "
+                                  "(SELECT rowid FROM dirs ORDER BY last_used LIMIT ?)",
+                                  (count - self.max_entries,))
+                self.conn.commit()
+            self.conn.close()
@@ -1,13 +1,474 @@
-import yaml
+"""Validate yaml
+This script validates YAML files, the .yaml/.yml files of directories and glob
+patterns on a process pool, with the libyaml loader when it is available.
+Results of files whose content did not change are answered from a cache.
+The stream mode checks every document of a file event by event, in constant
+memory, optionally against required top level keys and a max nesting depth."""
 import sys
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from glob import glob
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import yaml
+from validation_cache import ValidationCache, DEFAULT_CACHE_FILE
+
+LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_EXTENSIONS = (".yaml", ".yml")
+CHUNK_SIZE = 1024 * 1024
+BATCH_FILES = 32
+BATCH_BYTES = 8 * 1024 * 1024
+IN_FLIGHT = 2
+MAX_ERRORS = 100
+CACHED_FIELDS = ["valid", "error", "line", "column", "documents", "errors", "more_errors"]
+
+JOBS = os.cpu_count() or 1
+FORMAT = "text"
+FORMATS = ["text", "json", "ndjson"]
+PATHS = []
+REQUIRED_KEYS = []
+MAX_DEPTH = 0
+
+OPTIONS = ["-j", "--jobs", "-f", "--format", "--no-cache", "--refresh", "-s", "--stream", "--require",
+           "--max-depth", "-h", "-H", "--help"]
+OPTIONS_FLAGS = {"No_cache": False, "Refresh": False, "Stream": False}
+OPTIONS_HELP_TEXT = {
+    "-j": "{:>5}{:>3} {:<10}\tValidate on N processes (default: number of cpus)".format(
+        OPTIONS[0], "", OPTIONS[1] + " N"),
+    "-f": "{:>5}{:>3} {:<10}\tOutput text (default), json (one document) or ndjson records".format(
+        OPTIONS[2], "", OPTIONS[3] + " F"),
+    "--no-cache": "{:>5}{:>3} {:<10}\tDo not read or write the result cache".format("", "", OPTIONS[4]),
+    "--refresh": "{:>5}{:>3} {:<10}\tValidate every file again and rewrite the result cache".format(
+        "", "", OPTIONS[5]),
+    "-s": "{:>5}{:>3} {:<10}\tCheck every document event by event in constant memory, without loading it".format(
+        OPTIONS[6], "", OPTIONS[7]),
+    "--require": "{:>5}{:>3} {:<10}\tKEY[,KEY]... every document must be a mapping with these top level keys,\n"
+                 "\t\t\timplies --stream, can be repeated".format("", "", OPTIONS[8] + " K"),
+    "--max-depth": "{:>5}{:>3} {:<10}\tCollections must not be nested deeper than N, implies --stream".format(
+        "", "", OPTIONS[9] + " N"),
+    "-h": "{:>5}{:>3} {:<10}\tDisplay this help and exit".format(OPTIONS[-3], OPTIONS[-2], OPTIONS[-1])
+}
+
+
+def expand_paths(paths):
+    """
+    Files to validate: files as given, the .yaml/.yml files below directories
+    and the matches of glob patterns, in order and without repeats.
+    Paths that match nothing are kept so they are reported as missing.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(YAML_EXTENSIONS))
+        elif not os.path.exists(path) and any(char in path for char in "*?["):
+            matches = sorted(glob(path, recursive=True))
+            files.extend(match for match in matches if not os.path.isdir(match))
+            if not matches:
+                files.append(path)
+        else:
+            files.append(path)
+    return list(dict.fromkeys(os.path.normpath(file) for file in files))
+
+
+def content_digest(path):
+    """
+    blake2b hex digest and size of a file
+    Raises OSError if the file can not be read
+    """
+    digest = hashlib.blake2b()
+    size = 0
+    with open(path, "rb") as _f:
+        for chunk in iter(lambda: _f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def digest_batch(paths):
+    """
+    Hash several files in one task
+    Returns:
+    list of (path, digest, size, error), digest is None when the file can not be read
+    """
+    digests = []
+    for path in paths:
+        try:
+            digests.append((path,) + content_digest(path) + ("",))
+        except OSError as _e:
+            digests.append((path, None, 0, _e.strerror or str(_e)))
+    return digests
+
+
+def new_result(path):
+    """Result of a file before it is validated"""
+    return {"type": "file", "path": path, "valid": False, "error": "", "line": None, "column": None,
+            "documents": 0, "errors": [], "more_errors": 0, "cached": False, "seconds": 0.0}
+
+
+def add_error(result, message, mark=None, document=None):
+    """
+    Add an error to a result, the first one is also its error, line and column.
+    Only MAX_ERRORS are kept, the others are counted.
+    """
+    error = {"error": message, "line": mark.line + 1 if mark is not None else None,
+             "column": mark.column + 1 if mark is not None else None, "document": document}
+    if not result["errors"]:
+        result.update(error=message, line=error["line"], column=error["column"])
+    if len(result["errors"]) < MAX_ERRORS:
+        result["errors"].append(error)
+    else:
+        result["more_errors"] += 1
+
+
+def check_events(_f, result, required=(), max_depth=0):
+    """
+    Parse every document of a stream event by event, without constructing its
+    objects, so memory does not grow with the file, and check the structural rules
+    Parameters:
+    result: result of the file, its documents and errors are added as they are found
+    required: top level keys every document must have
+    max_depth: deepest nesting of collections allowed, 0 for any
+    Raises yaml.MarkedYAMLError at the first syntax error, the parser can not go on after it
+    """
+    required = set(required)
+    depth = 0
+    mapping_root = False
+    key_next = False  # The next node of the root mapping is a key
+    found = set()
+    document_mark = None
+    for event in yaml.parse(_f, Loader=LOADER):
+        kind = type(event)
+        if kind is yaml.ScalarEvent or kind is yaml.AliasEvent:
+            if depth == 1 and mapping_root:
+                if key_next and kind is yaml.ScalarEvent and event.value in required:
+                    found.add(event.value)
+                key_next = not key_next
+        elif kind is yaml.MappingStartEvent or kind is yaml.SequenceStartEvent:
+            if depth == max_depth and max_depth:
+                add_error(result, "collection nested deeper than %d levels" %max_depth, event.start_mark,
+                          result["documents"])
+            if depth == 0:
+                mapping_root = kind is yaml.MappingStartEvent
+                key_next = True
+            depth += 1
+        elif kind is yaml.MappingEndEvent or kind is yaml.SequenceEndEvent:
+            depth -= 1
+            if depth == 1 and mapping_root:  # A collection key or value of the root mapping is complete
+                key_next = not key_next
+        elif kind is yaml.DocumentStartEvent:
+            result["documents"] += 1
+            document_mark = event.start_mark
+            mapping_root = False
+            found = set()
+        elif kind is yaml.DocumentEndEvent and required:
+            if not mapping_root:
+                add_error(result, "document is not a mapping with the required keys", document_mark,
+                          result["documents"])
+            elif found != required:
+                add_error(result, "missing required keys: %s" %", ".join(sorted(required - found)),
+                          document_mark, result["documents"])
+
+
+def validate_file(path, rules=None):
+    """
+    Parse a file with LOADER, or check its events in stream mode
+    Parameters:
+    rules: dict with stream, required and max_depth, see check_events
+    Returns:
+    the result dict, and whether it depends on the content only and can be cached
+    """
+    rules = rules or {}
+    result = new_result(path)
+    started = time.perf_counter()
+    cacheable = True
+    try:
+        with open(path, "rb") as _f:
+            if rules.get("stream"):
+                check_events(_f, result, rules.get("required", ()), rules.get("max_depth", 0))
+            else:
+                yaml.load(_f, Loader=LOADER)
+                result["documents"] = 1
+    except yaml.MarkedYAMLError as _e:
+        add_error(result, " ".join(part for part in (_e.context, _e.problem) if part),
+                  _e.problem_mark or _e.context_mark, result["documents"] or None)
+    except OSError as _e:
+        add_error(result, _e.strerror or str(_e))
+        cacheable = False
+    except Exception as _e:
+        add_error(result, str(_e) or type(_e).__name__)
+    result["valid"] = not result["errors"]
+    result["seconds"] = round(time.perf_counter() - started, 6)
+    return result, cacheable
 
-file_to_validate = sys.argv[1]
 
-print(f"Validating file: {file_to_validate}")
+def validate_batch(paths, rules=None):
+    """Validate several files in one task, so small files do not cost a round trip each"""
+    return [validate_file(path, rules) for path in paths]
 
-with open(file_to_validate, "r") as stream:
+
+def batches(files):
+    """Group (path, size) into batches of at most BATCH_FILES files and about BATCH_BYTES"""
+    batch = []
+    size = 0
+    for path, file_size in files:
+        batch.append(path)
+        size += file_size
+        if len(batch) >= BATCH_FILES or size >= BATCH_BYTES:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def validate_files(files, cache=None, rules=None):
+    """
+    Validate files, answering unchanged ones from the cache and parsing the
+    others inline or on a pool of JOBS processes. On the pool the workers hash
+    the files too, hashing and validation batches are interleaved with at
+    most JOBS * IN_FLIGHT submitted. A worker dying breaks the pool: it is
+    started again and the files of the lost validation batches are retried
+    one at a time, with nothing else running, so only a file that kills its
+    worker again is reported as failed.
+    Yields:
+    the result of every file, in completion order
+    """
+    digests = {}
+
+    def lookup(path, digest, size, error):
+        # Result of a hashed file that is not validated again, None if it has to be
+        result = new_result(path)
+        if error:
+            add_error(result, error)
+            return result
+        stored = cache.get(digest)
+        if stored is None:
+            digests[path] = digest
+            return None
+        result.update(stored, cached=True)
+        return result
+
+    def finish(batch_results):
+        for result, cacheable in batch_results:
+            digest = digests.pop(result["path"], None)
+            if digest is not None and cacheable:
+                cache.put(digest, {key: result[key] for key in CACHED_FIELDS})
+        return [result for result, _ in batch_results]
+
+    if JOBS <= 1:
+        todo = []
+        for path in files:
+            if cache is None:
+                todo.append((path, 0))
+                continue
+            entry = digest_batch([path])[0]
+            result = lookup(*entry)
+            if result is None:
+                todo.append((path, entry[2]))
+            else:
+                yield result
+        for batch in batches(todo):
+            yield from finish(validate_batch(batch, rules))
+        return
+    files = iter(files)
+    work = deque()  # Tasks to submit before taking more files: (digest_batch or validate_batch, paths)
+    pending = {}
+    suspects = deque()  # Files of validation batches lost with a dead worker
+    isolated = None  # The suspect running alone on the pool
+    broken = False
+    pool = ProcessPoolExecutor(max_workers=JOBS)
+    try:
+        while True:
+            if broken and not pending:
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = ProcessPoolExecutor(max_workers=JOBS)
+                broken = False
+            try:  # A task is only taken off its queue once submitted
+                if suspects:
+                    if not pending:
+                        pending[pool.submit(validate_batch, [suspects[0]], rules)] = (validate_batch, [suspects[0]])
+                        isolated = suspects.popleft()
+                else:
+                    while len(pending) < JOBS * IN_FLIGHT:
+                        if not work:
+                            paths = list(islice(files, BATCH_FILES))
+                            if not paths:
+                                break
+                            work.append((digest_batch if cache is not None else validate_batch, paths))
+                        function, paths = work[0]
+                        args = (paths, rules) if function is validate_batch else (paths,)
+                        pending[pool.submit(function, *args)] = work.popleft()
+            except BrokenProcessPool:  # A worker died since the last wait
+                broken = True
+            if not pending:
+                if broken or suspects or work:
+                    continue
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                function, paths = pending.pop(future)
+                try:
+                    output = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    if function is digest_batch:
+                        work.append((function, paths))
+                    elif paths != [isolated]:
+                        suspects.extend(paths)
+                    else:
+                        isolated = None
+                        result = new_result(paths[0])
+                        add_error(result, "the worker process validating it died")
+                        digests.pop(paths[0], None)
+                        yield result
+                    continue
+                if function is validate_batch:
+                    if paths == [isolated]:
+                        isolated = None
+                    yield from finish(output)
+                    continue
+                todo = []
+                for entry in output:
+                    result = lookup(*entry)
+                    if result is None:
+                        todo.append((entry[0], entry[2]))
+                    else:
+                        yield result
+                work.extend((validate_batch, batch) for batch in batches(todo))
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def emit_result(result):
+    """Print the result of a file as a line of text or an ndjson record"""
+    if FORMAT == "ndjson":
+        sys.stdout.write(json.dumps(result) + "\n")
+    elif result["valid"]:
+        sys.stdout.write("{}: Valid{}\n".format(result["path"], " (cached)" if result["cached"] else ""))
+    else:
+        for error in result["errors"]:
+            position = "{}:{}:".format(error["line"], error["column"]) if error["line"] is not None else ""
+            document = "document {}: ".format(error["document"]) if error["document"] else ""
+            sys.stdout.write("{}:{} {}{}\n".format(result["path"], position, document, error["error"]))
+        if result["more_errors"]:
+            sys.stdout.write("{}: {} more errors\n".format(result["path"], result["more_errors"]))
+    sys.stdout.flush()
+
+
+def validation_rules():
+    """The mode and rules files are validated with, passed on to the workers"""
+    return {"stream": OPTIONS_FLAGS["Stream"], "required": sorted(set(REQUIRED_KEYS)), "max_depth": MAX_DEPTH}
+
+
+def open_cache(rules):
+    """Open the result cache unless disabled, continue without it if it can not be opened"""
+    if OPTIONS_FLAGS["No_cache"]:
+        return None
+    try:
+        return ValidationCache("%s pyyaml %s %s" %(LOADER.__name__, yaml.__version__, json.dumps(rules)),
+                               refresh=OPTIONS_FLAGS["Refresh"])
+    except (OSError, sqlite3.Error) as _e:
+        print("Result cache unavailable, continuing without it: {}".format(_e), file=sys.stderr)
+        return None
+
+
+def check_args(args):
+    """Separate args from paths"""
+    global JOBS, FORMAT, MAX_DEPTH
+    for idx, item in enumerate(args):
+        if idx > 0 and args[idx - 1] in OPTIONS[0:2]:
+            if not item.isdigit() or int(item) < 1:
+                print("Error {} expects a positive number of jobs".format(args[idx - 1]))
+                sys.exit(1)
+            JOBS = int(item)
+            continue
+        if idx > 0 and args[idx - 1] in OPTIONS[2:4]:
+            if item not in FORMATS:
+                print("Error {} expects one of: {}".format(args[idx - 1], ", ".join(FORMATS)))
+                sys.exit(1)
+            FORMAT = item
+            continue
+        if idx > 0 and args[idx - 1] == OPTIONS[8]:
+            keys = [key for key in item.split(",") if key]
+            if not keys:
+                print("Error {} expects a comma separated list of keys".format(args[idx - 1]))
+                sys.exit(1)
+            REQUIRED_KEYS.extend(keys)
+            OPTIONS_FLAGS["Stream"] = True
+            continue
+        if idx > 0 and args[idx - 1] == OPTIONS[9]:
+            if not item.isdigit() or int(item) < 1:
+                print("Error {} expects a positive number".format(args[idx - 1]))
+                sys.exit(1)
+            MAX_DEPTH = int(item)
+            OPTIONS_FLAGS["Stream"] = True
+            continue
+        if item in OPTIONS:
+            if item == OPTIONS[4]:
+                OPTIONS_FLAGS["No_cache"] = True
+            if item == OPTIONS[5]:
+                OPTIONS_FLAGS["Refresh"] = True
+            if item in OPTIONS[6:8]:
+                OPTIONS_FLAGS["Stream"] = True
+        else:
+            PATHS.append(item)
+
+
+def main():
+    """Main function"""
+    if len(sys.argv) < 2:
+        print("Usage: validate_yaml.py [OPTION]... [FILE/DIRECTORY/GLOB]...")
+        sys.exit(1)
+    if any(help_option in sys.argv for help_option in OPTIONS[-3:]):
+        print("Usage: validate_yaml.py [OPTION]... [FILE/DIRECTORY/GLOB]...")
+        print("Validates YAML files, directories are searched for .yaml and .yml files")
+        print("*NOTE* results of unchanged files are answered from the cache in {}".format(DEFAULT_CACHE_FILE))
+        print("*NOTE* without --stream a file must hold a single document, like yaml.safe_load expects")
+        print("*NOTE* exits with 1 if any file is invalid or can not be read")
+        print("Options:")
+        for option in OPTIONS_HELP_TEXT.values():
+            print(option)
+        sys.exit(0)
+    check_args(sys.argv[1:])
+    files = expand_paths(PATHS)
+    if not files:
+        print("Error no files to validate")
+        sys.exit(1)
+    started = time.perf_counter()
+    rules = validation_rules()
+    cache = open_cache(rules)
+    results = []
     try:
-        yaml.safe_load(stream)
-        print("Valid")
-    except yaml.YAMLError as exc:
-        print(exc)
\ No newline at end of file
+        for result in validate_files(files, cache, rules):
+            results.append(result)
+            if FORMAT != "json":
+                emit_result(result)
+    finally:
+        if cache is not None:
+            cache.close()
+    invalid = sum(1 for result in results if not result["valid"])
+    total = {"type": "total", "files": len(results), "valid": len(results) - invalid, "invalid": invalid,
+             "cached": sum(1 for result in results if result["cached"]), "loader": LOADER.__name__,
+             "stream": rules["stream"], "jobs": JOBS, "seconds": round(time.perf_counter() - started, 6)}
+    if FORMAT == "json":
+        order = {path: idx for idx, path in enumerate(files)}
+        results.sort(key=lambda result: order[result["path"]])
+        json.dump(dict(total, results=results), sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    elif FORMAT == "ndjson":
+        sys.stdout.write(json.dumps(total) + "\n")
+    else:
+        print("Validated {} files: {} valid, {} invalid, {} from cache, in {:.2f}s with {} on {} jobs".format(
+            total["files"], total["valid"], invalid, total["cached"], total["seconds"], LOADER.__name__, JOBS))
+    sys.exit(1 if invalid else 0)
+
+
+if __name__ == "__main__":
+    main()
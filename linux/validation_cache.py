@@ -0,0 +1,87 @@
+"""
+Validation cache
+Persistent validate_yaml results keyed on the content hash of each file and
+the settings it was validated with, so unchanged files are not parsed again.
+"""
+import os
+import json
+import time
+import sqlite3
+
+DEFAULT_CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                                  "validate_yaml", "results.sqlite")
+DEFAULT_MAX_ENTRIES = 100000
+FLUSH_EVERY = 1000
+
+
+class ValidationCache(object):
+    """
+    Store the result of every validated file under the blake2b digest of its
+    content. settings describes the loader and rules, results of other
+    settings are not returned.
+    """
+    def __init__(self, settings, path=DEFAULT_CACHE_FILE, max_entries=DEFAULT_MAX_ENTRIES, refresh=False):
+        self.settings = settings
+        self.path = path
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.pending = []
+        self.touched = []
+        self.now = int(time.time())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                          "digest TEXT, settings TEXT, result TEXT, last_used INTEGER, "
+                          "PRIMARY KEY (digest, settings))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def get(self, digest):
+        """
+        Look up a file
+        Returns:
+        the stored result dict, or None if the content was not validated before
+        """
+        if self.refresh:
+            return None
+        row = self.conn.execute("SELECT result FROM results WHERE digest = ? AND settings = ?",
+                                (digest, self.settings)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched.append((self.now, digest, self.settings))
+        if len(self.touched) >= FLUSH_EVERY:
+            self.flush()
+        return json.loads(row[0])
+
+    def put(self, digest, result):
+        """Store the result of validating content with this digest"""
+        self.pending.append((digest, self.settings, json.dumps(result), self.now))
+        if len(self.pending) >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        """Write buffered entries"""
+        if self.pending:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", self.pending)
+            self.pending = []
+        if self.touched:
+            self.conn.executemany("UPDATE results SET last_used = ? WHERE digest = ? AND settings = ?",
+                                  self.touched)
+            self.touched = []
+        self.conn.commit()
+
+    def close(self):
+        """Flush buffered entries and evict the least recently used beyond max_entries"""
+        self.flush()
+        count = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute("DELETE FROM results WHERE rowid IN "
+                              "(SELECT rowid FROM results ORDER BY last_used LIMIT ?)",
+                              (count - self.max_entries,))
+            self.conn.commit()
+        self.conn.close()